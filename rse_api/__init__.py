@@ -10,12 +10,17 @@ from flask.cli import AppGroup
 from rse_api.cli import add_cli
 from rse_api.decorators import singleton_function
 from rse_api.errors import register_common_error_handlers
+from rse_api.json_backend import register_json_backend
+from rse_api.metrics import register_metrics
+from rse_api.profiling import register_profiling
+from rse_api.utils import get_lazy_actors, import_pending_modules
 
 HAS_DRAMATIQ = util.find_spec('dramatiq') is not None
 HAS_RESTFUL = util.find_spec('flask_restful') is not None
 HAS_RABBIT = util.find_spec('pika') is not None
 HAS_REDIS = util.find_spec('redis') is not None
 HAS_APSCHEDULER = util.find_spec('apscheduler') is not None
+HAS_SQLALCHEMY = util.find_spec('sqlalchemy') is not None
 
 __author__ = """Clinton Collins"""
 __email__ = 'ccollins@idmod.org'
@@ -41,6 +46,7 @@ def default_dramatiq_setup_broker(app):
         import dramatiq
         import dramatiq.brokers
         from rse_api.tasks.app_context_middleware import AppContextMiddleware
+        from rse_api.tasks.idempotent import get_idempotent_results
 
         broker = None
         # if we are testing, setup stub broker
@@ -75,7 +81,9 @@ def default_dramatiq_setup_broker(app):
 
         if broker is not None:
             dramatiq.set_broker(broker)
-            broker.add_middleware(AppContextMiddleware(app))
+            broker.add_middleware(AppContextMiddleware(app, app.config.get('DRAMATIQ_REUSE_APP_CONTEXT', False)))
+            # added before the actors are declared so they can use the idempotent options
+            broker.add_middleware(get_idempotent_results(app))
         # add worker cli as well
         get_worker_cli(app)
         return broker
@@ -95,10 +103,15 @@ def get_application(setting_object_path: str=None, setting_environment_variable:
                     default_error_handlers: bool=True,
                     setup_broker_func: Optional[Callable] = default_dramatiq_setup_broker,
                     setup_results_backend_func: Optional[Callable] = None,
-                    template_folder='templates') -> Flask:
+                    template_folder='templates',
+                    json_backend: Optional[str]=None,
+                    metrics_endpoint: Optional[str]='/metrics') -> Flask:
     """
     Returns a Flask Application object. This function is a singleton function
 
+    In debug mode, or when the QUERY_COUNTER setting is true, the number of SQL queries of each request is counted
+    and a warning is logged above QUERY_COUNT_WARN_THRESHOLD. See rse_api.query.register_query_counter
+
 
     :param setup_broker_func: Function callback to setup brokers for queues. By default a function that checks for dramatiq
     is called and if deted
@@ -108,6 +121,11 @@ def get_application(setting_object_path: str=None, setting_environment_variable:
     :param strict_slashes: Should we use strict slashes(Ie a call to /projects will fail but a call to /projects will
       succeed
     :param template_folder: Template folder
+    :param json_backend: JSON library used to encode responses and decode requests. One of auto, orjson, rapidjson,
+      ujson or json. auto uses the fastest installed library and json is the standard library. If not specified,
+      the JSON_BACKEND setting is used, which defaults to auto
+    :param metrics_endpoint: Url of the Prometheus metrics endpoint reporting the latency, status codes, sizes and
+      time split of every endpoint. None disables the metrics. See rse_api.metrics.register_metrics
     :return: Flask app
     """
     app = Flask(__name__, template_folder=template_folder)
@@ -121,11 +139,19 @@ def get_application(setting_object_path: str=None, setting_environment_variable:
         app.logger.debug('Loading Application settings from the file {}'.format(os.environ[setting_environment_variable]))
         app.config.from_envvar(setting_environment_variable)
     app.url_map.strict_slashes = strict_slashes
+    register_json_backend(app, json_backend or app.config.get('JSON_BACKEND', 'auto'))
+    if metrics_endpoint:
+        register_metrics(app, metrics_endpoint)
+    register_profiling(app)
     add_cli(app)
 
     if default_error_handlers:
         register_common_error_handlers(app)
 
+    if HAS_SQLALCHEMY and (app.debug or app.config.get('QUERY_COUNTER', False)):
+        from rse_api.query import register_query_counter
+        register_query_counter(app)
+
     if HAS_DRAMATIQ and callable(setup_broker_func):
         app.broker = setup_broker_func(app)
 
@@ -191,17 +217,43 @@ def get_worker_cli(app,):
         @worker_cli.command('start', help="Starts all the workers including corn")
         @click.option('--cron', default=True, help='Whether we want to run cron jobs as well')
         @click.option('--processes', default=None, help='Whether we want to run cron jobs as well')
-        def start_workers(cron, processes):
+        @click.option('--autoscale', is_flag=True, default=False,
+                      help='Scale the worker processes with the queue depth and CPU load')
+        @click.option('--min-processes', default=1, help='Minimum number of processes when autoscaling')
+        @click.option('--max-processes', default=None, type=int,
+                      help='Maximum number of processes when autoscaling. Defaults to the number of CPUs')
+        @click.option('--min-threads', default=1, help='Threads per process for CPU bound work when autoscaling')
+        @click.option('--max-threads', default=8, help='Threads per process for I/O bound work when autoscaling')
+        @click.option('--scale-up-cooldown', default=30.0, help='Seconds between two scale ups')
+        @click.option('--scale-down-cooldown', default=300.0, help='Seconds between two scale downs')
+        def start_workers(cron, processes, autoscale, min_processes, max_processes, min_threads, max_threads,
+                          scale_up_cooldown, scale_down_cooldown):
+            # workers only consume the queues of declared actors so lazy modules are imported now
+            import_pending_modules()
             if HAS_APSCHEDULER and cron is True:
                 from apscheduler.schedulers.background import BackgroundScheduler
                 run_cron_workers(scheduler=BackgroundScheduler)
 
-            start_dramatiq_workers(app, processes)
+            pools = app.config.get('DRAMATIQ_WORKER_POOLS', None)
+            if pools:
+                if autoscale:
+                    raise click.UsageError("--autoscale cannot be used with DRAMATIQ_WORKER_POOLS")
+                from rse_api.tasks.pools import PoolSupervisor, get_worker_pools
+                PoolSupervisor(app.broker, get_worker_pools(pools, app.broker.get_declared_queues())).run()
+            elif autoscale:
+                from rse_api.tasks.autoscale import AutoscaleSupervisor
+                AutoscaleSupervisor(app.broker, min_processes=min_processes, max_processes=max_processes,
+                                    min_threads=min_threads, max_threads=max_threads,
+                                    scale_up_cooldown=scale_up_cooldown,
+                                    scale_down_cooldown=scale_down_cooldown).run()
+            else:
+                start_dramatiq_workers(app, processes)
 
         @worker_cli.command('list', help="Lists all the workers")
         def list_workers():
             import dramatiq
-            workers = dramatiq.get_broker().get_declared_actors()
+            # actors of lazy modules are listed from the manifest without importing them
+            workers = set(dramatiq.get_broker().get_declared_actors()) | set(get_lazy_actors())
             workers = sorted(workers)
             print('Workers available: ')
             [print(worker) for worker in workers]
@@ -210,6 +262,7 @@ def get_worker_cli(app,):
 
         @worker_cli.command('cron', help="Run any scheduled workers")
         def run_cron_only():
+            import_pending_modules()
             run_cron_workers()
 
     app.cli.add_command(worker_cli)
@@ -0,0 +1,236 @@
+import hashlib
+import pickle
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, Iterable, Optional
+from flask import current_app, request, Response
+
+
+class MemoryCache:
+    def __init__(self, max_size: int = 1024, default_ttl: Optional[float] = None):
+        """
+        In process cache that evicts the least recently used items once max_size is reached and expires items after
+        their time to live
+
+        The cache is thread safe. It is local to the process so every worker will have its own copy
+
+        :param max_size: Maximum number of items to keep
+        :param default_ttl: Time to live in seconds used when set is called without a ttl. None means items only expire
+        when evicted
+        """
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._items.get(key, None)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key: Hashable, value: Any, ttl: Optional[float]):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        self._items[key] = (value, expires)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def _is_live(self, item) -> bool:
+        return item is not None and (item[1] is None or item[1] >= time.monotonic())
+
+    def add(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> bool:
+        """
+        Sets the value only if the key is not already in the cache
+
+        :return: True if the value was set
+        """
+        with self._lock:
+            if self._is_live(self._items.get(key, None)):
+                return False
+            self._set(key, value, ttl)
+        return True
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def delete_if(self, key: Hashable, value: Any) -> bool:
+        """
+        Deletes the key only if it holds value, ie to release a lock taken with add
+
+        :return: True if the key was deleted
+        """
+        with self._lock:
+            item = self._items.get(key, None)
+            if not self._is_live(item) or item[0] != value:
+                return False
+            del self._items[key]
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+# Deletes a key in a single step only if it holds a value
+DELETE_IF_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisCache:
+    def __init__(self, url: str, prefix: str = 'rse_api:', default_ttl: Optional[float] = None):
+        """
+        Cache stored in Redis and shared by every worker. Values are pickled
+
+        :param url: Redis url
+        :param prefix: Prefix added to every key
+        :param default_ttl: Time to live in seconds used when set is called without a ttl
+        """
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+
+    def _ttl(self, ttl: Optional[float]) -> Optional[int]:
+        ttl = self.default_ttl if ttl is None else ttl
+        return int(ttl) if ttl is not None else None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else default
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self._ttl(ttl))
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        return bool(self.client.set(self.prefix + key, pickle.dumps(value), ex=self._ttl(ttl), nx=True))
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def delete_if(self, key: str, value: Any) -> bool:
+        """
+        Deletes the key only if it holds value, ie to release a lock taken with add
+
+        :return: True if the key was deleted
+        """
+        return bool(self.client.eval(DELETE_IF_SCRIPT, 1, self.prefix + key, pickle.dumps(value)))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+def get_response_cache(app=None):
+    """
+    Returns the response cache of the application, creating it on first use
+
+    The backend is controlled by the RESPONSE_CACHE_BACKEND setting. memory(the default) is an in process LRU cache
+    holding RESPONSE_CACHE_SIZE(default 1024) responses. redis shares the cache between workers using REDIS_URI
+
+    :param app: Flask application. Defaults to the current application
+    :return: MemoryCache or RedisCache
+    """
+    app = app or current_app
+    cache = app.extensions.get('rse_response_cache', None)
+    if cache is None:
+        backend = app.config.get('RESPONSE_CACHE_BACKEND', 'memory')
+        if backend == 'redis':
+            cache = RedisCache(app.config.get('REDIS_URI', None), prefix='rse_api:response:')
+        elif backend == 'memory':
+            cache = MemoryCache(max_size=app.config.get('RESPONSE_CACHE_SIZE', 1024))
+        else:
+            raise ValueError("Unsupported response cache backend {}".format(backend))
+        app.extensions['rse_response_cache'] = cache
+    return cache
+
+
+def _get_namespace_token(cache, namespace: str) -> str:
+    # Every namespace has a random token that is part of the keys of its responses. Invalidating a namespace replaces
+    # the token so all its responses become unreachable at once and expire on their own
+    key = 'namespace:' + namespace
+    token = cache.get(key)
+    if token is None:
+        cache.add(key, uuid.uuid4().hex)
+        token = cache.get(key)
+    return token
+
+
+def invalidate_response_cache(namespace: str, cache=None):
+    """
+    Invalidates every cached response of a namespace
+
+    :param namespace: Namespace to invalidate. For SimpleController this is the table name of the model by default
+    :param cache: Cache to use. Defaults to the response cache of the current application
+    """
+    cache = get_response_cache() if cache is None else cache
+    cache.set('namespace:' + namespace, uuid.uuid4().hex)
+
+
+def get_response_cache_key(namespace: str, vary_headers: Iterable[str] = (), cache=None) -> str:
+    """
+    Returns the key of the current request in the response cache. The key is made of the namespace, the endpoint, the
+    path(so the view args), the query string and the vary_headers
+
+    :param namespace: Namespace of the response
+    :param vary_headers: Request headers that change the response, for example Authorization or Accept-Language
+    :param cache: Cache to use
+    :return: Key
+    """
+    cache = get_response_cache() if cache is None else cache
+    parts = [request.method, str(request.endpoint), request.path,
+             repr(sorted(request.args.items(multi=True)))]
+    parts.extend('{}={}'.format(header, request.headers.get(header, '')) for header in vary_headers)
+    digest = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+    return 'response:{}:{}:{}'.format(namespace, _get_namespace_token(cache, namespace), digest)
+
+
+def cached_call(build_response: Callable[[], Any], namespace: str, timeout: Optional[float] = 60,
+                vary_headers: Iterable[str] = (), cache=None) -> Any:
+    """
+    Returns the cached response of the current request or calls build_response and caches its result
+
+    Only successful GET requests returning a non streamed flask Response are cached
+
+    :param build_response: Function that builds the response
+    :param namespace: Namespace of the response. See invalidate_response_cache
+    :param timeout: Time to live of the response in seconds
+    :param vary_headers: Request headers that change the response
+    :param cache: Cache to use. Defaults to the response cache of the current application
+    :return: Response
+    """
+    if request.method != 'GET':
+        return build_response()
+    cache = get_response_cache() if cache is None else cache
+    key = get_response_cache_key(namespace, vary_headers, cache)
+    cached = cache.get(key)
+    if cached is not None:
+        body, status, headers = cached
+        return Response(body, status=status, headers=headers).make_conditional(request)
+
+    response = build_response()
+    if isinstance(response, Response) and response.status_code == 200 and not response.is_streamed:
+        cache.set(key, (response.get_data(), response.status_code, list(response.headers.items())), ttl=timeout)
+    return response
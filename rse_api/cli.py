@@ -1,14 +1,144 @@
+import multiprocessing
+import os
+from importlib import util
 import click
 from flask.cli import AppGroup
 
+HAS_GUNICORN = util.find_spec('gunicorn') is not None and os.name != 'nt'
+HAS_WAITRESS = util.find_spec('waitress') is not None
+
+SERVERS = ['auto', 'gunicorn', 'waitress']
+
+
+def default_workers() -> int:
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def get_server(server: str = 'auto') -> str:
+    """
+    Returns the production server to use
+
+    :param server: auto, gunicorn or waitress. auto prefers gunicorn and falls back to waitress(ie on Windows)
+    :return: Name of the server
+    """
+    if server == 'auto':
+        if HAS_GUNICORN:
+            return 'gunicorn'
+        if HAS_WAITRESS:
+            return 'waitress'
+        raise click.ClickException("No production server is installed. Install gunicorn or waitress")
+    if server == 'gunicorn' and not HAS_GUNICORN:
+        raise click.ClickException("gunicorn is not installed or not supported on this platform")
+    if server == 'waitress' and not HAS_WAITRESS:
+        raise click.ClickException("waitress is not installed")
+    return server
+
+
+def run_gunicorn(app, host: str, port: int, workers: int, threads: int, worker_class: str, keep_alive: int,
+                 backlog: int, timeout: int):
+    """
+    Runs the application with gunicorn. The application is already loaded, and preload_app is set, so the forked
+    workers share its memory(copy on write) instead of each importing it again
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class StandaloneApplication(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    options = {
+        'bind': '{}:{}'.format(host, port),
+        'workers': workers,
+        'threads': threads,
+        'worker_class': worker_class,
+        'keepalive': keep_alive,
+        'backlog': backlog,
+        'timeout': timeout,
+        'preload_app': True,
+    }
+    StandaloneApplication(app, options).run()
+
+
+def run_waitress(app, host: str, port: int, threads: int, keep_alive: int, backlog: int):
+    """
+    Runs the application with waitress. waitress is a single process server so all requests are served by threads
+    """
+    from waitress import serve
+    serve(app, host=host, port=port, threads=threads, backlog=backlog, channel_timeout=max(keep_alive, 1))
+
 
 def add_cli(app):
     manage_cli = AppGroup('manage', help="Commands related to running application")
 
-    @manage_cli.command('run', help='Runs the application')
+    @manage_cli.command('run', help='Runs the application with the development server')
     @click.option('--host', default='127.0.0.1', help='What Host should the app run on')
     @click.option('--port', default=5000, help='What port should the server run on?')
     def run(host, port):
         app.run(host=host, port=port)
 
+    @manage_cli.command('serve', help='Runs the application with a production server(gunicorn or waitress)')
+    @click.option('--host', default='127.0.0.1', help='What Host should the app run on')
+    @click.option('--port', default=5000, help='What port should the server run on?')
+    @click.option('--server', default='auto', type=click.Choice(SERVERS),
+                  help='Server to use. auto uses gunicorn when installed, waitress otherwise')
+    @click.option('--workers', default=None, type=int,
+                  help='Number of worker processes(gunicorn only). Defaults to 2 * CPUs + 1')
+    @click.option('--threads', default=None, type=int,
+                  help='Number of threads per worker. Defaults to 1 for gunicorn and 4 for waitress')
+    @click.option('--worker-class', default='sync',
+                  help='gunicorn worker class. sync, gthread, gevent or eventlet. gevent and eventlet need the '
+                       'matching library installed')
+    @click.option('--keep-alive', default=5, help='Seconds to keep idle connections open')
+    @click.option('--backlog', default=2048, help='Maximum number of pending connections')
+    @click.option('--timeout', default=30, help='Seconds before a silent gunicorn worker is restarted')
+    def serve(host, port, server, workers, threads, worker_class, keep_alive, backlog, timeout):
+        server = get_server(server)
+        app.logger.info('Serving on {}:{} using {}'.format(host, port, server))
+        if server == 'gunicorn':
+            run_gunicorn(app, host, port, workers or default_workers(), threads or 1, worker_class, keep_alive,
+                         backlog, timeout)
+        else:
+            if workers:
+                app.logger.warning('waitress runs a single process. --workers is ignored')
+            run_waitress(app, host, port, threads or 4, keep_alive, backlog)
+
+    @manage_cli.command('build-manifest', help='Compiles the modules found by load_modules to bytecode and rebuilds the '
+                                               'manifests used by load_modules(lazy=True). Run it when building images '
+                                               'so the modules are not compiled or scanned at startup')
+    @click.option('--workers', default=0, help='Number of processes compiling the modules. Defaults to one per CPU')
+    def build_manifest_command(workers):
+        from rse_api.utils import MODULE_SCANS, build_manifest, prewarm_bytecode
+        if not MODULE_SCANS:
+            app.logger.warning('No load_modules call was found')
+        for scan in MODULE_SCANS:
+            prewarm_bytecode(scan['dir_path'], workers)
+            if scan['manifest_path']:
+                manifest = build_manifest(scan['package_path'], scan['dir_path'], scan['exclude'],
+                                          scan['manifest_path'], rebuild=True, cache_path=scan['cache_path'])
+                click.echo('Wrote {} modules to {}'.format(len(manifest['modules']), scan['manifest_path']))
+
+    @manage_cli.command('startup-profile', help='Shows the time spent by load_modules scanning directories and '
+                                                'importing each module, slowest first')
+    @click.option('--limit', default=20, help='Number of modules to show')
+    def startup_profile(limit):
+        from rse_api.utils import get_startup_profile
+        profile = get_startup_profile()
+        click.echo('Scan time(ms)')
+        for package, duration in profile['scans'].items():
+            click.echo('{:10.2f}  {}'.format(duration, package))
+        click.echo('Import time(ms), including the dependencies imported first by the module')
+        for name, duration in profile['imports'][:limit]:
+            click.echo('{:10.2f}  {}'.format(duration, name))
+        total = sum(duration for name, duration in profile['imports']) + sum(profile['scans'].values())
+        click.echo('Total(ms): {:.2f}'.format(total))
+
     app.cli.add_command(manage_cli)
@@ -1,18 +1,45 @@
 import sqlalchemy
-from typing import List, Union
+from typing import List, Optional, Union
 from flask import request, jsonify
 from flask.views import MethodView
+from sqlalchemy.orm.exc import NoResultFound
 
 from rse_db.utils import get_db
-from rse_api.query import get_pagination_from_request
-from rse_api.decorators import json_only
+from rse_api.query import get_pagination_from_request, get_cursor_from_request, keyset_paginate, \
+    get_count_mode_from_request, paginate_query, COUNT_MODES, get_fields_from_request, apply_sparse_fieldset, \
+    get_eager_load_options, get_filters_from_request, get_sort_from_request, apply_filters, apply_sort
+from rse_api.decorators import json_only, stream_schema_response
+from rse_api.cache import cached_call, invalidate_response_cache
 from rse_api.errors import RSEApiException
+from rse_api.etag import conditional_response, ETAG_ATTRIBUTES
+from rse_api.metrics import PhaseTimer
+from rse_api.serializers import get_sparse_schema, get_field_attributes, get_schema_instance
+
+# Dialects that can return the generated ids of a multi row INSERT
+RETURNING_DIALECTS = ['postgresql']
 
 
 class SimpleController(MethodView):
     def __init__(self, model, many_schema, single_schema=None,
                  exclude_on_post: List[str] = ['id'],
-                 order_by: Union[str, sqlalchemy.Column] = 'id'):
+                 order_by: Union[str, sqlalchemy.Column] = 'id',
+                 pagination: str = 'offset',
+                 count: str = 'exact',
+                 count_cache_ttl: Optional[float] = None,
+                 allow_stream: bool = False,
+                 stream_chunk_size: int = 1000,
+                 etag: bool = False,
+                 cache_timeout: Optional[float] = None,
+                 cache_namespace: Optional[str] = None,
+                 allow_bulk: bool = False,
+                 bulk_batch_size: int = 1000,
+                 bulk_return_ids: bool = False,
+                 orm_delete: bool = False,
+                 allow_sparse_fields: bool = False,
+                 eager_load: bool = True,
+                 eager_load_depth: int = 3,
+                 filter_fields: Optional[List[str]] = None,
+                 sort_fields: Optional[List[str]] = None):
         """
         Provides a controller to do basic crud operations
 
@@ -24,6 +51,53 @@ class SimpleController(MethodView):
         If not specified, the many schema will be used
         :param exclude_on_post: Fields to exclude on post
         :param order_by: Field to order list by default
+        :param pagination: Either 'offset' or 'cursor'. Offset pagination uses the page and per_page query parameters
+        and reports the totals. Cursor pagination seeks on the order_by column using the after/before query
+        parameters so deep pages cost the same as the first one. The order_by column should be unique and indexed
+        :param count: How the total of offset paginated listings is counted. exact runs a COUNT query on every request,
+        none skips the totals, estimate uses the database table statistics and cached keeps the count for
+        count_cache_ttl seconds. Clients can always request an exact count with the count=exact query parameter
+        :param count_cache_ttl: How long counts are cached when count is cached(or estimate on databases that don't
+        support estimates). Defaults to 60 seconds
+        :param allow_stream: Allow clients to export the whole listing using the stream query parameter. stream=json
+        sends a chunked JSON array and stream=ndjson sends newline delimited JSON. Rows are loaded and dumped
+        stream_chunk_size at a time so memory use stays flat
+        :param stream_chunk_size: Number of rows loaded at once when streaming
+        :param etag: Add ETags to GET responses and reply 304 Not Modified when the client already has the current
+        version. If the model has a version or updated_at column, the ETag is built from it so unchanged resources
+        are not dumped at all
+        :param cache_timeout: Cache GET responses for this many seconds. See rse_api.decorators.cached_response.
+        PUT, POST and DELETE invalidate the cached responses of the cache_namespace
+        :param cache_namespace: Namespace of the cached responses. Defaults to the table name of the model. When set,
+        writes also invalidate the namespace when cache_timeout is not, so resources decorated with cached_response
+        using the same namespace stay fresh
+        :param allow_bulk: Enable the bulk operations. POST with an array body creates many objects, PATCH on the
+        listing url with an array of partial objects(each with its id) updates many objects and DELETE on the listing
+        url with an array of ids(or {"ids": [...]}) deletes many objects. Each bulk operation runs in a single
+        transaction, using SqlAlchemy bulk operations in batches of bulk_batch_size, and returns the status of
+        every item. Bulk statements only write the columns of the model, so items setting relationships are rejected
+        with a 400 status. Register the controller with register_api(..., bulk=True) so the listing url accepts PATCH
+        and DELETE
+        :param bulk_batch_size: Number of rows per bulk statement
+        :param bulk_return_ids: Return the generated ids of the items created in bulk on databases without INSERT ..
+        RETURNING support, which inserts the rows one at a time. On PostgreSQL, each batch is a single INSERT
+        returning the ids, so they are always returned. Otherwise rows are inserted with executemany and the generated
+        ids are not returned
+        :param orm_delete: By default, DELETE issues a single DELETE statement without loading the object. Set this
+        when the model relies on ORM cascades or session events on delete, so the object is loaded and deleted
+        through the session instead
+        :param allow_sparse_fields: Allow clients to select the fields returned with the fields query parameter, ie
+        ?fields=id,name. Only the matching columns are loaded from the database and relationships that were not
+        requested are skipped
+        :param eager_load: Eager load the relationships dumped by Nested and List(Nested) fields of the schemas so
+        listings run one query per relationship instead of one per row. See rse_api.query.get_eager_load_options
+        :param eager_load_depth: How many levels of nested schemas are eager loaded
+        :param filter_fields: Model attributes listings can be filtered on using filter[field][operator]=value query
+        parameters, ie ?filter[name][like]=flu%. Defaults to the primary key and indexed columns of the model. See
+        rse_api.query.apply_filters
+        :param sort_fields: Model attributes listings can be sorted on using the sort query parameter, ie
+        ?sort=-created_at,name. Defaults to the primary key and indexed columns of the model. The order_by field is
+        always used as the last sort key. Sorting is not available with cursor pagination
         """
         super().__init__()
         # We assume that DB has been loaded before any controllers. Otherwise, some
@@ -34,56 +108,411 @@ class SimpleController(MethodView):
         self.single_schema = single_schema if single_schema else self.many_schema
         self.exclude_on_post = exclude_on_post
         self.order_by = order_by
+        if pagination not in ['offset', 'cursor']:
+            raise RSEApiException("Unsupported pagination {}".format(pagination))
+        self.pagination = pagination
+        if count not in COUNT_MODES:
+            raise RSEApiException("Unsupported count mode {}".format(count))
+        self.count = count
+        self.count_cache_ttl = count_cache_ttl
+        self.allow_stream = allow_stream
+        self.stream_chunk_size = stream_chunk_size
+        self.etag = etag
+        self.cache_timeout = cache_timeout
+        self.cache_namespace = cache_namespace if cache_namespace else model.__table__.name
+        # writes only need to invalidate if something could have cached responses of our namespace
+        self.invalidate_on_write = bool(cache_timeout or cache_namespace)
+        self.allow_bulk = allow_bulk
+        self.bulk_batch_size = bulk_batch_size
+        self.bulk_return_ids = bulk_return_ids
+        self.orm_delete = orm_delete
+        self.allow_sparse_fields = allow_sparse_fields
+        self.eager_load = eager_load
+        self.eager_load_depth = eager_load_depth
+        self.filter_fields = filter_fields
+        self.sort_fields = sort_fields
+
+    def invalidate_cache(self):
+        if self.invalidate_on_write:
+            invalidate_response_cache(self.cache_namespace)
+
+    def get_schema(self, schema_class):
+        """
+        Returns the schema instance used to dump the current request and the sparse fieldset requested, if any
+        """
+        fields = get_fields_from_request() if self.allow_sparse_fields else None
+        if fields:
+            return get_sparse_schema(schema_class, fields), fields
+        return get_schema_instance(schema_class), None
+
+    def get_query(self, schema, fields: Optional[List[str]] = None):
+        """
+        Returns the base query of the current request. The relationships dumped by the schema are eager loaded and,
+        when a sparse fieldset is requested, only the columns needed are loaded
+        """
+        query = self.model.query
+        if self.eager_load:
+            options = get_eager_load_options(self.model, schema, self.eager_load_depth)
+            if options:
+                query = query.options(*options)
+        if fields:
+            attributes = get_field_attributes(schema, fields)
+            if isinstance(self.order_by, str):
+                attributes.append(self.order_by)
+            if self.etag:
+                attributes.extend(ETAG_ATTRIBUTES)
+            query = apply_sparse_fieldset(query, self.model, attributes)
+        return query
+
+    def filter_query(self, query):
+        """
+        Applies the filters of the current request to a listing query
+
+        :return: Tuple of the query and whether it was filtered
+        """
+        filters = get_filters_from_request()
+        if filters:
+            query = apply_filters(query, self.model, filters, self.filter_fields)
+        return query, bool(filters)
+
+    def sort_query(self, query):
+        return apply_sort(query, self.model, get_sort_from_request(), self.sort_fields).order_by(self.order_by)
+
+    def dump_response(self, result, schema, many: bool = False, headers: Optional[dict] = None):
+        def build_response():
+            with PhaseTimer('schema_dump'):
+                data = schema.dump(result, many=many).data
+            with PhaseTimer('json_encode'):
+                resp = jsonify(data)
+            if headers:
+                resp.headers.extend(headers)
+            return resp
+        return conditional_response(result, build_response) if self.etag else build_response()
 
     def find_all(self):
-        result = self.model.query.order_by(self.order_by).paginate(**get_pagination_from_request())
-        resp = jsonify(self.many_schema().dump(result.items, many=True).data)
-        resp.headers['X-Total-Pages'] = result.pages
-        resp.headers['X-Current-Page'] = result.page
-        resp.headers['X-Per-Pages'] = result.per_page
-        resp.headers['X-Total'] = result.total
-        return resp
+        stream = request.args.get('stream', None)
+        if stream is not None:
+            return self.stream_all(stream)
+        if self.pagination == 'cursor':
+            return self.find_all_by_cursor()
+        schema, fields = self.get_schema(self.many_schema)
+        query, filtered = self.filter_query(self.get_query(schema, fields))
+        result = paginate_query(self.sort_query(query), **get_pagination_from_request(),
+                                count=get_count_mode_from_request(self.count),
+                                table_name=self.model.__table__.name, cache_ttl=self.count_cache_ttl,
+                                filtered=filtered)
+        headers = {'X-Current-Page': result.page, 'X-Per-Pages': result.per_page}
+        if result.total is not None:
+            headers['X-Total-Pages'] = result.pages
+            headers['X-Total'] = result.total
+        return self.dump_response(result.items, schema, many=True, headers=headers)
+
+    def stream_all(self, stream_format: str):
+        if not self.allow_stream:
+            raise RSEApiException("Streaming is not enabled for this resource")
+        if stream_format not in ['json', 'ndjson']:
+            raise RSEApiException("stream must be either json or ndjson")
+        schema, fields = self.get_schema(self.many_schema)
+        query, filtered = self.filter_query(self.get_query(schema, fields))
+        return stream_schema_response(schema, self.sort_query(query),
+                                      ndjson=stream_format == 'ndjson', chunk_size=self.stream_chunk_size)
+
+    def find_all_by_cursor(self):
+        if get_sort_from_request():
+            raise RSEApiException("sort is not supported with cursor pagination")
+        column = getattr(self.model, self.order_by) if isinstance(self.order_by, str) else self.order_by
+        schema, fields = self.get_schema(self.many_schema)
+        query, filtered = self.filter_query(self.get_query(schema, fields))
+        result = keyset_paginate(query, column, **get_cursor_from_request())
+        headers = {'X-Per-Pages': result.per_page}
+        if result.next_cursor:
+            headers['X-Next-Cursor'] = result.next_cursor
+        if result.prev_cursor:
+            headers['X-Prev-Cursor'] = result.prev_cursor
+        links = result.links()
+        if links:
+            headers['Link'] = links
+        return self.dump_response(result.items, schema, many=True, headers=headers)
+
+    def find_one(self, id, query=None):
+        query = self.model.query if query is None else query
+        return query.filter(self.model.id == id).one()
 
-    def find_one(self, id):
-        return self.model.query.filter(self.model.id == id).one()
+    def get_one(self, id):
+        schema, fields = self.get_schema(self.single_schema)
+        return self.dump_response(self.find_one(id, self.get_query(schema, fields)), schema)
 
     def get(self, id):
-        return self.find_all() if id is None else jsonify(
-            self.single_schema().dump(self.find_one(id), many=False).data)
+        def build_response():
+            return self.find_all() if id is None else self.get_one(id)
+        if self.cache_timeout:
+            return cached_call(build_response, self.cache_namespace, self.cache_timeout)
+        return build_response()
 
     @json_only
     def put(self, id):
         if id is None:
             raise RSEApiException("You must specify an id")
 
-        result = self.single_schema(strict=True).load(request.json,
-                                                      instance=self.find_one(id),
-                                                      session=self.db.session,
-                                                      partial=True)
+        instance = self.find_one(id)
+        with PhaseTimer('schema_load'):
+            schema = get_schema_instance(self.single_schema, strict=True)
+            result = schema.load(request.json, instance=instance, session=self.db.session, partial=True)
         session = self.db.object_session(result.data)
         session.add(result.data)
         session.commit()
-        return jsonify(self.single_schema().dump(result.data, many=False).data)
+        self.invalidate_cache()
+        return self.dump_response(result.data, get_schema_instance(self.single_schema))
+
+    @json_only
+    def patch(self, id=None):
+        if id is None:
+            return self.bulk_update(request.json)
+        return self.put(id)
 
     @json_only
     def post(self, id=None):
+        if isinstance(request.json, list):
+            return self.bulk_create(request.json)
         # check if we have a version
-        sch = self.single_schema(strict=True, exclude=self.exclude_on_post, session=self.db.session)
-        result = sch.load(request.json, session=self.db.session)
+        sch = get_schema_instance(self.single_schema, strict=True, exclude=self.exclude_on_post,
+                                  session=self.db.session)
+        with PhaseTimer('schema_load'):
+            result = sch.load(request.json, session=self.db.session)
         session = self.db.session
         session.add(result.data)
         session.commit()
-        return jsonify(self.single_schema().dump(result.data, many=False).data)
+        self.invalidate_cache()
+        return self.dump_response(result.data, get_schema_instance(self.single_schema))
 
     def delete(self, id):
         if id is None:
+            if self.allow_bulk and request.is_json:
+                ids = request.json.get('ids', None) if isinstance(request.json, dict) else request.json
+                return self.bulk_delete(ids)
             raise RSEApiException("You must specify an id")
-        result = self.single_schema(strict=True).load({}, instance=self.find_one(id),
-                                                      session=self.db.session,
-                                                      partial=True)
-        if result is None:
-            raise FileNotFoundError("Cannot Find item with id {}".format(id))
-        session = self.db.object_session(result.data)
-        session.delete(result.data)
+        if self.orm_delete:
+            instance = self.find_one(id)
+            session = self.db.object_session(instance)
+            session.delete(instance)
+        else:
+            session = self.db.session
+            rows = session.query(self.model).filter(self.model.id == id).delete(synchronize_session=False)
+            if rows == 0:
+                raise NoResultFound("Cannot find item with id {}".format(id))
         session.commit()
+        self.invalidate_cache()
         return '', 204
+
+    def check_bulk(self, items):
+        if not self.allow_bulk:
+            raise RSEApiException("Bulk operations are not enabled for this resource")
+        if not isinstance(items, list):
+            raise RSEApiException("Bulk operations expect an array")
+
+    def batches(self, items: List):
+        for i in range(0, len(items), self.bulk_batch_size):
+            yield items[i:i + self.bulk_batch_size]
+
+    def bulk_response(self, statuses: List[dict], success_status: int):
+        failures = sum(1 for status in statuses if status['status'] != success_status)
+        if failures == 0:
+            # 204 responses cannot have a body
+            code = 200 if success_status == 204 else success_status
+        elif failures == len(statuses):
+            code = 400
+        else:
+            code = 207
+        return jsonify(statuses), code
+
+    def convert_id(self, id):
+        """
+        Converts an id from a JSON body to the python type of the primary key so it can be compared with the ids
+        returned by the database
+
+        :raises ValueError: if the id cannot be converted
+        """
+        try:
+            python_type = self.model.id.property.columns[0].type.python_type
+        except NotImplementedError:
+            return id
+        if isinstance(id, (bool, dict, list)) or id is None:
+            raise ValueError("Invalid id {}".format(id))
+        return id if isinstance(id, python_type) else python_type(id)
+
+    def get_relationship_fields(self, schema) -> List[str]:
+        """
+        Returns the names, as sent by clients, of the schema fields that load relationships of the model
+        """
+        relationships = set(sqlalchemy.inspect(self.model).relationships.keys())
+        return [field.load_from or name for name, field in schema.fields.items()
+                if (field.attribute or name) in relationships and not field.dump_only]
+
+    @staticmethod
+    def check_relationships(item, relationship_fields: List[str]) -> dict:
+        # bulk statements only write the columns of the model so relationships would be silently dropped
+        if not isinstance(item, dict):
+            return {}
+        return {name: ['Relationships cannot be set by bulk operations.'] for name in relationship_fields
+                if name in item}
+
+    @staticmethod
+    def deserialize_columns(schema, item: dict, columns) -> dict:
+        """
+        Deserializes the fields of an item that map to columns of the model, without building an instance
+        """
+        mapping = {}
+        for name, field in schema.fields.items():
+            key = field.load_from or name
+            attribute = field.attribute or name
+            if attribute in columns and key in item and not field.dump_only:
+                mapping[attribute] = field.deserialize(item[key])
+        return mapping
+
+    def bulk_create(self, items: List[dict]):
+        self.check_bulk(items)
+        sch = get_schema_instance(self.single_schema, exclude=self.exclude_on_post, session=self.db.session)
+        relationship_fields = self.get_relationship_fields(sch)
+        statuses = [dict(index=index, status=201) for index in range(len(items))]
+        loadable = []
+        for index, item in enumerate(items):
+            errors = self.check_relationships(item, relationship_fields)
+            if errors:
+                statuses[index].update(status=400, errors=errors)
+            else:
+                loadable.append((index, item))
+
+        result = sch.load([item for _, item in loadable], many=True, session=self.db.session)
+        if result.errors:
+            # Load each item so the valid ones can still be created
+            results = [sch.load(item, session=self.db.session) for _, item in loadable]
+        else:
+            results = [(data, {}) for data in result.data]
+
+        objects = []
+        for (index, item), (data, errors) in zip(loadable, results):
+            if errors:
+                statuses[index].update(status=400, errors=errors)
+            else:
+                objects.append((index, data))
+
+        session = self.db.session
+        try:
+            for batch in self.batches(objects):
+                rows = [data if isinstance(data, dict) else self.get_column_values(data) for _, data in batch]
+                for (index, _), id in zip(batch, self.insert_rows(session, rows)):
+                    statuses[index]['id'] = id
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self.invalidate_cache()
+        return self.bulk_response(statuses, 201)
+
+    def get_column_values(self, instance) -> dict:
+        """
+        Returns the column attributes set on an instance loaded by a ModelSchema
+        """
+        state = sqlalchemy.inspect(instance)
+        return {attr.key: state.dict[attr.key] for attr in state.mapper.column_attrs if attr.key in state.dict}
+
+    def insert_rows(self, session, rows: List[dict]) -> List:
+        """
+        Inserts rows of column attributes and returns their ids. Generated ids are returned when the database
+        supports INSERT .. RETURNING or bulk_return_ids is set. Otherwise the ids of rows without one are None
+
+        :param session: SqlAlchemy session
+        :param rows: Column attributes of each row
+        :return: Ids of the rows
+        """
+        mapper = sqlalchemy.inspect(self.model)
+        if session.get_bind(mapper).dialect.name in RETURNING_DIALECTS:
+            table = mapper.local_table
+            columns = {attr.key: attr.columns[0].key for attr in mapper.column_attrs}
+            ids = [None] * len(rows)
+            # a multi row INSERT needs the same columns in every row
+            groups = {}
+            for index, row in enumerate(rows):
+                groups.setdefault(tuple(sorted(row)), []).append(index)
+            for indexes in groups.values():
+                values = [{columns[key]: value for key, value in rows[index].items()} for index in indexes]
+                result = session.execute(table.insert().values(values).returning(table.c[columns['id']]),
+                                         mapper=mapper)
+                for index, row in zip(indexes, result):
+                    ids[index] = row[0]
+            return ids
+        # return_defaults fetches the generated ids but inserts the rows one at a time
+        session.bulk_insert_mappings(self.model, rows, return_defaults=self.bulk_return_ids)
+        return [row.get('id', None) for row in rows]
+
+    def bulk_update(self, items: List[dict]):
+        self.check_bulk(items)
+        sch = get_schema_instance(self.single_schema, session=self.db.session)
+        columns = set(attr.key for attr in sqlalchemy.inspect(self.model).column_attrs)
+        relationship_fields = self.get_relationship_fields(sch)
+        statuses = []
+        mappings = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or item.get('id', None) is None:
+                statuses.append(dict(index=index, status=400, errors={'id': ['Missing data for required field.']}))
+                continue
+            try:
+                id = self.convert_id(item['id'])
+            except (TypeError, ValueError):
+                statuses.append(dict(index=index, id=item['id'], status=400, errors={'id': ['Not a valid id.']}))
+                continue
+            # Validate and deserialize without building an instance, which would load the object from the db
+            errors = self.check_relationships(item, relationship_fields) or \
+                sch.validate(item, session=self.db.session, partial=True)
+            if errors:
+                statuses.append(dict(index=index, id=id, status=400, errors=errors))
+                continue
+            mapping = self.deserialize_columns(sch, item, columns)
+            mapping['id'] = id
+            statuses.append(dict(index=index, id=id, status=200))
+            mappings.append((index, mapping))
+
+        session = self.db.session
+        try:
+            for batch in self.batches(mappings):
+                ids = [mapping['id'] for _, mapping in batch]
+                existing = set(row[0] for row in session.query(self.model.id).filter(self.model.id.in_(ids)))
+                found = []
+                for index, mapping in batch:
+                    if mapping['id'] in existing:
+                        found.append(mapping)
+                    else:
+                        statuses[index]['status'] = 404
+                session.bulk_update_mappings(self.model, found)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self.invalidate_cache()
+        return self.bulk_response(statuses, 200)
+
+    def bulk_delete(self, ids: List):
+        self.check_bulk(ids)
+        statuses = []
+        for index, id in enumerate(ids):
+            try:
+                statuses.append(dict(index=index, id=self.convert_id(id), status=204))
+            except (TypeError, ValueError):
+                statuses.append(dict(index=index, id=id, status=400, errors={'id': ['Not a valid id.']}))
+        session = self.db.session
+        try:
+            for batch in self.batches([status for status in statuses if status['status'] == 204]):
+                batch_ids = [status['id'] for status in batch]
+                existing = set(row[0] for row in session.query(self.model.id).filter(self.model.id.in_(batch_ids)))
+                for status in batch:
+                    if status['id'] not in existing:
+                        status['status'] = 404
+                if existing:
+                    session.query(self.model).filter(self.model.id.in_(list(existing))).delete(
+                        synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self.invalidate_cache()
+        return self.bulk_response(statuses, 204)
@@ -1,16 +1,23 @@
 import os
-import time
+import warnings
 from functools import wraps
 from importlib import util
-from logging import getLogger
-from typing import Callable
-from flask import jsonify, Response
+from itertools import islice
+from threading import RLock
+from typing import Callable, Iterable, Optional
+from flask import jsonify, Response, json, stream_with_context
 from flask.views import MethodView
 from marshmallow import Schema
 
 
+from .cache import cached_call
 from .errors import RSEApiException
+from .etag import conditional_response
+from .metrics import PhaseTimer
+from .profiling import profiled
+from .query import get_fields_from_request
 from .routing import register_api
+from .serializers import get_compiled_serializer, get_sparse_serializer
 
 HAS_APSCHEDULER = util.find_spec('apscheduler') is not None
 HAS_DRAMATIQ = util.find_spec('dramatiq') is not None
@@ -32,23 +39,66 @@ def json_only(func: Callable) -> Callable:
     return wrapper
 
 
-def singleton_function(func: Callable) -> Callable:
+_MISSING = object()
+
+
+def _make_singleton_key(args: tuple, kwargs: dict) -> tuple:
+    key = args
+    if kwargs:
+        key += (_MISSING,) + tuple(sorted(kwargs.items()))
+    return key
+
+
+def singleton_function(func: Callable = None, keyed: bool = False) -> Callable:
     """
     Allows a function to run once then cache its results for later calls
+
+    Concurrent first calls are serialized(double checked locking) so the function only runs once even when called
+    from many threads at the same time. The cache can be emptied with the cache_clear method of the wrapper, ie
+    get_application.cache_clear() between tests
+
+    By default the first result is returned whatever the arguments, so accessors like get_restful_api() can be
+    called without arguments once initialized. Calling it again with different arguments logs a warning. With
+    keyed=True, the function runs once per distinct set of arguments, which must be hashable
+
     :param func: Function to be cached
+    :param keyed: Cache one result per set of arguments
     :return: Wrapper function
     """
+    if func is None:
+        return lambda f: singleton_function(f, keyed=keyed)
+
+    lock = RLock()
+    cache = {}
+    first_call = []
 
     @wraps(func)
     def wrapper(*args, **kwargs):
-        if not hasattr(func, 'has_ran'):
-            setattr(func, 'cache_value', func(*args, **kwargs))
-            setattr(func, 'has_ran', True)
-        return getattr(func, 'cache_value')
+        key = _make_singleton_key(args, kwargs) if keyed else None
+        value = cache.get(key, _MISSING)
+        if value is _MISSING:
+            with lock:
+                value = cache.get(key, _MISSING)
+                if value is _MISSING:
+                    value = func(*args, **kwargs)
+                    cache[key] = value
+                    if not keyed:
+                        first_call[:] = [(args, kwargs)]
+        elif not keyed and (args or kwargs) and first_call and first_call[0] != (args, kwargs):
+            warnings.warn("{} was already called with different arguments. The first result is returned".format(
+                func.__name__), RuntimeWarning, stacklevel=2)
+        return value
+
+    def cache_clear():
+        with lock:
+            cache.clear()
+            first_call[:] = []
+
+    wrapper.cache_clear = cache_clear
     return wrapper
 
 
-def register_crud(endpoint, url=None) -> Callable:
+def register_crud(endpoint, url=None, bulk=False) -> Callable:
     if url is None:
         url = endpoint
 
@@ -60,7 +110,7 @@ def register_crud(endpoint, url=None) -> Callable:
         def wrapper(*args, **kwargs):
             return func(*args, **kwargs)
 
-        register_api(func, endpoint, url)
+        register_api(func, endpoint, url, bulk=bulk)
         return wrapper
     return decorator_register
 
@@ -213,10 +263,12 @@ def schema_in(schema: Schema, many: bool=False, instance_loader_func: Callable=N
         @json_only
         def wrapper_schema_in(*args, **kwargs):
             body = request.json
-            if callable(instance_loader_func):
-                result = schema.load(body, many=many, instance=instance_loader_func(*args, **kwargs), partial=partial)
-            else:
-                result = schema.load(body, many=many)
+            instance = instance_loader_func(*args, **kwargs) if callable(instance_loader_func) else None
+            with PhaseTimer('schema_load'):
+                if callable(instance_loader_func):
+                    result = schema.load(body, many=many, instance=instance, partial=partial)
+                else:
+                    result = schema.load(body, many=many)
             if hasattr(result, 'data'):
                 args = tuple(list(args) + [result.data]) if args is not None else (result.data,)
             else:
@@ -226,7 +278,48 @@ def schema_in(schema: Schema, many: bool=False, instance_loader_func: Callable=N
     return decorate_schema_in
 
 
-def schema_out(schema: Schema, detect_many=True, many=False, description=None, example=None) -> Callable:
+def stream_schema_response(schema: Schema, items: Iterable, ndjson: bool=False, chunk_size: int=1000) -> Response:
+    """
+    Returns a chunked Response that serializes items with schema as they are sent. Only chunk_size items are held in
+    memory at any point so memory stays flat regardless of the number of items and the first bytes are sent before the
+    last items are loaded
+
+    :param schema: Marshmallow schema instance to dump the items with
+    :param items: Iterable of items. This can be a list, a generator or a SqlAlchemy query. Queries are loaded
+    chunk_size rows at a time using yield_per
+    :param ndjson: Send newline delimited JSON(application/x-ndjson) instead of a JSON array
+    :param chunk_size: Number of items dumped together
+    :return: Streaming Response
+    """
+    if hasattr(items, 'yield_per'):
+        items = items.yield_per(chunk_size)
+    serializer = get_compiled_serializer(schema)
+
+    def generate():
+        iterator = iter(items)
+        first = True
+        if not ndjson:
+            yield '['
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                break
+            encoded = [json.dumps(item) for item in serializer.dump(chunk, many=True)]
+            if ndjson:
+                yield '\n'.join(encoded) + '\n'
+            else:
+                yield ('' if first else ',') + ','.join(encoded)
+            first = False
+        if not ndjson:
+            yield ']\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+
+def schema_out(schema: Schema, detect_many=True, many=False, description=None, example=None,
+               stream: bool=False, ndjson: bool=False, chunk_size: int=1000, etag: bool=False,
+               sparse_fields: bool=False) -> Callable:
     """
     Decorator that attempts to convert the output of the wrapped function with a Flask JSON Response using the
     supplied Marshmallow schema
@@ -234,6 +327,16 @@ def schema_out(schema: Schema, detect_many=True, many=False, description=None, e
     :param schema: Marshmallow schema to convert output of function to
     :param detect_many: Detect if output should be many(lists)
     :param many: Only needed if detect many is False. Mainly set the except many output
+    :param stream: Stream the output as a chunked JSON array. When enabled, the function should return a list,
+    generator or SqlAlchemy query. See stream_schema_response
+    :param ndjson: When streaming, send newline delimited JSON instead of a JSON array
+    :param chunk_size: When streaming, number of items loaded and dumped at once
+    :param etag: Add an ETag to the response and reply 304 Not Modified when it matches If-None-Match. When the
+    output has a version or updated_at attribute, the ETag is built from it and the dump is skipped on a match.
+    Otherwise the ETag is the hash of the payload. See rse_api.etag.conditional_response
+    :param sparse_fields: Allow clients to select the fields returned with the fields query parameter, ie
+    ?fields=id,name. To also restrict the columns loaded from the database, use rse_api.query.apply_sparse_fieldset
+    in the wrapped function
     :return: Wrapped function
     """
     def decorate_schema_out(func: Callable):
@@ -244,19 +347,75 @@ def schema_out(schema: Schema, detect_many=True, many=False, description=None, e
         #                        description=description)
         #swagger.add_schema_function(swagger_function)
 
+        # resolve the fields of the schema once instead of on every call
+        default_serializer = get_compiled_serializer(schema)
+
         @wraps(func)
         def wrapper_schema_out(*args, **kwargs):
             result = func(*args, **kwargs)
+            serializer = default_serializer
+            if sparse_fields:
+                fields = get_fields_from_request()
+                if fields:
+                    serializer = get_sparse_serializer(schema, fields)
+            if stream:
+                return stream_schema_response(serializer.schema, result, ndjson=ndjson, chunk_size=chunk_size)
             imany = (detect_many and type(result) is list) or many
-            result = schema.dump(result, many=imany)
-            if hasattr(result, 'data'):
-                return jsonify(result.data)
-            else:
-                return jsonify(result)
+
+            def build_response():
+                with PhaseTimer('schema_dump'):
+                    data = serializer.dump(result, many=imany)
+                with PhaseTimer('json_encode'):
+                    return jsonify(data)
+            if etag:
+                return conditional_response(result, build_response)
+            return build_response()
         return wrapper_schema_out
     return decorate_schema_out
 
 
+def cached_response(timeout: Optional[float]=60, namespace: Optional[str]=None, vary_headers: Iterable[str]=(),
+                    cache=None) -> Callable:
+    """
+    Decorator that caches the responses of GET requests. Responses are keyed by endpoint, path(so view args), query
+    string and the vary_headers. It should be placed above schema_out so the serialized response is what is cached
+
+    The cache backend is configured with the RESPONSE_CACHE_BACKEND setting. See rse_api.cache.get_response_cache
+
+    Examples:
+        .. code-block:: python
+
+            @register_resource(['/users', '/users/<int:id>'])
+            class UserController(Resource):
+
+                @cached_response(timeout=300, namespace='users', vary_headers=['Authorization'])
+                @schema_out(UserSchema())
+                def get(self, id=None):
+                    return UserModel.query.all() if id is None else UserModel.find_one(id)
+
+                @schema_in_out(UserSchema(), UserSchema())
+                def post(self, data):
+                    invalidate_response_cache('users')
+                    return data.commit()
+
+    :param timeout: Time to live of the cached responses in seconds
+    :param namespace: Namespace of the responses. rse_api.cache.invalidate_response_cache clears all the responses of a
+    namespace. Defaults to the endpoint
+    :param vary_headers: Request headers that change the response, for example Authorization
+    :param cache: Cache instance to use instead of the application response cache
+    :return: Wrapped function
+    """
+    def decorate_cached_response(func: Callable):
+        from flask import request
+
+        @wraps(func)
+        def wrapper_cached_response(*args, **kwargs):
+            return cached_call(lambda: func(*args, **kwargs), namespace or str(request.endpoint), timeout,
+                               vary_headers, cache)
+        return wrapper_cached_response
+    return decorate_cached_response
+
+
 def schema_in_out(schemaIn: Schema, schemaOut: Schema, schema_in_many=False, schema_out_many=False,
                   schema_out_detect_many: bool=True, schema_in_loader_func: Callable = None,
                   schema_in_partial: bool=False, description=None, in_example=None, out_example=None) -> Callable:
@@ -298,19 +457,14 @@ def schema_in_out(schemaIn: Schema, schemaOut: Schema, schema_in_many=False, sch
 def timeit_logged(func: Callable) -> Callable:
     """
     Times the execution of a function and log to the Timed log
+
+    The timings are only collected when profiling is enabled(see rse_api.profiling.register_profiling), for requests
+    sent with the X-Profile header outside of production or when the timing logger is at debug level. Otherwise the
+    function is called directly
     :param func: Function that should be timed
     :return: Wrapped function
     """
-    logger = getLogger('timing')
-
-    @wraps(func)
-    def timed(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        end = time.time()
-        logger.debug('%r  %2.2f ms' % (func.__name__, (end - start) * 1000))
-        return result
-    return timed
+    return profiled(func)
 
 
 def actor(*args, **kwargs) -> Callable:
@@ -334,6 +488,43 @@ def actor(*args, **kwargs) -> Callable:
         return dramatiq.actor(*args, **kwargs)(func)
     return decorate_wrap_actor
 
+
+def batch_actor(func: Callable = None, max_batch_size: int = 100, max_wait_ms: float = 50, **kwargs) -> Callable:
+    """
+    Declares an actor whose messages are processed in batches. Messages are sent with a single argument, the item, and
+    the function is called with the list of items of the batch. For example
+
+    @batch_actor(max_batch_size=32, max_wait_ms=20)
+    def ingest(rows):
+        db.session.bulk_insert_mappings(Row, rows)
+        db.session.commit()
+
+    ingest.send({'name': 'a'})
+
+    The function returns None or a list with one result per item. Messages are acked or nacked, and retried, one by one.
+    A batch holds the messages being processed at the same time by the worker threads, so its size is limited by the
+    number of worker threads(see dramatiq --threads), and it runs as soon as no other thread is about to add a message.
+    See rse_api.tasks.batching.MessageBatcher
+
+    :param func: Function called with the list of items
+    :param max_batch_size: Maximum number of items in a batch
+    :param max_wait_ms: Maximum time to wait for the messages being processed by other threads in milliseconds
+    :param kwargs: Options of the dramatiq actor, ie queue_name or max_retries
+    :return: Actor
+    """
+    if func is None:
+        return lambda f: batch_actor(f, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, **kwargs)
+    import dramatiq
+    from rse_api.tasks.batching import MessageBatcher, get_batching_middleware
+    batcher = MessageBatcher(func, max_batch_size, max_wait_ms)
+    get_batching_middleware(kwargs.get('broker', None) or dramatiq.get_broker())
+
+    @wraps(func)
+    def process_item(item):
+        return batcher.submit(item)
+    process_item.batcher = batcher
+    return actor(batcher=batcher, **kwargs)(process_item)
+
 if HAS_APSCHEDULER and HAS_DRAMATIQ:
     import dramatiq
     from apscheduler.triggers.cron import CronTrigger
@@ -0,0 +1,74 @@
+import hashlib
+from collections.abc import Mapping
+from typing import Callable, List, Optional
+from flask import request, Response
+
+# Attributes checked, in order, to build an ETag without dumping the model
+ETAG_ATTRIBUTES = ['version', 'updated_at']
+
+
+def get_model_etag(result, attributes: List[str] = None) -> Optional[str]:
+    """
+    Builds an ETag for a model or list of models from their version or updated at columns
+
+    The ETag is a hash of the type, id and version of each object so it changes whenever any object is updated, added
+    or removed. If any object does not have one of the attributes, None is returned and the ETag has to be computed
+    from the dumped payload instead
+
+    :param result: Model or list of models
+    :param attributes: Attributes that change every time the object is updated. Defaults to ETAG_ATTRIBUTES
+    :return: ETag or None
+    """
+    attributes = ETAG_ATTRIBUTES if attributes is None else attributes
+    objects = result if isinstance(result, list) else [result]
+    parts = []
+    for obj in objects:
+        if obj is None or isinstance(obj, Mapping):
+            return None
+        version = None
+        for attribute in attributes:
+            version = getattr(obj, attribute, None)
+            if version is not None:
+                break
+        if version is None:
+            return None
+        parts.append('{}:{}:{}'.format(type(obj).__name__, getattr(obj, 'id', ''), version))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def not_modified_response(etag: str, weak: bool = True) -> Response:
+    """
+    Returns an empty 304 Not Modified response
+
+    :param etag: ETag of the resource
+    :param weak: Is the ETag weak?
+    :return: Response
+    """
+    response = Response(status=304)
+    response.set_etag(etag, weak=weak)
+    return response
+
+
+def conditional_response(result, build_response: Callable[[], Response],
+                         attributes: List[str] = None) -> Response:
+    """
+    Returns a response that honors If-None-Match
+
+    When the ETag can be built from the model(see get_model_etag) and the client already has it, a 304 is returned
+    without calling build_response, so the dump and encoding are skipped entirely. Otherwise the response is built and
+    its ETag is the hash of the payload
+
+    :param result: Model or list of models the response is built from
+    :param build_response: Function that builds the full response
+    :param attributes: Version attributes passed to get_model_etag
+    :return: Response
+    """
+    etag = get_model_etag(result, attributes)
+    if etag is not None and request.method in ['GET', 'HEAD'] and request.if_none_match.contains_weak(etag):
+        return not_modified_response(etag)
+    response = build_response()
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    else:
+        response.add_etag()
+    return response.make_conditional(request)
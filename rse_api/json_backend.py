@@ -0,0 +1,155 @@
+import decimal
+import re
+from importlib import util
+from typing import Callable, Optional, Tuple
+from flask.json import JSONEncoder, JSONDecoder
+
+HAS_ORJSON = util.find_spec('orjson') is not None
+HAS_RAPIDJSON = util.find_spec('rapidjson') is not None
+HAS_UJSON = util.find_spec('ujson') is not None
+
+_NON_ASCII_RE = re.compile(b'[\x80-\xff]')
+
+# Order in which backends are tried when the backend is auto
+BACKEND_PREFERENCE = ['orjson', 'rapidjson', 'ujson', 'json']
+
+
+def _orjson_functions() -> Tuple[Callable, Callable]:
+    import orjson
+
+    def dumps(obj, default, sort_keys, indent, ensure_ascii):
+        # dates are passed through to default so they are formatted the same way as flask does
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        result = orjson.dumps(obj, default=default, option=option)
+        if ensure_ascii and _NON_ASCII_RE.search(result):
+            # orjson always writes UTF-8, the encoder falls back to the standard library to escape the characters
+            raise ValueError("orjson cannot escape non ASCII characters")
+        return result.decode('utf-8')
+    return dumps, orjson.loads
+
+
+def _rapidjson_functions() -> Tuple[Callable, Callable]:
+    import rapidjson
+
+    def dumps(obj, default, sort_keys, indent, ensure_ascii):
+        return rapidjson.dumps(obj, default=default, sort_keys=sort_keys, indent=indent, ensure_ascii=ensure_ascii)
+    return dumps, rapidjson.loads
+
+
+def _ujson_functions() -> Tuple[Callable, Callable]:
+    import ujson
+    # default is only supported by ujson 5+
+    ujson.dumps(None, default=str)
+
+    def dumps(obj, default, sort_keys, indent, ensure_ascii):
+        return ujson.dumps(obj, default=default, sort_keys=sort_keys, indent=indent or 0, ensure_ascii=ensure_ascii,
+                           escape_forward_slashes=False)
+    return dumps, ujson.loads
+
+
+_BACKENDS = {
+    'orjson': (HAS_ORJSON, _orjson_functions),
+    'rapidjson': (HAS_RAPIDJSON, _rapidjson_functions),
+    'ujson': (HAS_UJSON, _ujson_functions),
+}
+
+
+def get_json_backend(backend: str = 'auto') -> Tuple[str, Optional[Callable], Optional[Callable]]:
+    """
+    Returns the name, dumps and loads functions of a JSON backend
+
+    :param backend: One of auto, orjson, rapidjson, ujson or json. auto picks the fastest installed backend. json is
+    the standard library json module, in which case the dumps and loads functions returned are None
+    :return: Tuple of backend name, dumps function and loads function
+    """
+    if backend not in BACKEND_PREFERENCE + ['auto']:
+        raise ValueError("Unsupported JSON backend {}".format(backend))
+    candidates = BACKEND_PREFERENCE if backend == 'auto' else [backend]
+    for name in candidates:
+        if name == 'json':
+            break
+        installed, functions = _BACKENDS[name]
+        if not installed:
+            if backend != 'auto':
+                raise ValueError("JSON backend {} is not installed".format(name))
+            continue
+        try:
+            dumps, loads = functions()
+        except TypeError:
+            # backend is installed but too old
+            if backend != 'auto':
+                raise
+            continue
+        return name, dumps, loads
+    return 'json', None, None
+
+
+def make_json_encoder(dumps: Callable, base=JSONEncoder):
+    """
+    Returns a Flask JSON Encoder class that encodes using dumps
+
+    Types the backend does not support natively are converted by the encoder's default method, which adds Decimal
+    support on top of flask's(dates, UUID, etc). If the backend still fails(for example on integers bigger than 64
+    bits, or on non ASCII characters with orjson when ensure_ascii is set, ie flask's JSON_AS_ASCII default), the
+    standard library encoder is used
+
+    :param dumps: Dumps function returned by get_json_backend
+    :param base: Encoder class to extend
+    :return: JSONEncoder class
+    """
+    class RSEJSONEncoder(base):
+        def default(self, o):
+            if isinstance(o, decimal.Decimal):
+                return float(o)
+            return super().default(o)
+
+        def encode(self, o):
+            try:
+                return dumps(o, self.default, self.sort_keys, self.indent, self.ensure_ascii)
+            except (TypeError, ValueError, OverflowError):
+                return super().encode(o)
+    return RSEJSONEncoder
+
+
+def make_json_decoder(loads: Callable, base=JSONDecoder):
+    """
+    Returns a Flask JSON Decoder class that decodes using loads. This is also used for request.json
+
+    When loads fails, the standard library decoder is used so the errors(and the handling of NaN and Infinity) are the
+    same as before
+
+    :param loads: Loads function returned by get_json_backend
+    :param base: Decoder class to extend
+    :return: JSONDecoder class
+    """
+    class RSEJSONDecoder(base):
+        def decode(self, s, *args, **kwargs):
+            if self.object_hook is None and self.object_pairs_hook is None:
+                try:
+                    return loads(s)
+                except ValueError:
+                    pass
+            return super().decode(s, *args, **kwargs)
+    return RSEJSONDecoder
+
+
+def register_json_backend(app, backend: str = 'auto') -> str:
+    """
+    Configures the application to encode responses(including jsonify) and decode requests with a fast JSON backend
+    when one is installed. Flask's JSON_AS_ASCII setting is honoured. orjson cannot escape non ASCII characters, so
+    set JSON_AS_ASCII = False for it to encode those responses too
+
+    :param app: Flask application
+    :param backend: Backend to use. See get_json_backend
+    :return: Name of the backend in use
+    """
+    name, dumps, loads = get_json_backend(backend)
+    if name != 'json':
+        app.json_encoder = make_json_encoder(dumps, base=app.json_encoder)
+        app.json_decoder = make_json_decoder(loads, base=app.json_decoder)
+    app.logger.debug('Using {} JSON backend'.format(name))
+    return name
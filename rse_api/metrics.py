@@ -0,0 +1,218 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import Dict, Optional, Tuple
+from flask import g, has_request_context, request, Response
+
+try:
+    from time import perf_counter_ns
+except ImportError:
+    # python 3.6
+    from time import perf_counter
+
+    def perf_counter_ns() -> int:
+        return int(perf_counter() * 1e9)
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the request and response size histogram buckets in bytes
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        """
+        Prometheus style histogram. Not thread safe on its own, MetricsRegistry serializes the updates
+
+        :param buckets: Sorted upper bounds of the buckets. The +Inf bucket is added automatically
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PhaseTimer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        """
+        Context manager that adds the time spent in its block to a phase of the current request. See add_phase_time
+
+        :param name: Name of the phase, ie schema_load, schema_dump or json_encode
+        """
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        add_phase_time(self.name, perf_counter_ns() - self.start)
+        return False
+
+
+def add_phase_time(name: str, duration_ns: int):
+    """
+    Adds time to a phase of the current request. Does nothing when metrics are not enabled or outside of a request
+
+    :param name: Name of the phase
+    :param duration_ns: Duration in nanoseconds
+    """
+    if has_request_context():
+        phases = g.get('rse_metrics_phases', None)
+        if phases is not None:
+            phases[name] = phases.get(name, 0) + duration_ns
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    parts = ['{}="{}"'.format(name, _escape(str(value))) for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        Collects the request metrics of the process. With multiple worker processes(ie gunicorn), every worker
+        reports its own metrics, so they should be scraped or aggregated per worker
+        """
+        self.lock = Lock()
+        self.durations: Dict[Tuple[str, str], Histogram] = {}
+        self.statuses: Dict[Tuple[str, str, int], int] = {}
+        self.request_sizes: Dict[Tuple[str], Histogram] = {}
+        self.response_sizes: Dict[Tuple[str], Histogram] = {}
+        self.phases: Dict[Tuple[str, str], Histogram] = {}
+
+    @staticmethod
+    def _histogram(metrics: dict, key: tuple, buckets: Tuple[float, ...]) -> Histogram:
+        histogram = metrics.get(key, None)
+        if histogram is None:
+            histogram = metrics[key] = Histogram(buckets)
+        return histogram
+
+    def observe_request(self, endpoint: str, method: str, status: int, duration: float,
+                        request_size: Optional[int] = None, response_size: Optional[int] = None,
+                        phases: Optional[Dict[str, float]] = None):
+        """
+        Records a request
+
+        :param endpoint: Flask endpoint of the request
+        :param method: HTTP method
+        :param status: Status code of the response
+        :param duration: Duration in seconds
+        :param request_size: Size of the request body in bytes
+        :param response_size: Size of the response body in bytes. None for streamed responses
+        :param phases: Time spent in each phase in seconds
+        """
+        with self.lock:
+            self._histogram(self.durations, (endpoint, method), LATENCY_BUCKETS).observe(duration)
+            key = (endpoint, method, status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+            if request_size is not None:
+                self._histogram(self.request_sizes, (endpoint,), SIZE_BUCKETS).observe(request_size)
+            if response_size is not None:
+                self._histogram(self.response_sizes, (endpoint,), SIZE_BUCKETS).observe(response_size)
+            for phase, value in (phases or {}).items():
+                self._histogram(self.phases, (endpoint, phase), LATENCY_BUCKETS).observe(value)
+
+    def _render_histograms(self, lines: list, name: str, help_text: str, label_names: Tuple[str, ...],
+                           histograms: dict):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} histogram'.format(name))
+        for key, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(label_names, key, 'le="{}"'.format(_format_bound(bound))), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, _labels(label_names, key, 'le="+Inf"'), histogram.count))
+            lines.append('{}_sum{} {}'.format(name, _labels(label_names, key), repr(histogram.sum)))
+            lines.append('{}_count{} {}'.format(name, _labels(label_names, key), histogram.count))
+
+    def render(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            self._render_histograms(lines, 'rse_api_request_duration_seconds', 'Request latency in seconds',
+                                    ('endpoint', 'method'), self.durations)
+            lines.append('# HELP rse_api_requests_total Requests by status code')
+            lines.append('# TYPE rse_api_requests_total counter')
+            for key, count in sorted(self.statuses.items()):
+                lines.append('rse_api_requests_total{} {}'.format(
+                    _labels(('endpoint', 'method', 'status'), key), count))
+            self._render_histograms(lines, 'rse_api_request_size_bytes', 'Request body size in bytes',
+                                    ('endpoint',), self.request_sizes)
+            self._render_histograms(lines, 'rse_api_response_size_bytes', 'Response body size in bytes',
+                                    ('endpoint',), self.response_sizes)
+            self._render_histograms(lines, 'rse_api_request_phase_seconds',
+                                    'Time spent in schema_load, handler, schema_dump and json_encode in seconds',
+                                    ('endpoint', 'phase'), self.phases)
+        return '\n'.join(lines) + '\n'
+
+
+def get_metrics_registry(app) -> Optional[MetricsRegistry]:
+    """
+    Returns the metrics registry of an application, None if metrics are not enabled
+    """
+    return app.extensions.get('rse_metrics', None)
+
+
+def register_metrics(app, endpoint: Optional[str] = '/metrics') -> MetricsRegistry:
+    """
+    Records the latency, status code, request and response sizes of every request and the time split between
+    schema_load, handler, schema_dump and json_encode. The phases are measured by schema_in, schema_out and
+    SimpleController. The handler time is what remains of the request once the other phases are removed
+
+    :param app: Flask application
+    :param endpoint: Url of the Prometheus metrics endpoint. None to not expose one
+    :return: MetricsRegistry
+    """
+    registry = get_metrics_registry(app)
+    if registry is not None:
+        return registry
+    registry = MetricsRegistry()
+    app.extensions['rse_metrics'] = registry
+
+    @app.before_request
+    def start_request_timer():
+        g.rse_metrics_start = perf_counter_ns()
+        g.rse_metrics_phases = {}
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.get('rse_metrics_start', None)
+        if start is None:
+            return response
+        duration = perf_counter_ns() - start
+        phases = g.get('rse_metrics_phases', None) or {}
+        handler = duration - sum(phases.values())
+        seconds = {phase: value / 1e9 for phase, value in phases.items()}
+        seconds['handler'] = max(handler, 0) / 1e9
+        response_size = None if response.is_streamed else response.calculate_content_length()
+        registry.observe_request(request.endpoint or 'unmatched', request.method, response.status_code, duration / 1e9,
+                                 request.content_length or 0, response_size, seconds)
+        return response
+
+    if endpoint:
+        def metrics():
+            return Response(registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+        app.add_url_rule(endpoint, 'rse_api_metrics', metrics, methods=['GET'])
+    return registry
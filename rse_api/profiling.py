@@ -0,0 +1,257 @@
+import cProfile
+import io
+import itertools
+import pstats
+import re
+import threading
+from collections import deque
+from functools import wraps
+from logging import getLogger, DEBUG
+from typing import Callable, Dict, Optional
+from flask import g, has_request_context, jsonify, request
+
+from rse_api.metrics import perf_counter_ns
+
+PROFILE_HEADER = 'X-Profile'
+
+
+class FunctionStats:
+    def __init__(self, max_samples: int = 1000):
+        """
+        Timing statistics of a function. Count, total, min and max cover every call while the percentiles are
+        computed over the last max_samples calls
+
+        :param max_samples: Number of recent durations kept for the percentiles
+        """
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.samples = deque(maxlen=max_samples)
+
+    def add(self, duration_ms: float):
+        self.count += 1
+        self.total += duration_ms
+        self.min = duration_ms if self.min is None else min(self.min, duration_ms)
+        self.max = duration_ms if self.max is None else max(self.max, duration_ms)
+        self.samples.append(duration_ms)
+
+    def summary(self) -> dict:
+        samples = sorted(self.samples)
+
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(round(p * (len(samples) - 1))))] if samples else None
+        return dict(count=self.count, total_ms=self.total, min_ms=self.min, p50_ms=percentile(0.5),
+                    p99_ms=percentile(0.99), max_ms=self.max)
+
+
+class Profiler:
+    def __init__(self):
+        """
+        Collects the timings of functions decorated with profiled(or timeit_logged)
+
+        While disabled, decorated functions are called directly after a few attribute checks. Once enabled, every
+        call is timed and 1 in sample_rate calls also runs under cProfile. The cProfile statistics are merged per
+        function
+        """
+        self.enabled = False
+        self.sample_rate = 0
+        self.max_samples = 1000
+        # number of requests profiled through the profile header
+        self.active_requests = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._calls = itertools.count()
+        self._stats: Dict[str, FunctionStats] = {}
+        self._profiles: Dict[str, pstats.Stats] = {}
+
+    def configure(self, enabled: bool = False, sample_rate: int = 0, max_samples: int = 1000):
+        """
+        :param enabled: Time every call of the profiled functions
+        :param sample_rate: Also run 1 in sample_rate calls under cProfile. 0 disables cProfile
+        :param max_samples: Number of recent durations kept per function for the percentiles
+        """
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+
+    def record(self, name: str, duration_ns: int):
+        duration_ms = duration_ns / 1e6
+        with self._lock:
+            stats = self._stats.get(name, None)
+            if stats is None:
+                stats = self._stats[name] = FunctionStats(self.max_samples)
+            stats.add(duration_ms)
+        if has_request_context():
+            timings = g.get('rse_profile_timings', None)
+            if timings is not None:
+                timings[name] = timings.get(name, 0) + duration_ms
+
+    def add_profile(self, name: str, profile: cProfile.Profile):
+        with self._lock:
+            stats = self._profiles.get(name, None)
+            if stats is None:
+                self._profiles[name] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+
+    def _is_profiling(self) -> bool:
+        return getattr(self._local, 'profiling', False)
+
+    def _should_sample(self) -> bool:
+        # only one cProfile can be active per thread, so nested calls and profiled requests are not sampled
+        if not self.sample_rate or self._is_profiling():
+            return False
+        if has_request_context() and g.get('rse_profile', None) is not None:
+            return False
+        return next(self._calls) % self.sample_rate == 0
+
+    def call(self, name: str, func: Callable, args, kwargs, logger):
+        if not self.enabled and not logger.isEnabledFor(DEBUG):
+            # only the requests that asked for it are profiled
+            if not has_request_context() or g.get('rse_profile', None) is None:
+                return func(*args, **kwargs)
+
+        profile = None
+        if self.enabled and self._should_sample():
+            profile = cProfile.Profile()
+            self._local.profiling = True
+            profile.enable()
+        start = perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = perf_counter_ns() - start
+            if profile is not None:
+                profile.disable()
+                self._local.profiling = False
+                self.add_profile(name, profile)
+            self.record(name, duration)
+            logger.debug('%r  %2.2f ms', name, duration / 1e6)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Returns the count, total, min, p50, p99 and max duration in milliseconds of each function
+        """
+        with self._lock:
+            return {name: stats.summary() for name, stats in self._stats.items()}
+
+    def profile_text(self, name: str, limit: int = 30) -> Optional[str]:
+        """
+        Returns the cProfile statistics of a function(or request) sorted by cumulative time
+
+        :param name: Name of the function
+        :param limit: Number of lines
+        :return: Statistics or None if the function was not sampled
+        """
+        with self._lock:
+            stats = self._profiles.get(name, None)
+            if stats is None:
+                return None
+            stream = io.StringIO()
+            stats.stream = stream
+            stats.sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    def profile_names(self):
+        with self._lock:
+            return list(self._profiles.keys())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._profiles.clear()
+
+
+PROFILER = Profiler()
+
+
+def profiled(func: Callable = None, name: Optional[str] = None, profiler: Profiler = None) -> Callable:
+    """
+    Decorator that records the timings of a function in the profiler. Calls are also logged to the timing logger
+    at debug level
+
+    :param func: Function to profile
+    :param name: Name of the function in the statistics. Defaults to module.qualname
+    :param profiler: Profiler to use. Defaults to PROFILER
+    :return: Wrapped function
+    """
+    if func is None:
+        return lambda f: profiled(f, name=name, profiler=profiler)
+    profiler = PROFILER if profiler is None else profiler
+    name = name or '{}.{}'.format(func.__module__, func.__qualname__)
+    logger = getLogger('timing')
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not profiler.enabled and not profiler.active_requests and not logger.isEnabledFor(DEBUG):
+            return func(*args, **kwargs)
+        return profiler.call(name, func, args, kwargs, logger)
+    return wrapper
+
+
+def register_profiling(app, profiler: Profiler = None):
+    """
+    Configures the profiler from the application settings:
+
+    PROFILING_ENABLED: Time every call of the profiled functions. Defaults to False
+    PROFILING_SAMPLE_RATE: Run 1 in N calls under cProfile. Defaults to 0(never)
+    PROFILING_MAX_SAMPLES: Number of recent durations kept per function. Defaults to 1000
+
+    PROFILING_ENDPOINT: Url serving the statistics as JSON. DELETE on the endpoint resets them. The endpoint is not
+    authenticated, so in production it is only served when set explicitly. Defaults to /_profiling outside of
+    production, None to not expose one
+
+    Outside of production, requests with the X-Profile header are profiled as a whole with cProfile and their
+    response has a Server-Timing header with the time of each profiled function
+
+    :param app: Flask application
+    :param profiler: Profiler to configure. Defaults to PROFILER
+    """
+    profiler = PROFILER if profiler is None else profiler
+    profiler.configure(enabled=app.config.get('PROFILING_ENABLED', False),
+                       sample_rate=app.config.get('PROFILING_SAMPLE_RATE', 0),
+                       max_samples=app.config.get('PROFILING_MAX_SAMPLES', 1000))
+    app.extensions['rse_profiler'] = profiler
+
+    endpoint = app.config.get('PROFILING_ENDPOINT', None if app.env == 'production' else '/_profiling')
+    if endpoint:
+        def profiling_stats():
+            if request.method == 'DELETE':
+                profiler.reset()
+                return '', 204
+            return jsonify(functions=profiler.stats(),
+                           profiles={name: profiler.profile_text(name) for name in profiler.profile_names()})
+        app.add_url_rule(endpoint, 'rse_api_profiling', profiling_stats, methods=['GET', 'DELETE'])
+
+    if app.env == 'production':
+        return profiler
+
+    @app.before_request
+    def start_request_profile():
+        if request.headers.get(PROFILE_HEADER, None) and not profiler._is_profiling():
+            with profiler._lock:
+                profiler.active_requests += 1
+            g.rse_profile_timings = {}
+            g.rse_profile = cProfile.Profile()
+            g.rse_profile.enable()
+
+    @app.after_request
+    def add_server_timing(response):
+        timings = g.get('rse_profile_timings', None)
+        if timings:
+            response.headers['Server-Timing'] = ', '.join(
+                '{};dur={:.2f}'.format(re.sub(r'[^\w.-]', '_', name), duration) for name, duration in timings.items())
+        return response
+
+    @app.teardown_request
+    def stop_request_profile(exc):
+        profile = g.get('rse_profile', None)
+        if profile is not None:
+            profile.disable()
+            g.rse_profile = None
+            with profiler._lock:
+                profiler.active_requests -= 1
+            profiler.add_profile('request {} {}'.format(request.method, request.endpoint), profile)
+
+    return profiler
@@ -1,4 +1,44 @@
-from flask import request
+import base64
+import datetime
+import decimal
+import json
+import math
+import re
+from importlib import util
+from typing import Any, List, Optional, Tuple
+from urllib.parse import urlencode
+from flask import request, abort, g, has_request_context
+
+from rse_api.cache import MemoryCache
+from rse_api.errors import RSEApiException
+
+COUNT_MODES = ['exact', 'none', 'estimate', 'cached']
+# Count modes clients are allowed to request through the count query parameter
+REQUESTABLE_COUNT_MODES = ['exact', 'none']
+COUNT_CACHE = MemoryCache(max_size=1024, default_ttl=60)
+# Eager load options per model and schema. Schemas don't change at runtime so the entries never expire
+EAGER_LOAD_CACHE = MemoryCache(max_size=1024)
+QUERY_COUNT_WARN_THRESHOLD = 20
+
+FILTER_OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'lt': lambda column, value: column < value,
+    'le': lambda column, value: column <= value,
+    'gt': lambda column, value: column > value,
+    'ge': lambda column, value: column >= value,
+    'in': lambda column, value: column.in_(value),
+    'like': lambda column, value: column.like(value),
+    'ilike': lambda column, value: column.ilike(value),
+    'is_null': lambda column, value: column.is_(None) if value else column.isnot(None),
+}
+# Maximum number of values of an in filter
+MAX_IN_VALUES = 1000
+FILTER_PARAM_RE = re.compile(r'^filter\[(\w+)\](?:\[(\w+)\])?$')
+# ISO 8601 dates and times accepted by filters on datetime columns
+ISO_DATETIME_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})(?:[T ](\d{2}:\d{2}(?::\d{2}(?:\.\d{1,6})?)?))?(Z|[+-]\d{2}:?\d{2})?$')
+
+HAS_MARSHMALLOW_SQLALCHEMY = util.find_spec('marshmallow_sqlalchemy') is not None
 
 
 def get_pagination_from_request(page_default: int =1, per_page_default: int =100) -> dict:
@@ -20,3 +60,582 @@ def get_pagination_from_request(page_default: int =1, per_page_default: int =100
         if isinstance(options[k], str):
             options[k] = int(options[k])
     return options
+
+
+def get_fields_from_request(param: str = 'fields') -> Optional[List[str]]:
+    """
+    Returns the sparse fieldset requested using the `fields` query parameter, ie ?fields=id,name,owner.name
+
+    :param param: Name of the query parameter
+    :return: List of fields or None if all fields should be returned
+    """
+    value = request.args.get(param, None)
+    if not value:
+        return None
+    fields = []
+    for field in value.split(','):
+        field = field.strip()
+        if field and field not in fields:
+            fields.append(field)
+    return fields if fields else None
+
+
+def apply_sparse_fieldset(query, model, attributes: List[str]):
+    """
+    Restricts the columns loaded by a query to the requested attributes using load_only. The primary key is always
+    loaded, as are the foreign keys of the requested relationships. Relationships that were not requested are not
+    loaded
+
+    :param query: SqlAlchemy query
+    :param model: Model being queried
+    :param attributes: Model attributes that should be loaded
+    :return: Query
+    """
+    from sqlalchemy import inspect
+    from sqlalchemy.orm import load_only
+    mapper = inspect(model)
+    requested = set(attributes)
+    columns = set(mapper.get_property_by_column(column).key for column in mapper.primary_key)
+    for relationship in mapper.relationships:
+        if relationship.key in requested:
+            columns.update(mapper.get_property_by_column(column).key for column in relationship.local_columns)
+    columns.update(attr.key for attr in mapper.column_attrs if attr.key in requested)
+    return query.options(load_only(*columns))
+
+
+def get_filters_from_request() -> List[Tuple[str, str, str]]:
+    """
+    Returns the filters of the request. Filters use the filter[field][operator]=value query parameters, ie
+    ?filter[name][like]=flu%&filter[age][ge]=18. When the operator is omitted, eq is used. See FILTER_OPERATORS for
+    the list of operators
+
+    :return: List of (field, operator, value) tuples. Values are not converted yet
+    """
+    filters = []
+    for param, value in request.args.items(multi=True):
+        if not param.startswith('filter['):
+            continue
+        match = FILTER_PARAM_RE.match(param)
+        if match is None:
+            raise RSEApiException("Invalid filter {}".format(param))
+        field, operator = match.group(1), match.group(2) or 'eq'
+        if operator not in FILTER_OPERATORS:
+            raise RSEApiException("Unsupported filter operator {}. Supported operators are {}".format(
+                operator, ', '.join(FILTER_OPERATORS.keys())))
+        filters.append((field, operator, value))
+    return filters
+
+
+def get_sort_from_request(param: str = 'sort') -> List[Tuple[str, bool]]:
+    """
+    Returns the sort order of the request. Fields are separated by commas and prefixed with - to sort in descending
+    order, ie ?sort=-created_at,name
+
+    :param param: Name of the query parameter
+    :return: List of (field, descending) tuples
+    """
+    value = request.args.get(param, None)
+    if not value:
+        return []
+    sort = []
+    for field in value.split(','):
+        field = field.strip()
+        if not field:
+            continue
+        descending = field.startswith('-')
+        sort.append((field.lstrip('-+'), descending))
+    return sort
+
+
+def get_indexed_columns(model) -> List[str]:
+    """
+    Returns the attributes of a model that can be filtered and sorted on efficiently. These are the primary key and
+    the columns that are the first column of an index or are unique
+
+    :param model: SqlAlchemy model
+    :return: List of attribute names
+    """
+    from sqlalchemy import inspect
+    mapper = inspect(model)
+    table = model.__table__
+    columns = set(mapper.primary_key)
+    columns.update(index.columns.values()[0] for index in table.indexes if len(index.columns))
+    columns.update(column for column in table.columns if column.index or column.unique)
+    attributes = []
+    for attr in mapper.column_attrs:
+        if any(column in columns for column in attr.columns):
+            attributes.append(attr.key)
+    return attributes
+
+
+def _check_allowed_field(model, field: str, allowed: Optional[List[str]], action: str):
+    if allowed is None:
+        allowed = get_indexed_columns(model)
+    if field not in allowed:
+        raise RSEApiException("Cannot {} on {}. Allowed fields are {}".format(action, field, ', '.join(allowed)))
+    return getattr(model, field)
+
+
+def _parse_bool(value: str) -> bool:
+    if value.lower() in ['true', '1', 'yes']:
+        return True
+    if value.lower() in ['false', '0', 'no']:
+        return False
+    raise ValueError(value)
+
+
+def _parse_datetime(value: str) -> datetime.datetime:
+    # datetime.fromisoformat is only available from python 3.7
+    match = ISO_DATETIME_RE.match(value)
+    if match is None:
+        raise ValueError(value)
+    date, time, zone = match.groups()
+    result = datetime.datetime.strptime(date, '%Y-%m-%d')
+    if time:
+        time_format = '%H:%M:%S.%f' if '.' in time else ('%H:%M:%S' if time.count(':') == 2 else '%H:%M')
+        result = datetime.datetime.combine(result.date(), datetime.datetime.strptime(time, time_format).time())
+    if zone:
+        offset = datetime.timedelta(0)
+        if zone != 'Z':
+            zone = zone.replace(':', '')
+            offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5]))
+            offset = -offset if zone[0] == '-' else offset
+        result = result.replace(tzinfo=datetime.timezone(offset))
+    return result
+
+
+def _convert_filter_value(column, value: str) -> Any:
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is bool:
+        return _parse_bool(value)
+    if python_type is datetime.datetime:
+        return _parse_datetime(value)
+    if python_type is datetime.date:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    if python_type in [int, float, decimal.Decimal, str]:
+        return python_type(value)
+    return value
+
+
+def apply_filters(query, model, filters: List[Tuple[str, str, str]], allowed: Optional[List[str]] = None):
+    """
+    Compiles filters into SqlAlchemy expressions and adds them to a query. Values are converted to the python type of
+    the column and passed as bound parameters
+
+    :param query: SqlAlchemy query
+    :param model: Model being queried
+    :param filters: Filters returned by get_filters_from_request
+    :param allowed: Attributes that can be filtered on. Defaults to the indexed columns of the model so clients cannot
+    trigger full table scans. See get_indexed_columns
+    :return: Query
+    """
+    for field, operator, value in filters:
+        column = _check_allowed_field(model, field, allowed, 'filter')
+        try:
+            if operator == 'is_null':
+                value = _parse_bool(value)
+            elif operator == 'in':
+                values = value.split(',')
+                if len(values) > MAX_IN_VALUES:
+                    raise RSEApiException("in filters are limited to {} values".format(MAX_IN_VALUES))
+                value = [_convert_filter_value(column, v) for v in values]
+            elif operator not in ['like', 'ilike']:
+                value = _convert_filter_value(column, value)
+        except ValueError:
+            raise RSEApiException("Invalid value {} for filter on {}".format(value, field))
+        query = query.filter(FILTER_OPERATORS[operator](column, value))
+    return query
+
+
+def apply_sort(query, model, sort: List[Tuple[str, bool]], allowed: Optional[List[str]] = None):
+    """
+    Orders a query by the requested fields
+
+    :param query: SqlAlchemy query
+    :param model: Model being queried
+    :param sort: Sort returned by get_sort_from_request
+    :param allowed: Attributes that can be sorted on. Defaults to the indexed columns of the model
+    :return: Query
+    """
+    for field, descending in sort:
+        column = _check_allowed_field(model, field, allowed, 'sort')
+        query = query.order_by(column.desc() if descending else column.asc())
+    return query
+
+
+def _get_nested_schema(field):
+    """
+    Returns the schema of a Nested or List(Nested) field, None if the field is not nested
+    """
+    from marshmallow import fields
+    # marshmallow 2 calls the inner field of a List container, marshmallow 3 inner
+    inner = getattr(field, 'container', None) or getattr(field, 'inner', None)
+    if isinstance(field, fields.List) and inner is not None:
+        field = inner
+    if isinstance(field, fields.Nested):
+        return field.schema
+    return None
+
+
+def _is_related_field(field) -> bool:
+    # Related fields of marshmallow-sqlalchemy dump the primary keys of related objects, so the relationship has to
+    # be loaded as well
+    if not HAS_MARSHMALLOW_SQLALCHEMY:
+        return False
+    from marshmallow import fields
+    from marshmallow_sqlalchemy.fields import Related
+    inner = getattr(field, 'container', None) or getattr(field, 'inner', None)
+    if isinstance(field, fields.List) and inner is not None:
+        field = inner
+    return isinstance(field, Related)
+
+
+def _build_eager_load_options(mapper, schema, parent, depth: int) -> list:
+    from sqlalchemy import orm
+    options = []
+    for name, field in schema.fields.items():
+        if field.load_only:
+            continue
+        nested = _get_nested_schema(field)
+        if nested is None and not _is_related_field(field):
+            continue
+        key = (field.attribute or name).split('.')[0]
+        if key not in mapper.relationships:
+            continue
+        relationship = mapper.relationships[key]
+        # collections are loaded with a second SELECT ... IN query so the rows of the parent are not multiplied,
+        # which would break LIMIT. Many to one relationships are joined
+        strategy = 'selectinload' if relationship.uselist else 'joinedload'
+        attribute = getattr(mapper.class_, key)
+        loader = getattr(orm if parent is None else parent, strategy)(attribute)
+        children = []
+        if nested is not None and depth > 1:
+            children = _build_eager_load_options(relationship.mapper, nested, loader, depth - 1)
+        options.extend(children if children else [loader])
+    return options
+
+
+def get_eager_load_options(model, schema, max_depth: int = 3) -> list:
+    """
+    Returns the loader options that eager load every relationship dumped by a schema so dumping a list of objects
+    does not run one query per object and relationship(the N+1 problem)
+
+    Nested and List(Nested) fields are followed up to max_depth levels. Collections use selectinload and many to one
+    relationships use joinedload. The options are cached per model, schema class and fields
+
+    :param model: SqlAlchemy model
+    :param schema: Marshmallow schema instance used to dump the query results
+    :param max_depth: How many levels of nested schemas are eager loaded
+    :return: List of loader options to pass to query.options
+    """
+    from sqlalchemy import inspect
+    key = (model, type(schema), tuple(schema.fields.keys()), max_depth)
+    options = EAGER_LOAD_CACHE.get(key)
+    if options is None:
+        options = _build_eager_load_options(inspect(model), schema, None, max_depth)
+        EAGER_LOAD_CACHE.set(key, options)
+    return options
+
+
+def _count_query_execution(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.rse_query_count = g.get('rse_query_count', 0) + 1
+
+
+def register_query_counter(app, threshold: Optional[int] = None):
+    """
+    Counts the SQL queries executed by each request. The count is returned in the X-Query-Count header and a warning
+    is logged when a request executes more than threshold queries, which usually means relationships are lazy loaded
+    one object at a time
+
+    This is meant for development. get_application registers it when the application is in debug mode or the
+    QUERY_COUNTER setting is true
+
+    :param app: Flask application
+    :param threshold: Number of queries above which a warning is logged. Defaults to the QUERY_COUNT_WARN_THRESHOLD
+    setting or 20
+    """
+    if 'rse_query_counter' in app.extensions:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    if not event.contains(Engine, 'before_cursor_execute', _count_query_execution):
+        event.listen(Engine, 'before_cursor_execute', _count_query_execution)
+    if threshold is None:
+        threshold = app.config.get('QUERY_COUNT_WARN_THRESHOLD', QUERY_COUNT_WARN_THRESHOLD)
+
+    @app.before_request
+    def reset_query_count():
+        g.rse_query_count = 0
+
+    @app.after_request
+    def check_query_count(response):
+        count = g.get('rse_query_count', 0)
+        response.headers['X-Query-Count'] = str(count)
+        if count > threshold:
+            app.logger.warning('{} {} executed {} queries'.format(request.method, request.path, count))
+        return response
+
+    app.extensions['rse_query_counter'] = threshold
+
+
+def encode_cursor(value: Any) -> str:
+    """
+    Encodes the value of the order by column into an opaque cursor token
+
+    :param value: Value of the order by column for the item the cursor points at
+    :return: Url safe cursor token
+    """
+    return base64.urlsafe_b64encode(json.dumps(value, default=str).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token: str) -> Any:
+    """
+    Decodes a cursor token created by encode_cursor
+
+    :param token: Cursor token from the request
+    :return: Value of the order by column the cursor points at
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise RSEApiException("Invalid cursor {}".format(token))
+
+
+def get_cursor_from_request(per_page_default: int =100) -> dict:
+    """
+    Returns the cursor pagination filter created from a request
+
+    The cursor is assumed to be in either the `after` or the `before` query parameters. Only one of them may be
+    supplied. The number of items per page is assumed to be in the per_page query option
+
+    :param per_page_default: Number of items per page when per_page is not supplied
+    :return: Dictionary containing the decoded values for after and before(None when not supplied) and per_page
+    """
+    after = request.args.get('after', None)
+    before = request.args.get('before', None)
+    if after is not None and before is not None:
+        raise RSEApiException("Only one of after or before can be specified")
+    per_page = request.args.get('per_page', per_page_default)
+    try:
+        per_page = int(per_page)
+    except (ValueError, TypeError):
+        per_page = 0
+    if per_page < 1:
+        raise RSEApiException("Invalid per_page {}. It must be a positive integer".format(
+            request.args.get('per_page', per_page_default)))
+    return {
+        "after": decode_cursor(after) if after else None,
+        "before": decode_cursor(before) if before else None,
+        "per_page": per_page
+    }
+
+
+class CursorPage:
+    def __init__(self, items: List, per_page: int, next_cursor: Optional[str] = None,
+                 prev_cursor: Optional[str] = None):
+        """
+        One page of a keyset(cursor) paginated query
+
+        :param items: Items of the page
+        :param per_page: Maximum number of items of the page
+        :param next_cursor: Cursor token to fetch the page after this one. None if this is the last page
+        :param prev_cursor: Cursor token to fetch the page before this one. None if this is the first page
+        """
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def links(self) -> str:
+        """
+        Returns the value of the Link header pointing to the next and previous pages of the current request
+        """
+        links = []
+        for rel, param, cursor in [('next', 'after', self.next_cursor), ('prev', 'before', self.prev_cursor)]:
+            if cursor is None:
+                continue
+            args = {k: v for k, v in request.args.items() if k not in ['after', 'before']}
+            args[param] = cursor
+            links.append('<{}?{}>; rel="{}"'.format(request.base_url, urlencode(args), rel))
+        return ', '.join(links)
+
+
+def keyset_paginate(query, column, after: Any = None, before: Any = None, per_page: int = 100) -> CursorPage:
+    """
+    Paginates a query by seeking on an indexed column instead of using OFFSET. Fetching any page costs the same as
+    fetching the first one and no COUNT query is issued
+
+    The column should be unique(usually the primary key) so the ordering is stable
+
+    :param query: SqlAlchemy query to paginate. It should not be ordered already
+    :param column: Column to order and seek by
+    :param after: Return the items following this column value
+    :param before: Return the items preceding this column value
+    :param per_page: Number of items per page
+    :return: CursorPage
+    """
+    if before is not None:
+        items = query.filter(column < before).order_by(column.desc()).limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = list(reversed(items[:per_page]))
+        has_next, has_prev = True, has_more
+    else:
+        if after is not None:
+            query = query.filter(column > after)
+        items = query.order_by(column.asc()).limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        has_next, has_prev = has_more, after is not None
+
+    key = column.key
+    next_cursor = encode_cursor(getattr(items[-1], key)) if has_next and items else None
+    prev_cursor = encode_cursor(getattr(items[0], key)) if has_prev and items else None
+    return CursorPage(items, per_page, next_cursor, prev_cursor)
+
+
+def get_count_mode_from_request(default: str = 'exact') -> str:
+    """
+    Returns how the total of a listing should be counted
+
+    Clients can request an exact count(or no count at all) using the `count` query parameter. Otherwise the default
+    mode of the endpoint is used
+
+    :param default: Count mode of the endpoint. One of exact, none, estimate or cached
+    :return: Count mode
+    """
+    mode = request.args.get('count', None)
+    if mode is None:
+        return default
+    if mode not in REQUESTABLE_COUNT_MODES:
+        raise RSEApiException("count must be one of {}".format(', '.join(REQUESTABLE_COUNT_MODES)))
+    return mode
+
+
+def estimate_table_count(session, table_name: str) -> Optional[int]:
+    """
+    Returns the row count of a table from the database statistics. This is not exact but is close to free
+
+    Only PostgreSQL and MySQL are supported. For other databases None is returned
+
+    :param session: SqlAlchemy session
+    :param table_name: Table to estimate
+    :return: Estimated number of rows or None
+    """
+    from sqlalchemy import text
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        sql = text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table_name)")
+    elif dialect == 'mysql':
+        sql = text("SELECT table_rows FROM information_schema.tables "
+                   "WHERE table_schema = DATABASE() AND table_name = :table_name")
+    else:
+        return None
+    result = session.execute(sql, dict(table_name=table_name)).scalar()
+    # reltuples is -1 on tables that have never been analyzed
+    return int(result) if result is not None and result >= 0 else None
+
+
+def get_count_cache_key(query, table_name: str) -> tuple:
+    """
+    Returns the cache key of the count of a query. The key is made of the table and of the query statement with its
+    parameters, so two listings with different filters don't share a count
+
+    :param query: SqlAlchemy query
+    :param table_name: Table being counted
+    :return: Key
+    """
+    statement = query.order_by(None).statement
+    params = statement.compile().params
+    return table_name, str(statement), repr(sorted(params.items()))
+
+
+def count_query(query, mode: str = 'exact', table_name: Optional[str] = None, cache_ttl: Optional[float] = None,
+                filtered: bool = False) -> Optional[int]:
+    """
+    Counts the results of a query
+
+    :param query: SqlAlchemy query to count
+    :param mode: exact runs a COUNT query, none skips the count, estimate uses the database statistics of the table
+    and cached runs a COUNT query and keeps the result for cache_ttl seconds. When the database cannot estimate,
+    estimate falls back to cached
+    :param table_name: Name of the table being counted. Required for estimate and cached
+    :param cache_ttl: How long a cached count is kept. Defaults to the COUNT_CACHE default ttl
+    :param filtered: Is the query filtered? Table statistics cannot be used to estimate filtered queries
+    :return: Total or None when the count was skipped
+    """
+    if mode not in COUNT_MODES:
+        raise RSEApiException("Unsupported count mode {}".format(mode))
+    if mode == 'none':
+        return None
+    if mode == 'exact' or table_name is None:
+        return query.order_by(None).count()
+
+    if mode == 'estimate' and not filtered:
+        total = estimate_table_count(query.session, table_name)
+        if total is not None:
+            return total
+
+    key = get_count_cache_key(query, table_name)
+    total = COUNT_CACHE.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        COUNT_CACHE.set(key, total, ttl=cache_ttl)
+    return total
+
+
+class OffsetPage:
+    def __init__(self, items: List, page: int, per_page: int, total: Optional[int] = None):
+        """
+        One page of an offset paginated query
+
+        :param items: Items of the page
+        :param page: Current page starting at 1
+        :param per_page: Maximum number of items of the page
+        :param total: Total number of items. None if the count was skipped
+        """
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+
+    @property
+    def pages(self) -> Optional[int]:
+        if self.total is None:
+            return None
+        if self.per_page == 0 or self.total == 0:
+            return 0
+        return int(math.ceil(self.total / float(self.per_page)))
+
+
+def paginate_query(query, page: int = 1, per_page: int = 100, count: str = 'exact', table_name: Optional[str] = None,
+                   cache_ttl: Optional[float] = None, filtered: bool = False) -> OffsetPage:
+    """
+    Paginates a query using OFFSET/LIMIT. This behaves like Flask-SQLAlchemy's paginate but allows control over how
+    the total is counted. See count_query for the count options
+
+    :param query: Query to paginate
+    :param page: Page to fetch starting at 1
+    :param per_page: Number of items per page
+    :param count: Count mode
+    :param table_name: Table being counted
+    :param cache_ttl: How long a cached count is kept
+    :param filtered: Is the query filtered?
+    :return: OffsetPage
+    """
+    if page < 1 or per_page < 0:
+        abort(404)
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    if not items and page != 1:
+        abort(404)
+
+    if page == 1 and len(items) < per_page:
+        # we have everything on the first page so there is no need to count
+        total = len(items)
+    else:
+        total = count_query(query, count, table_name, cache_ttl, filtered)
+    return OffsetPage(items, page, per_page, total)
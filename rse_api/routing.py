@@ -1,4 +1,5 @@
-def register_api(view, endpoint, url=None, pk='id', pk_type='int', methods=['GET', 'PUT', 'DELETE', 'POST'], app=None):
+def register_api(view, endpoint, url=None, pk='id', pk_type='int', methods=['GET', 'PUT', 'DELETE', 'POST'], app=None,
+                 bulk=False):
     """
     Registers a class as an api endpoint
 
@@ -11,6 +12,8 @@ def register_api(view, endpoint, url=None, pk='id', pk_type='int', methods=['GET
     registered for to sets of urls. The unique object versions, ie /objects/id and the listing of all objects,
     ie /objects. POST will only be registered at the top level url is specified, ie /objects
     :param app: App object to register url
+    :param bulk: Register the bulk operations of SimpleController. PATCH and DELETE will be registered on the top level
+    url, ie /objects, and PATCH will also be registered on the unique object url
     :return: None
     """
     view_func = view.as_view(endpoint)
@@ -31,6 +34,10 @@ def register_api(view, endpoint, url=None, pk='id', pk_type='int', methods=['GET
                          view_func=view_func, methods=['GET', ])
     if 'POST' in methods:
         app.add_url_rule(url, strict_slashes=False, view_func=view_func, methods=['POST', ])
+    if bulk:
+        methods = methods + ['PATCH'] if 'PATCH' not in methods else methods
+        bulk_methods = [m for m in ['PATCH', 'DELETE'] if m in methods]
+        app.add_url_rule(url, strict_slashes=False, defaults={pk: None}, view_func=view_func, methods=bulk_methods)
     app.logger.info('Register URL %s/<%s:%s>' % (url, pk_type, pk))
     # ensure post is not a method at this point
     fm = [f for f in methods.copy() if f != 'POST']
@@ -0,0 +1,286 @@
+from collections import OrderedDict
+from threading import Lock, local
+from typing import Any, Hashable, List, Optional, Union
+import marshmallow
+from marshmallow import Schema, ValidationError, fields, missing
+
+from rse_api.errors import RSEApiException
+
+# The compiled serializers rely on the internals of Marshmallow 2. With other versions, we always use Schema.dump
+CAN_COMPILE = getattr(marshmallow, '__version_info__', (0,))[0] == 2
+
+# Kind of accessor used for each field
+_GENERIC = 0  # call field.serialize like marshmallow does
+_FIELD = 1  # pull the value ourselves then call field._serialize
+_STRING = 2  # like _FIELD but str values are passed through as is
+_INTEGER = 3  # like _FIELD but int values are passed through as is
+
+_SERIALIZER_CACHE = OrderedDict()
+_SERIALIZER_CACHE_SIZE = 256
+_SERIALIZER_CACHE_LOCK = Lock()
+
+# Schema instances are cached per thread. See get_schema_instance
+_SCHEMA_INSTANCES = local()
+SCHEMA_INSTANCE_CACHE_SIZE = 256
+
+
+def dump_data(schema: Schema, obj, many: bool=False):
+    """
+    Dumps an object with a schema and returns only the data. Works with both Marshmallow 2 and 3
+
+    :param schema: Marshmallow schema instance
+    :param obj: Object to dump
+    :param many: Is obj a list of objects?
+    :return: Dumped data
+    """
+    result = schema.dump(obj, many=many)
+    return result.data if hasattr(result, 'data') else result
+
+
+def _get_value(obj, key: str, getitem: bool):
+    # Same lookup as marshmallow.utils.get_value for a non dotted key, minus the exception raised when trying to
+    # index objects that are not subscriptable
+    if getitem:
+        try:
+            return obj[key]
+        except (KeyError, AttributeError, IndexError, TypeError):
+            pass
+    try:
+        value = getattr(obj, key)
+    except AttributeError:
+        return missing
+    return value() if callable(value) else value
+
+
+def _field_kind(field_obj: fields.Field, attr: str) -> int:
+    field_class = type(field_obj)
+    if field_class.serialize is not fields.Field.serialize or field_class.get_value is not fields.Field.get_value or \
+            not field_obj._CHECK_ATTRIBUTE or not isinstance(attr, str) or '.' in attr:
+        return _GENERIC
+    if field_class in (fields.String, fields.Str):
+        return _STRING
+    if field_class in (fields.Integer, fields.Int) and not field_obj.as_string:
+        return _INTEGER
+    return _FIELD
+
+
+def _can_compile_schema(schema: Schema) -> bool:
+    schema_class = type(schema)
+    return CAN_COMPILE and \
+        schema_class.get_attribute is Schema.get_attribute and \
+        schema_class.__accessor__ is None and \
+        not schema._has_processors and \
+        all(name in schema.declared_fields for name in schema.fields)
+
+
+class CompiledSerializer:
+    def __init__(self, schema: Schema):
+        """
+        Serializer that produces the same output as schema.dump, but faster
+
+        The field list, output keys and value accessors are resolved once here instead of on every dump. Plain fields
+        are serialized by calling their _serialize directly and str/int values of String/Integer fields are passed
+        through as is. Fields that customize how values are pulled(Method, Function, List, dotted attributes, etc)
+        are still serialized by marshmallow.
+
+        Schemas with pre/post dump processors or custom accessors are not compiled. For those, and whenever a field
+        fails to serialize, the schema's own dump is used so output and errors are exactly the same
+
+        :param schema: Marshmallow schema instance
+        """
+        self.schema = schema
+        self.compiled = _can_compile_schema(schema)
+        self._fields = []
+        if self.compiled:
+            prefix = schema.prefix or ''
+            for attr_name, field_obj in schema.fields.items():
+                if getattr(field_obj, 'load_only', False):
+                    continue
+                attr = field_obj.attribute if getattr(field_obj, 'attribute', None) is not None else attr_name
+                key = prefix + (field_obj.dump_to or attr_name)
+                self._fields.append((key, attr_name, attr, _field_kind(field_obj, attr), field_obj))
+            self._dict_class = schema.dict_class
+            self._extra = schema.extra
+            self._accessor = schema.get_attribute
+
+    def _dump_one(self, obj) -> dict:
+        getitem = hasattr(type(obj), '__getitem__')
+        items = []
+        for key, attr_name, attr, kind, field_obj in self._fields:
+            if kind == _GENERIC:
+                value = field_obj.serialize(attr_name, obj, accessor=self._accessor)
+            else:
+                value = _get_value(obj, attr, getitem)
+                if value is missing:
+                    default = field_obj.default
+                    value = default() if callable(default) else default
+                elif not ((kind == _STRING and type(value) is str) or (kind == _INTEGER and type(value) is int)):
+                    value = field_obj._serialize(value, attr_name, obj)
+            if value is missing:
+                continue
+            items.append((key, value))
+        result = self._dict_class(items)
+        if self._extra:
+            result.update(self._extra)
+        return result
+
+    def dump(self, obj, many: bool=False) -> Any:
+        """
+        Dumps an object and returns only the data
+
+        :param obj: Object or list of objects to dump
+        :param many: Is obj a list of objects?
+        :return: Dumped data
+        """
+        if not self.compiled or obj is None:
+            return dump_data(self.schema, obj, many=many)
+        try:
+            if many:
+                return [self._dump_one(o) for o in obj]
+            return self._dump_one(obj)
+        except ValidationError:
+            # let marshmallow collect the errors and handle strict mode
+            return dump_data(self.schema, obj, many=many)
+
+
+def _get_schema_cache_key(schema: Schema) -> Optional[Hashable]:
+    if schema.context or schema.extra:
+        return None
+    try:
+        return (type(schema), tuple(schema.fields.keys()), schema.prefix, schema.ordered, schema.strict,
+                tuple(sorted(schema.load_only)), tuple(sorted(schema.dump_only)))
+    except TypeError:
+        return None
+
+
+def get_compiled_serializer(schema: Schema) -> CompiledSerializer:
+    """
+    Returns a compiled serializer for a schema instance. Serializers are cached per schema class and options so
+    decorating many functions with equivalent schemas only compiles once
+
+    :param schema: Marshmallow schema instance
+    :return: CompiledSerializer
+    """
+    key = _get_schema_cache_key(schema) if CAN_COMPILE else None
+    if key is None:
+        return CompiledSerializer(schema)
+    with _SERIALIZER_CACHE_LOCK:
+        serializer = _SERIALIZER_CACHE.get(key, None)
+        if serializer is None:
+            serializer = CompiledSerializer(schema)
+            _SERIALIZER_CACHE[key] = serializer
+            while len(_SERIALIZER_CACHE) > _SERIALIZER_CACHE_SIZE:
+                _SERIALIZER_CACHE.popitem(last=False)
+        else:
+            _SERIALIZER_CACHE.move_to_end(key)
+        return serializer
+
+
+def _freeze(value: Any) -> Hashable:
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def get_schema_instance(schema_class: type, **options) -> Schema:
+    """
+    Returns an instance of schema_class built with options, reusing the instance built by a previous call with the
+    same class and options. Building a schema deep copies its declared fields, which costs more than dumping a
+    single object
+
+    Instances are cached per thread because loading is not thread safe. For example ModelSchema keeps the instance
+    being loaded on the schema. Schemas with a context are not cached since the context is usually per request
+
+    :param schema_class: Marshmallow schema class
+    :param options: Arguments of the schema constructor, ie only, exclude, strict or session
+    :return: Schema instance
+    """
+    if options.get('context', None):
+        return schema_class(**options)
+    cache = getattr(_SCHEMA_INSTANCES, 'cache', None)
+    if cache is None:
+        cache = _SCHEMA_INSTANCES.cache = OrderedDict()
+    try:
+        key = (schema_class, _freeze(options))
+        schema = cache.get(key, None)
+    except TypeError:
+        # unhashable option
+        return schema_class(**options)
+    if schema is None:
+        schema = cache[key] = schema_class(**options)
+        while len(cache) > SCHEMA_INSTANCE_CACHE_SIZE:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+    return schema
+
+
+def validate_sparse_fields(schema: Schema, field_names: List[str]):
+    """
+    Ensures all the requested fields are dumped by the schema. Nested fields can be requested using dots,
+    ie owner.name
+
+    :param schema: Marshmallow schema instance
+    :param field_names: Requested fields
+    :raises RSEApiException: When a field is unknown
+    """
+    dumped = [name for name, field in schema.fields.items() if not getattr(field, 'load_only', False)]
+    unknown = [name for name in field_names if name.split('.')[0] not in dumped]
+    if unknown:
+        raise RSEApiException("Unknown field(s) {}".format(', '.join(unknown)))
+
+
+def get_field_attributes(schema: Schema, field_names: List[str]) -> List[str]:
+    """
+    Returns the object attributes the requested fields are pulled from
+
+    :param schema: Marshmallow schema instance
+    :param field_names: Requested fields
+    :return: List of attributes
+    """
+    attributes = []
+    for name in field_names:
+        field_obj = schema.fields[name.split('.')[0]]
+        attribute = getattr(field_obj, 'attribute', None) or name.split('.')[0]
+        attributes.append(attribute.split('.')[0])
+    return attributes
+
+
+def get_sparse_schema(schema: Union[Schema, type], field_names: List[str]) -> Schema:
+    """
+    Returns a schema that only dumps the requested fields. See get_schema_instance
+
+    :param schema: Marshmallow schema class or instance
+    :param field_names: Requested fields
+    :return: Schema instance
+    """
+    if isinstance(schema, type):
+        schema = get_schema_instance(schema)
+    validate_sparse_fields(schema, field_names)
+    return get_schema_instance(type(schema), only=tuple(field_names), exclude=tuple(schema.exclude),
+                               prefix=schema.prefix, strict=schema.strict, context=schema.context, extra=schema.extra)
+
+
+def get_sparse_serializer(schema: Schema, field_names: List[str]) -> CompiledSerializer:
+    """
+    Returns a compiled serializer that only dumps the requested fields. Serializers are cached per schema and fields
+
+    :param schema: Marshmallow schema instance
+    :param field_names: Requested fields
+    :return: CompiledSerializer
+    """
+    base_key = _get_schema_cache_key(schema) if CAN_COMPILE else None
+    if base_key is None:
+        return CompiledSerializer(get_sparse_schema(schema, field_names))
+    key = ('sparse', base_key, tuple(field_names))
+    with _SERIALIZER_CACHE_LOCK:
+        serializer = _SERIALIZER_CACHE.get(key, None)
+    if serializer is None:
+        serializer = CompiledSerializer(get_sparse_schema(schema, field_names))
+        with _SERIALIZER_CACHE_LOCK:
+            _SERIALIZER_CACHE[key] = serializer
+            while len(_SERIALIZER_CACHE) > _SERIALIZER_CACHE_SIZE:
+                _SERIALIZER_CACHE.popitem(last=False)
+    return serializer
@@ -1,20 +1,52 @@
 import dramatiq
 from threading import local
+from flask import g, has_app_context
+
+
+def _is_current(context) -> bool:
+    # each application context has its own g, so the current g tells which context is active
+    return has_app_context() and g._get_current_object() is context.g
 
 
 class AppContextMiddleware(dramatiq.Middleware):
     state = local()
 
-    def __init__(self, app):
+    def __init__(self, app, reuse_context: bool = False):
+        """
+        Runs every message inside an application context
+
+        :param app: Flask application
+        :param reuse_context: Keep one application context per worker thread instead of pushing and popping one for
+        every message. After each message the teardown_appcontext functions still run, which removes the
+        Flask-SQLAlchemy session, and g is cleared. Defaults to the DRAMATIQ_REUSE_APP_CONTEXT setting
+        """
         self.app = app
+        self.reuse_context = reuse_context
 
     def before_process_message(self, broker, message):
+        if self.reuse_context:
+            context = getattr(self.state, 'context', None)
+            if context is None or not _is_current(context):
+                context = self.app.app_context()
+                context.push()
+                self.state.context = context
+            return
+
         context = self.app.app_context()
         context.push()
 
         self.state.context = context
 
     def after_process_message(self, broker, message, *, result=None, exception=None):
+        if self.reuse_context:
+            context = getattr(self.state, 'context', None)
+            if context is not None:
+                try:
+                    self.app.do_teardown_appcontext(exception)
+                finally:
+                    context.g.__dict__.clear()
+            return
+
         try:
             context = self.state.context
             context.pop(exception)
@@ -23,3 +55,10 @@ class AppContextMiddleware(dramatiq.Middleware):
             pass
 
     after_skip_message = after_process_message
+
+    def before_worker_thread_shutdown(self, broker, thread):
+        context = getattr(self.state, 'context', None)
+        if self.reuse_context and context is not None:
+            del self.state.context
+            if _is_current(context):
+                context.pop()
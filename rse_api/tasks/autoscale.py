@@ -0,0 +1,247 @@
+import math
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import time
+from importlib import util
+from logging import getLogger
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+HAS_PIKA = util.find_spec('pika') is not None
+
+
+class ScaleDecision(NamedTuple):
+    processes: int
+    threads: int
+
+
+def decide_scale(processes: int, queue_depth: int, load: float, min_processes: int = 1, max_processes: int = 4,
+                 min_threads: int = 1, max_threads: int = 8, messages_per_thread: int = 10,
+                 max_load: float = 0.9, io_bound_load: float = 0.5) -> ScaleDecision:
+    """
+    Returns the number of worker processes to run and the number of threads of the processes to start
+
+    Enough processes are requested for every thread to have messages_per_thread messages waiting. While the CPUs are
+    saturated(load >= max_load) more processes would not drain the queues faster, so the count is not raised. When
+    the queues have a backlog while the CPUs are mostly idle(load < io_bound_load) the work is waiting on I/O, so new
+    processes get max_threads threads. Otherwise they get min_threads threads
+
+    :param processes: Number of processes running
+    :param queue_depth: Number of messages waiting in the queues
+    :param load: Load average divided by the number of CPUs
+    :param min_processes: Minimum number of processes
+    :param max_processes: Maximum number of processes
+    :param min_threads: Threads of new processes when the work is CPU bound
+    :param max_threads: Threads of new processes when the work is I/O bound
+    :param messages_per_thread: Waiting messages per thread before adding a process
+    :param max_load: Load above which no process is added
+    :param io_bound_load: Load under which the work is considered I/O bound
+    :return: ScaleDecision
+    """
+    threads = max_threads if load < io_bound_load else min_threads
+    wanted = math.ceil(queue_depth / float(max(threads * messages_per_thread, 1)))
+    wanted = min(max(wanted, min_processes), max_processes)
+    if wanted > processes and load >= max_load:
+        wanted = max(processes, min_processes)
+    return ScaleDecision(wanted, threads)
+
+
+def get_cpu_load() -> float:
+    """
+    Returns the one minute load average divided by the number of CPUs. 0 where load averages are not available
+    """
+    try:
+        return os.getloadavg()[0] / multiprocessing.cpu_count()
+    except (AttributeError, OSError):
+        return 0.0
+
+
+def get_queue_depth(broker, queues: Optional[Iterable[str]] = None) -> int:
+    """
+    Returns the number of messages waiting in queues, including their delay queues, using the broker API. Supports the
+    StubBroker, RabbitmqBroker and RedisBroker
+
+    :param broker: Dramatiq broker
+    :param queues: Queues to count. Defaults to the declared queues
+    :return: Number of messages
+    """
+    from dramatiq.common import dq_name, q_name
+    queues = broker.get_declared_queues() if queues is None else queues
+    depth = 0
+    # some brokers declare the delay queues too, they are counted with their queue
+    for queue_name in sorted(set(q_name(queue_name) for queue_name in queues)):
+        if hasattr(broker, 'get_queue_message_counts'):
+            messages, delayed, dead = broker.get_queue_message_counts(queue_name)
+            depth += messages + delayed
+        elif hasattr(broker, 'do_qsize'):
+            depth += broker.do_qsize(queue_name) + broker.do_qsize(dq_name(queue_name))
+        elif hasattr(broker, 'queues'):
+            for name in (queue_name, dq_name(queue_name)):
+                queue = broker.queues.get(name, None)
+                depth += queue.qsize() if queue is not None else 0
+        else:
+            raise NotImplementedError("Cannot read the queue depth of {}".format(type(broker).__name__))
+    return depth
+
+
+def _reset_broker_connections(broker):
+    # the RabbitMQ connection and channel of the supervisor thread are inherited by the forked process, which drops
+    # them without closing them and opens its own. Redis connection pools already reset themselves after a fork
+    if not HAS_PIKA:
+        return
+    from dramatiq.brokers.rabbitmq import RabbitmqBroker
+    if isinstance(broker, RabbitmqBroker):
+        del broker.channel
+        del broker.connection
+
+
+def get_process_factory() -> Callable:
+    """
+    Returns the class of the worker processes. The processes use the broker, with its actors and middleware, of the
+    supervisor, so they have to be forked
+
+    :return: multiprocessing.Process of the fork start method
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise NotImplementedError("Worker processes need the fork start method, which {} does not support".format(
+            sys.platform))
+    return multiprocessing.get_context('fork').Process
+
+
+def run_worker_process(broker, queues: Optional[List[str]], threads: int, prefetch: Optional[int] = None):
+    """
+    Runs a dramatiq worker in a forked process until it receives SIGTERM. See get_process_factory
+
+    :param broker: Dramatiq broker of the supervisor
+    :param queues: Queues to consume. None consumes all declared queues
+    :param threads: Number of worker threads
+    :param prefetch: Number of messages fetched ahead per queue. Defaults to twice the threads
+    """
+    from dramatiq import Worker
+    random.seed()
+    _reset_broker_connections(broker)
+    broker.emit_after('process_boot')
+    worker = Worker(broker, queues=queues, worker_threads=threads)
+    if prefetch:
+        worker.queue_prefetch = prefetch
+    worker.start()
+
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop)
+    while running:
+        time.sleep(1)
+    worker.stop()
+    broker.close()
+
+
+class AutoscaleSupervisor:
+    def __init__(self, broker, queues: Optional[List[str]] = None, min_processes: int = 1, max_processes: int = None,
+                 min_threads: int = 1, max_threads: int = 8, messages_per_thread: int = 10,
+                 scale_up_cooldown: float = 30, scale_down_cooldown: float = 300, interval: float = 5,
+                 process_factory: Callable = None):
+        """
+        Starts and stops dramatiq worker processes according to the depth of the queues and the CPU load. See
+        decide_scale
+
+        Processes are added at most once per scale_up_cooldown seconds and removed at most once per
+        scale_down_cooldown seconds, one process at a time when removing. A removed process gets SIGTERM and
+        finishes the messages it is processing. The threads of a process are fixed once started, so thread scaling
+        applies to the processes started afterwards
+
+        :param broker: Dramatiq broker
+        :param queues: Queues to consume and watch. Defaults to all declared queues
+        :param min_processes: Minimum number of processes
+        :param max_processes: Maximum number of processes. Defaults to the number of CPUs
+        :param min_threads: Threads of new processes when the work is CPU bound
+        :param max_threads: Threads of new processes when the work is I/O bound
+        :param messages_per_thread: Waiting messages per thread before adding a process
+        :param scale_up_cooldown: Seconds between two scale ups
+        :param scale_down_cooldown: Seconds between two scale downs
+        :param interval: Seconds between two checks
+        :param process_factory: Creates the worker processes. Defaults to get_process_factory()
+        """
+        self.broker = broker
+        self.queues = queues
+        self.min_processes = min_processes
+        self.max_processes = max_processes or multiprocessing.cpu_count()
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.messages_per_thread = messages_per_thread
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.interval = interval
+        self.process_factory = process_factory or get_process_factory()
+        self.processes = []
+        self.last_scale_up = None
+        self.last_scale_down = None
+        self.running = False
+        self.logger = getLogger('rse_api.autoscale')
+
+    def start_process(self, threads: int):
+        process = self.process_factory(target=run_worker_process, args=(self.broker, self.queues, threads),
+                                       daemon=False)
+        process.start()
+        self.processes.append(process)
+
+    def stop_process(self):
+        process = self.processes.pop()
+        process.terminate()
+        process.join()
+
+    def step(self, now: Optional[float] = None) -> ScaleDecision:
+        """
+        Checks the queues and the load once and starts or stops processes
+
+        :param now: Current monotonic time
+        :return: ScaleDecision
+        """
+        now = time.monotonic() if now is None else now
+        # replace processes that died
+        self.processes = [process for process in self.processes if process.is_alive()]
+        decision = decide_scale(len(self.processes), get_queue_depth(self.broker, self.queues), get_cpu_load(),
+                                self.min_processes, self.max_processes, self.min_threads, self.max_threads,
+                                self.messages_per_thread)
+        running = len(self.processes)
+        if decision.processes > running:
+            if running < self.min_processes or self.last_scale_up is None or \
+                    now - self.last_scale_up >= self.scale_up_cooldown:
+                self.logger.info('Scaling up from {} to {} processes with {} threads'.format(
+                    running, decision.processes, decision.threads))
+                for _ in range(decision.processes - running):
+                    self.start_process(decision.threads)
+                self.last_scale_up = now
+        elif decision.processes < running:
+            last_change = max(self.last_scale_up or 0, self.last_scale_down or 0)
+            if now - last_change >= self.scale_down_cooldown:
+                self.logger.info('Scaling down from {} to {} processes'.format(running, running - 1))
+                self.stop_process()
+                self.last_scale_down = now
+        return decision
+
+    def run(self):
+        """
+        Runs the supervisor until SIGINT or SIGTERM, then stops the worker processes
+        """
+        self.running = True
+
+        def stop(signum, frame):
+            self.running = False
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        while self.running:
+            self.step()
+            time.sleep(self.interval)
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
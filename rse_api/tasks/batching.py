@@ -0,0 +1,198 @@
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+import dramatiq
+
+
+class _Batch:
+    __slots__ = ('items', 'results', 'error', 'done')
+
+    def __init__(self):
+        self.items = []
+        self.results: Optional[List[Any]] = None
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+
+class MessageBatcher:
+    def __init__(self, func: Callable[[List[Any]], Optional[List[Any]]], max_batch_size: int = 100,
+                 max_wait_ms: float = 50, idle_ms: float = 1):
+        """
+        Groups the messages processed at the same time by the worker threads so func is called once per batch
+
+        The first thread to submit an item leads the batch. It waits while other threads announced an item(see
+        expect), until the batch has max_batch_size items or max_wait_ms passed. Once every announced item is in the
+        batch and some worker threads are not waiting on it, it waits idle_ms more for one of them to announce an item,
+        since the threads released by the previous batch start their next message at about the same time. It then
+        calls func with the items and hands the results back to the other threads. Every thread returns its own result
+        or raises, so each message is still acked or nacked on its own
+
+        Each thread of the batch is blocked until the batch is processed, so a batch has at most as many items as
+        there are worker threads consuming the queue(see dramatiq --threads). Since a batch does not wait for threads
+        that are not processing a message, it runs as soon as the messages available to the worker are in it
+
+        :param func: Function called with the list of items. It returns None or a list with one result per item. A
+        result that is an exception fails the message of that item only. If func raises, every message of the batch
+        fails
+        :param max_batch_size: Maximum number of items in a batch
+        :param max_wait_ms: Maximum time the leader waits for other items in milliseconds
+        :param idle_ms: Time the leader waits for another thread to announce an item in milliseconds
+        """
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.idle_ms = idle_ms
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._batch: Optional[_Batch] = None
+        # number of threads that announced an item they have not submitted yet
+        self._expected = 0
+        self._local = threading.local()
+        # number of worker threads that can submit items, set by BatchingMiddleware. None when unknown
+        self.worker_threads: Optional[int] = None
+
+    def expect(self):
+        """
+        Announces that the current thread is about to submit an item, so the current batch waits for it
+        """
+        with self._lock:
+            if not getattr(self._local, 'expected', False):
+                self._local.expected = True
+                self._expected += 1
+                self._changed.notify_all()
+
+    def cancel(self):
+        """
+        Withdraws the item announced by the current thread, if it was not submitted
+        """
+        with self._lock:
+            self._withdraw()
+
+    def _withdraw(self):
+        if getattr(self._local, 'expected', False):
+            self._local.expected = False
+            self._expected -= 1
+            self._changed.notify_all()
+
+    def _close(self, batch: _Batch):
+        with self._lock:
+            if self._batch is batch:
+                self._batch = None
+
+    def _process(self, batch: _Batch):
+        try:
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            with self._lock:
+                while self._batch is batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if self._expected > 0:
+                        self._changed.wait(remaining)
+                    elif self.worker_threads and len(batch.items) >= self.worker_threads:
+                        # every worker thread is waiting on the batch
+                        break
+                    elif not self._changed.wait(min(self.idle_ms / 1000, remaining)):
+                        # no thread started a message of the batch actor in idle_ms
+                        break
+                if self._batch is batch:
+                    self._batch = None
+            results = self.func(list(batch.items))
+            if results is None:
+                results = [None] * len(batch.items)
+            elif len(results) != len(batch.items):
+                raise ValueError("Batch function returned {} results for {} items".format(
+                    len(results), len(batch.items)))
+            batch.results = results
+        except BaseException as e:
+            batch.error = e
+            raise
+        finally:
+            self._close(batch)
+            batch.done.set()
+
+    def submit(self, item: Any) -> Any:
+        """
+        Adds an item to the current batch and waits for the batch to be processed
+
+        :param item: Item
+        :return: Result of the item
+        """
+        with self._lock:
+            self._withdraw()
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.max_batch_size:
+                self._batch = None
+                self._changed.notify_all()
+
+        if leader:
+            self._process(batch)
+        else:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+        result = batch.results[index]
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+
+class BatchingMiddleware(dramatiq.Middleware):
+    """
+    Announces the messages of batch actors to their MessageBatcher when a worker thread starts processing them, so
+    batches only wait for messages that are being processed. See rse_api.decorators.batch_actor
+    """
+
+    @property
+    def actor_options(self):
+        return {'batcher'}
+
+    @staticmethod
+    def _get_batcher(broker, message) -> Optional[MessageBatcher]:
+        return broker.get_actor(message.actor_name).options.get('batcher', None)
+
+    def before_process_message(self, broker, message):
+        batcher = self._get_batcher(broker, message)
+        if batcher is not None:
+            batcher.expect()
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        batcher = self._get_batcher(broker, message)
+        if batcher is not None:
+            batcher.cancel()
+
+    after_skip_message = after_process_message
+
+    @staticmethod
+    def _add_worker_threads(broker, threads: int):
+        for actor_name in broker.get_declared_actors():
+            batcher = broker.get_actor(actor_name).options.get('batcher', None)
+            if batcher is not None:
+                batcher.worker_threads = (batcher.worker_threads or 0) + threads
+
+    def after_worker_boot(self, broker, worker):
+        self._add_worker_threads(broker, worker.worker_threads)
+
+    def after_worker_shutdown(self, broker, worker):
+        self._add_worker_threads(broker, -worker.worker_threads)
+
+
+def get_batching_middleware(broker) -> BatchingMiddleware:
+    """
+    Returns the BatchingMiddleware of a broker, adding it on first use
+
+    :param broker: Dramatiq broker
+    :return: BatchingMiddleware
+    """
+    for middleware in broker.middleware:
+        if isinstance(middleware, BatchingMiddleware):
+            return middleware
+    middleware = BatchingMiddleware()
+    broker.add_middleware(middleware)
+    return middleware
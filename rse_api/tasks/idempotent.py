@@ -0,0 +1,182 @@
+import hashlib
+import json
+import pickle
+from logging import getLogger
+from typing import Any, Optional
+
+import dramatiq
+from dramatiq.middleware import SkipMessage
+
+from rse_api.cache import MemoryCache, RedisCache
+
+_MISSING = object()
+
+
+def get_idempotency_key(actor_name: str, args: tuple = (), kwargs: Optional[dict] = None) -> str:
+    """
+    Returns the key of a call to an idempotent actor, a hash of the actor name and the arguments
+
+    :param actor_name: Name of the actor
+    :param args: Positional arguments of the message
+    :param kwargs: Keyword arguments of the message
+    :return: Key
+    """
+    payload = json.dumps([actor_name, list(args), kwargs or {}], sort_keys=True, default=repr, separators=(',', ':'))
+    return '{}:{}'.format(actor_name, hashlib.sha256(payload.encode('utf-8')).hexdigest())
+
+
+class IdempotentResults(dramatiq.Middleware):
+    def __init__(self, cache=None, result_ttl: float = 3600, lock_ttl: float = 600, retry_delay: int = 1000,
+                 max_attempts: int = 10, max_result_size: Optional[int] = None):
+        """
+        Runs the actors declared with idempotent=True once per set of arguments
+
+        The result of a successful message is stored under a hash of the actor name and its arguments(see
+        get_idempotency_key) for result_ttl seconds. Later messages with the same arguments are skipped, and if the
+        Results middleware stores the results of the actor, the stored result is saved as their result
+
+        While a message runs it holds a lock on its key. A duplicate received in the meantime is enqueued again after
+        retry_delay milliseconds, doubled on each attempt up to lock_ttl, so concurrent duplicates run once. After
+        max_attempts attempts the duplicate fails instead. The lock expires after lock_ttl seconds in case the process
+        holding it dies
+
+        Actors accept the idempotent, idempotent_ttl(overrides result_ttl) and idempotent_key(a function returning
+        the key from the args and kwargs) options
+
+        :param cache: MemoryCache or RedisCache. With a MemoryCache, each worker process deduplicates on its own.
+        Defaults to a MemoryCache of 1024 results
+        :param result_ttl: Seconds results are kept
+        :param lock_ttl: Seconds before the lock of a running message expires
+        :param retry_delay: Milliseconds before a duplicate of a running message is processed again the first time
+        :param max_attempts: Number of times a duplicate of a running message is enqueued again before failing
+        :param max_result_size: Results larger than this many bytes(pickled) are not stored. None stores all results
+        """
+        self.cache = MemoryCache(max_size=1024) if cache is None else cache
+        self.result_ttl = result_ttl
+        self.lock_ttl = lock_ttl
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.max_result_size = max_result_size
+        self.locks = {}
+        self.logger = getLogger('rse_api.idempotent')
+
+    @property
+    def actor_options(self):
+        return {'idempotent', 'idempotent_ttl', 'idempotent_key'}
+
+    @staticmethod
+    def _actor_key(actor, args: tuple, kwargs: dict) -> str:
+        key_func = actor.options.get('idempotent_key', None)
+        if key_func is not None:
+            return '{}:{}'.format(actor.actor_name, key_func(*args, **kwargs))
+        return get_idempotency_key(actor.actor_name, args, kwargs)
+
+    def _get_key(self, broker, message) -> Optional[str]:
+        actor = broker.get_actor(message.actor_name)
+        if not actor.options.get('idempotent', False):
+            return None
+        return self._actor_key(actor, message.args, message.kwargs)
+
+    def _store_message_result(self, broker, message, result):
+        from dramatiq.results import Results
+        actor = broker.get_actor(message.actor_name)
+        for middleware in broker.middleware:
+            if isinstance(middleware, Results) and actor.options.get('store_results', middleware.store_results):
+                middleware.backend.store_result(message, result,
+                                                actor.options.get('result_ttl', middleware.result_ttl))
+
+    def before_process_message(self, broker, message):
+        key = self._get_key(broker, message)
+        if key is None:
+            return
+        cached = self.cache.get(key + ':result', _MISSING)
+        if cached is not _MISSING:
+            self.logger.debug('Using the stored result of %s for message %s', key, message.message_id)
+            self._store_message_result(broker, message, cached)
+            raise SkipMessage()
+        if not self.cache.add(key + ':lock', message.message_id, ttl=self.lock_ttl):
+            attempts = message.options.get('idempotent_attempts', 0)
+            if attempts >= self.max_attempts:
+                self.logger.warning('%s is still running after %s attempts, failing message %s', key, attempts,
+                                    message.message_id)
+                message.fail()
+                raise SkipMessage()
+            delay = min(self.retry_delay * 2 ** attempts, int(self.lock_ttl * 1000))
+            self.logger.debug('%s is running, retrying message %s in %sms', key, message.message_id, delay)
+            broker.enqueue(message.copy(options={'idempotent_attempts': attempts + 1}), delay=delay)
+            raise SkipMessage()
+        self.locks[message.message_id] = key
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        key = self.locks.pop(message.message_id, None)
+        if key is None:
+            return
+        try:
+            if exception is None and self._fits(result):
+                actor = broker.get_actor(message.actor_name)
+                self.cache.set(key + ':result', result, ttl=actor.options.get('idempotent_ttl', self.result_ttl))
+        finally:
+            self._release(key, message)
+
+    def after_skip_message(self, broker, message):
+        key = self.locks.pop(message.message_id, None)
+        if key is not None:
+            self._release(key, message)
+
+    def _release(self, key: str, message):
+        # the lock may have expired and been taken by another message meanwhile
+        if not self.cache.delete_if(key + ':lock', message.message_id):
+            self.logger.warning('The lock of %s expired before message %s finished', key, message.message_id)
+
+    def _fits(self, result: Any) -> bool:
+        if self.max_result_size is None:
+            return True
+        return len(pickle.dumps(result)) <= self.max_result_size
+
+    def get_result(self, actor, *args, default: Any = None, **kwargs) -> Any:
+        """
+        Returns the stored result of an idempotent actor for a set of arguments
+
+        :param actor: Actor
+        :param args: Positional arguments
+        :param default: Value returned when no result is stored
+        :param kwargs: Keyword arguments
+        :return: Result
+        """
+        return self.cache.get(self._actor_key(actor, args, kwargs) + ':result', default)
+
+    def clear(self, actor=None, *args, **kwargs):
+        """
+        Removes a stored result. Without an actor, all stored results are removed
+        """
+        if actor is None:
+            self.cache.clear()
+            return
+        self.cache.delete(self._actor_key(actor, args, kwargs) + ':result')
+
+
+def get_idempotent_results(app) -> IdempotentResults:
+    """
+    Returns the IdempotentResults middleware of an application, creating it on first use
+
+    The backend is controlled by the IDEMPOTENT_RESULTS_BACKEND setting. memory(the default) keeps
+    IDEMPOTENT_RESULTS_SIZE(default 1024) results per process. redis shares the results between workers using
+    REDIS_URI. IDEMPOTENT_RESULTS_TTL(default 3600) sets how many seconds results are kept and
+    IDEMPOTENT_RESULTS_MAX_SIZE the largest result stored in bytes
+
+    :param app: Flask application
+    :return: IdempotentResults
+    """
+    middleware = app.extensions.get('rse_idempotent_results', None)
+    if middleware is None:
+        backend = app.config.get('IDEMPOTENT_RESULTS_BACKEND', 'memory')
+        if backend == 'redis':
+            cache = RedisCache(app.config.get('REDIS_URI', None), prefix='rse_api:idempotent:')
+        elif backend == 'memory':
+            cache = MemoryCache(max_size=app.config.get('IDEMPOTENT_RESULTS_SIZE', 1024))
+        else:
+            raise ValueError("Unsupported idempotent results backend {}".format(backend))
+        middleware = IdempotentResults(cache, result_ttl=app.config.get('IDEMPOTENT_RESULTS_TTL', 3600),
+                                       max_result_size=app.config.get('IDEMPOTENT_RESULTS_MAX_SIZE', None))
+        app.extensions['rse_idempotent_results'] = middleware
+    return middleware
@@ -0,0 +1,117 @@
+import signal
+import time
+from logging import getLogger
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from rse_api.tasks.autoscale import get_process_factory, run_worker_process
+
+POOL_OPTIONS = ['name', 'queues', 'processes', 'threads', 'prefetch']
+
+
+class WorkerPool(NamedTuple):
+    name: str
+    queues: Optional[List[str]]
+    processes: int
+    threads: int
+    prefetch: Optional[int]
+
+
+def get_worker_pools(pools: List[dict], declared_queues: List[str]) -> List[WorkerPool]:
+    """
+    Builds the worker pools from the DRAMATIQ_WORKER_POOLS setting. For example
+
+    DRAMATIQ_WORKER_POOLS = [
+        dict(name='fast', queues=['default'], processes=2, threads=16),
+        dict(name='simulations', queues=['simulations'], processes=1, threads=2, prefetch=1),
+        dict(name='other')
+    ]
+
+    Each pool has its own processes, so slow queues cannot starve the queues of other pools. A pool without queues
+    consumes every declared queue not listed by another pool
+
+    :param pools: List of pool settings with the name, queues, processes(default 1), threads(default 8) and
+    prefetch(default twice the threads) of each pool
+    :param declared_queues: Queues declared by the broker
+    :return: List of WorkerPool
+    """
+    from dramatiq.common import q_name
+    claimed = set()
+    for pool in pools:
+        unknown = set(pool) - set(POOL_OPTIONS)
+        if unknown:
+            raise ValueError("Unknown options {} in worker pool {}".format(sorted(unknown), pool.get('name', None)))
+        if 'name' not in pool:
+            raise ValueError("Worker pools need a name")
+        for queue in pool.get('queues', None) or []:
+            if queue in claimed:
+                raise ValueError("Queue {} is in more than one worker pool".format(queue))
+            claimed.add(queue)
+
+    remaining = sorted(set(q_name(queue) for queue in declared_queues) - claimed)
+    result = []
+    for pool in pools:
+        queues = pool.get('queues', None) or remaining
+        if not queues:
+            getLogger().warning('Worker pool {} has no queue to consume'.format(pool['name']))
+            continue
+        result.append(WorkerPool(pool['name'], list(queues), int(pool.get('processes', 1)),
+                                 int(pool.get('threads', 8)), pool.get('prefetch', None)))
+    return result
+
+
+class PoolSupervisor:
+    def __init__(self, broker, pools: List[WorkerPool], interval: float = 1, process_factory: Callable = None):
+        """
+        Runs the processes of every worker pool and restarts the ones that die
+
+        :param broker: Dramatiq broker
+        :param pools: Worker pools. See get_worker_pools
+        :param interval: Seconds between two checks of the processes
+        :param process_factory: Creates the worker processes. Defaults to get_process_factory()
+        """
+        self.broker = broker
+        self.pools = pools
+        self.interval = interval
+        self.process_factory = process_factory or get_process_factory()
+        self.processes: Dict[str, list] = {pool.name: [] for pool in pools}
+        self.running = False
+        self.logger = getLogger('rse_api.pools')
+
+    def step(self):
+        """
+        Starts the missing processes of every pool
+        """
+        for pool in self.pools:
+            processes = [process for process in self.processes[pool.name] if process.is_alive()]
+            for _ in range(pool.processes - len(processes)):
+                self.logger.info('Starting a process for worker pool {} on {}'.format(pool.name, pool.queues))
+                process = self.process_factory(target=run_worker_process,
+                                               args=(self.broker, pool.queues, pool.threads, pool.prefetch),
+                                               daemon=False)
+                process.start()
+                processes.append(process)
+            self.processes[pool.name] = processes
+
+    def stop(self):
+        processes = [process for pool_processes in self.processes.values() for process in pool_processes]
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        self.processes = {pool.name: [] for pool in self.pools}
+
+    def run(self):
+        """
+        Runs the pools until SIGINT or SIGTERM, then stops their processes
+        """
+        self.running = True
+
+        def stop(signum, frame):
+            self.running = False
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        while self.running:
+            self.step()
+            time.sleep(self.interval)
+        self.stop()
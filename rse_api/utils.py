@@ -1,11 +1,34 @@
+import ast
 import importlib
+import json
 import os
+import threading
 from logging import getLogger
-from typing import List
+from typing import Dict, List, Optional, Tuple
+
+from rse_api.metrics import perf_counter_ns
 
 
 default_exclude = ['__init__.py']
 
+MANIFEST_VERSION = 1
+# Names of the functions and decorators that register routes and actors. See scan_module
+ROUTE_FUNCTIONS = ['route', 'add_url_rule', 'register_crud', 'register_api', 'register_resource']
+ACTOR_DECORATORS = ['actor', 'batch_actor', 'cron']
+# Functions that register routes scan_module cannot read. Modules calling them are always imported
+DYNAMIC_ROUTE_FUNCTIONS = ['Blueprint', 'register_blueprint', 'add_resource', 'resource', 'add_namespace']
+
+# Modules found by load_modules(lazy=True) that have not been imported yet
+LAZY_MODULES: Dict[str, dict] = {}
+# Scans done by load_modules, used to rebuild the manifests
+MODULE_SCANS: List[dict] = []
+_lazy_lock = threading.RLock()
+# Directory scans of load_modules keyed by package, directory and excluded files. See list_module_files
+_SCAN_CACHE: Dict[str, dict] = {}
+# Time in milliseconds spent importing each module and scanning each directory by load_modules
+IMPORT_TIMES: Dict[str, float] = {}
+SCAN_TIMES: Dict[str, float] = {}
+
 
 def dynamic_import_all(module):
     # get a handle on the module
@@ -20,7 +43,290 @@ def dynamic_import_all(module):
     return names
 
 
-def load_modules(package_path: str, dir_path: str, exclude: List[str]=None) -> List[str]:
+def _literal(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return None
+
+
+def _call_name(node) -> Optional[str]:
+    func = node.func if isinstance(node, ast.Call) else node
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    if isinstance(func, ast.Name):
+        return func.id
+    return None
+
+
+def _get_argument(node: ast.Call, position: int, keyword: str):
+    for kw in node.keywords:
+        if kw.arg == keyword:
+            return kw.value
+    if len(node.args) > position:
+        return node.args[position]
+    return None
+
+
+def _get_route_urls(node: ast.Call) -> Optional[List[str]]:
+    # returns the urls registered by a call or None if they cannot be determined statically
+    name = _call_name(node)
+    if name in ['route', 'add_url_rule', 'register_resource']:
+        value = _literal(node.args[0]) if node.args else None
+    else:
+        endpoint_position = 0 if name == 'register_crud' else 1
+        url = _get_argument(node, endpoint_position + 1, 'url')
+        if url is None or (isinstance(url, ast.NameConstant) and url.value is None):
+            url = _get_argument(node, endpoint_position, 'endpoint')
+        value = _literal(url) if url is not None else None
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, (list, tuple)) and all(isinstance(v, str) for v in value):
+        return list(value)
+    return None
+
+
+def scan_module(file_path: str) -> dict:
+    """
+    Finds the routes and actors a module declares without importing it
+
+    Routes are the urls passed to route, add_url_rule, register_crud, register_api and register_resource. Actors are
+    the functions decorated with actor, batch_actor or cron. When a url or an actor name is not a literal or the
+    module registers routes in other ways(see DYNAMIC_ROUTE_FUNCTIONS), the module is marked dynamic and is always
+    imported
+
+    :param file_path: Path to the python file
+    :return: Dictionary with the routes, actors and dynamic flag of the module
+    """
+    with open(file_path, 'rb') as module_file:
+        tree = ast.parse(module_file.read(), file_path)
+    routes, actors, dynamic = [], [], False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            name = _call_name(node)
+            if name in DYNAMIC_ROUTE_FUNCTIONS:
+                dynamic = True
+            elif name in ROUTE_FUNCTIONS:
+                urls = _get_route_urls(node)
+                if urls is None:
+                    dynamic = True
+                else:
+                    routes.extend(urls)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for decorator in node.decorator_list:
+                decorator_name = _call_name(decorator)
+                if decorator_name in ACTOR_DECORATORS:
+                    actor_name = node.name
+                    # actor_name is keyword only, and cron actors are always named after the function
+                    if isinstance(decorator, ast.Call) and decorator_name != 'cron':
+                        value = next((kw.value for kw in decorator.keywords if kw.arg == 'actor_name'), None)
+                        actor_name = _literal(value) if value is not None else node.name
+                    if not isinstance(actor_name, str):
+                        dynamic = True
+                    else:
+                        actors.append(actor_name)
+    return dict(routes=sorted(set(routes)), actors=sorted(set(actors)), dynamic=dynamic)
+
+
+def _directories_unchanged(directories: Dict[str, float]) -> bool:
+    try:
+        return all(os.path.getmtime(path) == mtime for path, mtime in directories.items())
+    except OSError:
+        return False
+
+
+def _read_scan_cache(cache_path: Optional[str]) -> dict:
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as cache_file:
+                return json.load(cache_file)
+        except ValueError:
+            pass
+    return {}
+
+
+def list_module_files(package_path: str, dir_path: str, exclude: List[str]=None,
+                      cache_path: Optional[str]=None) -> List[Tuple[str, str]]:
+    """
+    Returns the name and path of the python modules of a directory and its sub directories
+
+    The result is cached with the modification time of every directory scanned. Adding, removing or renaming a file
+    changes the modification time of its directory, so as long as none changed the directories are not walked again
+
+    :param package_path: Prefix to package path of directory we are scanning
+    :param dir_path: Directory to scan
+    :param exclude: List of files to exclude
+    :param cache_path: JSON file the cache is saved to so it is reused between runs
+    :return: List of module name and file path
+    """
+    exclude = default_exclude.copy() if exclude is None else exclude
+    key = '{}:{}:{}'.format(package_path, os.path.abspath(dir_path), ','.join(sorted(exclude)))
+    cached = _SCAN_CACHE.get(key, None)
+    if cached is None:
+        cached = _read_scan_cache(cache_path).get(key, None)
+    if cached is not None and _directories_unchanged(cached['directories']):
+        _SCAN_CACHE[key] = cached
+        return [tuple(module_file) for module_file in cached['files']]
+
+    module_files = []
+    directories = {}
+    for root, dirs, files in os.walk(dir_path, topdown=True):
+        directories[root] = os.path.getmtime(root)
+        p_path = package_path
+        if root != dir_path:
+            # find relative difference
+            p_path += "." + os.path.relpath(root, dir_path).replace(os.sep, ".")
+        for f in files:
+            if f.endswith('.py') and f not in exclude:
+                module_files.append(('{}.{}'.format(p_path, f[:-3]), os.path.join(root, f)))
+    _SCAN_CACHE[key] = dict(directories=directories, files=module_files)
+    if cache_path:
+        scans = _read_scan_cache(cache_path)
+        scans[key] = _SCAN_CACHE[key]
+        with open(cache_path, 'w') as cache_file:
+            json.dump(scans, cache_file, indent=1, sort_keys=True)
+    return module_files
+
+
+def prewarm_bytecode(dir_path: str, workers: int=0) -> bool:
+    """
+    Compiles the modules of a directory to bytecode in parallel so the imports do not have to. Modules whose
+    bytecode is up to date are skipped
+
+    :param dir_path: Directory to compile
+    :param workers: Number of processes. 0 uses one per CPU
+    :return: True if all the modules compiled
+    """
+    import compileall
+    return bool(compileall.compile_dir(dir_path, quiet=1, workers=workers))
+
+
+def _import_module(name: str):
+    # the time includes the first import of the module dependencies, like the cumulative time of -X importtime
+    start = perf_counter_ns()
+    module = importlib.import_module(name)
+    IMPORT_TIMES.setdefault(name, (perf_counter_ns() - start) / 1e6)
+    return module
+
+
+def get_startup_profile() -> dict:
+    """
+    Returns the time in milliseconds spent by load_modules scanning each directory and importing each module, slowest
+    modules first
+    """
+    return dict(scans=dict(SCAN_TIMES),
+                imports=sorted(IMPORT_TIMES.items(), key=lambda item: item[1], reverse=True))
+
+
+def build_manifest(package_path: str, dir_path: str, exclude: List[str]=None, manifest_path: Optional[str]=None,
+                   rebuild: bool=False, cache_path: Optional[str]=None) -> dict:
+    """
+    Returns the manifest of the modules of a directory. The manifest lists the routes and actors of every module(see
+    scan_module) along with its modification time so only modules that changed are scanned again
+
+    :param package_path: Prefix to package path of directory we are scanning
+    :param dir_path: Directory to scan
+    :param exclude: List of files to exclude
+    :param manifest_path: JSON file the manifest is read from and saved to. It can be prebuilt when building images
+    with manage build-manifest
+    :param rebuild: Ignore the saved manifest
+    :param cache_path: JSON file caching the list of modules. See list_module_files
+    :return: Manifest
+    """
+    exclude = default_exclude.copy() if exclude is None else exclude
+    previous = {}
+    if manifest_path and not rebuild and os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as manifest_file:
+                saved = json.load(manifest_file)
+            if saved.get('version', None) == MANIFEST_VERSION and saved.get('package', None) == package_path:
+                previous = saved.get('modules', {})
+        except ValueError:
+            previous = {}
+
+    modules = {}
+    changed = False
+    for name, file_path in list_module_files(package_path, dir_path, exclude, cache_path):
+        mtime = os.path.getmtime(file_path)
+        entry = previous.get(name, None)
+        if entry is None or entry.get('mtime', None) != mtime:
+            entry = dict(scan_module(file_path), path=file_path, mtime=mtime)
+            changed = True
+        modules[name] = entry
+    manifest = dict(version=MANIFEST_VERSION, package=package_path, modules=modules)
+    if manifest_path and (changed or set(previous) != set(modules)):
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    return manifest
+
+
+def _route_prefix(url: str) -> str:
+    prefix = url.split('<', 1)[0].rstrip('/')
+    return prefix if prefix.startswith('/') or not prefix else '/' + prefix
+
+
+def _matches_route(path: str, url: str) -> bool:
+    prefix = _route_prefix(url)
+    return not prefix or path == prefix or path.startswith(prefix + '/')
+
+
+def import_pending_modules(path: Optional[str]=None) -> List[str]:
+    """
+    Imports the modules found by load_modules(lazy=True) that were not imported yet
+
+    :param path: Only import the modules with a route matching this url path. All modules are imported when None
+    :return: Names of the modules imported
+    """
+    imported = []
+    with _lazy_lock:
+        for name, entry in list(LAZY_MODULES.items()):
+            if path is None or any(_matches_route(path, url) for url in entry['routes']):
+                _import_module(name)
+                LAZY_MODULES.pop(name, None)
+                imported.append(name)
+    if imported:
+        getLogger().debug('Lazily imported modules {}'.format(imported))
+    return imported
+
+
+def get_lazy_actors() -> List[str]:
+    """
+    Returns the names of the actors declared by modules that were not imported yet
+    """
+    with _lazy_lock:
+        return sorted(actor for entry in LAZY_MODULES.values() for actor in entry['actors'])
+
+
+def install_lazy_loader(app):
+    """
+    Imports lazy modules the first time a request is sent to one of their routes. Requests that do not match any
+    route are matched again once the modules declaring a matching route are imported. Modules are imported and
+    requests matched again under a lock, since the url map of flask is not thread safe while rules are added
+    """
+    if 'rse_lazy_modules' in app.extensions:
+        return
+    app.extensions['rse_lazy_modules'] = True
+    from flask import request
+    from werkzeug.exceptions import NotFound, MethodNotAllowed
+
+    @app.before_request
+    def import_lazy_modules():
+        if LAZY_MODULES and isinstance(request.routing_exception, (NotFound, MethodNotAllowed)):
+            with _lazy_lock:
+                # the modules may have been imported by another request while this one waited for the lock
+                import_pending_modules(request.path)
+                try:
+                    rule, view_args = app.create_url_adapter(request).match(return_rule=True)
+                except (NotFound, MethodNotAllowed):
+                    return
+            # flask dispatches to request.url_rule once routing_exception is cleared
+            request.url_rule, request.view_args = rule, view_args
+            request.routing_exception = None
+
+
+def load_modules(package_path: str, dir_path: str, exclude: List[str]=None, lazy: bool=False,
+                 manifest_path: Optional[str]=None, app=None, cache_path: Optional[str]=None,
+                 prewarm: bool=False) -> List[str]:
     """
     Scans a specific directory path for list of possible model files. It then will import each file as part of the
     specified package_path. For example, if a directory contains the following files
@@ -39,24 +345,55 @@ def load_modules(package_path: str, dir_path: str, exclude: List[str]=None) -> L
     :param dir_path: Directory to scan
     :type dir_path: str
     :param exclude: List of files to exclude. If value is None, the default list of '__init__.py' will be used
+    :param lazy: Only import the modules once a request is sent to one of their routes. The routes and actors of each
+    module are found without importing it(see scan_module). Modules that declare neither, or whose routes cannot be
+    determined, are imported right away. In debug mode, or when the LAZY_LOAD_MODULES setting is False, modules are
+    always imported right away since flask does not allow adding routes after the first request in debug mode.
+    workers start imports all the modules so the workers consume every queue
+    :param manifest_path: JSON file caching the routes and actors of the modules. See build_manifest
+    :param app: Flask application. Defaults to get_application()
+    :param cache_path: JSON file caching the list of modules. See list_module_files
+    :param prewarm: Compile the modules to bytecode in parallel before importing them. See prewarm_bytecode. Prefer
+    running manage build-manifest when building images
     :return: List of models loaded
     :rtype: List[str]
     """
     logger = getLogger()
-    modules = []
 
     if exclude is None:
         exclude = default_exclude.copy()
-    for root, dirs, files in os.walk(dir_path, topdown=True):
-        p_path = package_path
-        if root != dir_path:
-            # find relative difference
-            p_path += "." + os.path.relpath(root, dir_path).replace("/", ".")
-        for f in files:
-            if f.endswith('.py') and f not in exclude:
-                name = '{}.{}'.format(p_path, f.replace('.py', ''))
-                importlib.import_module(name)
-                modules.append(name)
+    if lazy:
+        if app is None:
+            from rse_api import get_application
+            app = get_application()
+        lazy = not app.debug and app.config.get('LAZY_LOAD_MODULES', True)
+    MODULE_SCANS.append(dict(package_path=package_path, dir_path=dir_path, exclude=exclude,
+                             manifest_path=manifest_path if lazy else None, cache_path=cache_path))
+    if prewarm:
+        prewarm_bytecode(dir_path)
 
-    logger.debug('Loaded Modules for package {} from {}: {}'.format(package_path, dir_path, str(modules)))
+    if not lazy:
+        start = perf_counter_ns()
+        module_files = list_module_files(package_path, dir_path, exclude, cache_path)
+        SCAN_TIMES[package_path] = (perf_counter_ns() - start) / 1e6
+        modules = []
+        for name, file_path in module_files:
+            _import_module(name)
+            modules.append(name)
+        logger.debug('Loaded Modules for package {} from {}: {}'.format(package_path, dir_path, str(modules)))
+        return modules
+
+    start = perf_counter_ns()
+    manifest = build_manifest(package_path, dir_path, exclude, manifest_path, cache_path=cache_path)
+    SCAN_TIMES[package_path] = (perf_counter_ns() - start) / 1e6
+    install_lazy_loader(app)
+    modules = []
+    for name, entry in manifest['modules'].items():
+        if entry['dynamic'] or (not entry['routes'] and not entry['actors']):
+            _import_module(name)
+        else:
+            with _lazy_lock:
+                LAZY_MODULES[name] = entry
+        modules.append(name)
+    logger.debug('Lazy Modules for package {} from {}: {}'.format(package_path, dir_path, str(modules)))
     return modules
@@ -0,0 +1,44 @@
+"""
+Compares the message rate of AppContextMiddleware pushing an application context per message against reusing one
+context per worker thread, for tiny messages on the StubBroker
+
+Run with python -m tests.benchmarks.bench_app_context
+"""
+import time
+
+import dramatiq
+from dramatiq import Worker
+from flask import g
+
+from tests.test_tasks import make_broker
+
+
+def messages_per_second(reuse_context: bool, messages: int, worker_threads: int) -> float:
+    app, broker, teardowns = make_broker(reuse_context)
+
+    @dramatiq.actor(broker=broker)
+    def tiny(i):
+        g.value = i
+
+    worker = Worker(broker, worker_timeout=100, worker_threads=worker_threads)
+    worker.start()
+    try:
+        start = time.perf_counter()
+        for i in range(messages):
+            tiny.send(i)
+        broker.join(tiny.queue_name)
+        worker.join()
+        return messages / (time.perf_counter() - start)
+    finally:
+        worker.stop()
+
+
+def bench(messages: int = 20000, worker_threads: int = 4, repeat: int = 3):
+    per_message = max(messages_per_second(False, messages, worker_threads) for _ in range(repeat))
+    reused = max(messages_per_second(True, messages, worker_threads) for _ in range(repeat))
+    print('context per message: {:10.0f} msg/s  reused context: {:10.0f} msg/s ({:.2f}x)'
+          .format(per_message, reused, reused / per_message))
+
+
+if __name__ == "__main__":
+    bench()
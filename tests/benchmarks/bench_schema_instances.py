@@ -0,0 +1,33 @@
+"""
+Compares building a schema on every request against reusing the instances cached by get_schema_instance, for the
+schemas built by a typical PUT(load then dump)
+
+Run with python -m tests.benchmarks.bench_schema_instances
+"""
+import timeit
+
+from rse_api.serializers import get_schema_instance
+from tests.test_serializers import ProjectSchema, make_projects
+
+
+def per_request_new(project):
+    data = ProjectSchema(strict=True).load({'name': project.name}, partial=True).data
+    return ProjectSchema().dump(project).data, data
+
+
+def per_request_cached(project):
+    data = get_schema_instance(ProjectSchema, strict=True).load({'name': project.name}, partial=True).data
+    return get_schema_instance(ProjectSchema).dump(project).data, data
+
+
+def bench(number: int = 5000, repeat: int = 5):
+    project = make_projects(1)[0]
+    assert per_request_new(project) == per_request_cached(project), "Outputs differ"
+    new_time = min(timeit.repeat(lambda: per_request_new(project), number=number, repeat=repeat)) / number
+    cached_time = min(timeit.repeat(lambda: per_request_cached(project), number=number, repeat=repeat)) / number
+    print('new schemas: {:8.1f} us/request  cached schemas: {:8.1f} us/request  saving: {:8.1f} us/request ({:.2f}x)'
+          .format(new_time * 1e6, cached_time * 1e6, (new_time - cached_time) * 1e6, new_time / cached_time))
+
+
+if __name__ == "__main__":
+    bench()
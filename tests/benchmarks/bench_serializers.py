@@ -0,0 +1,37 @@
+"""
+Compares the throughput of CompiledSerializer against Schema.dump on 10k objects
+
+Run with python -m tests.benchmarks.bench_serializers
+"""
+import timeit
+
+from marshmallow import Schema, fields
+
+from rse_api.serializers import CompiledSerializer, dump_data
+from tests.test_serializers import ProjectSchema, make_projects
+
+
+class FlatProjectSchema(Schema):
+    id = fields.Integer()
+    name = fields.String()
+    score = fields.Float()
+    active = fields.Boolean()
+    created_at = fields.DateTime()
+    code = fields.String()
+    status = fields.String(default='new')
+
+
+def bench(schema: Schema, objects, repeat: int = 5):
+    serializer = CompiledSerializer(schema)
+    assert serializer.dump(objects, many=True) == dump_data(schema, objects, many=True), "Outputs differ"
+    marshmallow_time = min(timeit.repeat(lambda: dump_data(schema, objects, many=True), number=1, repeat=repeat))
+    compiled_time = min(timeit.repeat(lambda: serializer.dump(objects, many=True), number=1, repeat=repeat))
+    print('{:<20} marshmallow: {:8.1f} ms ({:>9.0f} obj/s)  compiled: {:8.1f} ms ({:>9.0f} obj/s)  speedup: {:.2f}x'
+          .format(type(schema).__name__, marshmallow_time * 1000, len(objects) / marshmallow_time,
+                  compiled_time * 1000, len(objects) / compiled_time, marshmallow_time / compiled_time))
+
+
+if __name__ == "__main__":
+    projects = make_projects(10000)
+    bench(FlatProjectSchema(), projects)
+    bench(ProjectSchema(), projects)
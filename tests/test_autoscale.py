@@ -0,0 +1,100 @@
+import unittest
+from unittest import mock
+
+import dramatiq
+from dramatiq.brokers.stub import StubBroker
+from dramatiq.middleware import default_middleware, Prometheus
+
+from rse_api.tasks.autoscale import AutoscaleSupervisor, ScaleDecision, decide_scale, get_process_factory, \
+    get_queue_depth
+
+
+class FakeProcess:
+    def __init__(self, target, args, daemon):
+        self.args = args
+        self.alive = False
+
+    def start(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def terminate(self):
+        self.alive = False
+
+    def join(self):
+        pass
+
+
+def make_broker():
+    broker = StubBroker(middleware=[m() for m in default_middleware if m is not Prometheus])
+
+    @dramatiq.actor(broker=broker)
+    def task(i):
+        pass
+    return broker, task
+
+
+class TestAutoscale(unittest.TestCase):
+
+    def test_decide_scale(self):
+        # idle queues keep the minimum
+        self.assertEqual(decide_scale(3, 0, 0.1, min_processes=1, max_processes=4), ScaleDecision(1, 8))
+        # backlog of I/O bound work adds processes with many threads
+        self.assertEqual(decide_scale(1, 200, 0.1, min_processes=1, max_processes=4), ScaleDecision(3, 8))
+        self.assertEqual(decide_scale(1, 10000, 0.1, min_processes=1, max_processes=4), ScaleDecision(4, 8))
+        # CPU bound work uses fewer threads per process
+        self.assertEqual(decide_scale(1, 25, 0.7, min_processes=1, max_processes=4), ScaleDecision(3, 1))
+        # saturated CPUs do not add processes
+        self.assertEqual(decide_scale(2, 10000, 1.5, min_processes=1, max_processes=4), ScaleDecision(2, 1))
+
+    def test_queue_depth(self):
+        broker, task = make_broker()
+        for i in range(5):
+            task.send(i)
+        task.send_with_options(args=(5,), delay=60000)
+        self.assertEqual(get_queue_depth(broker), 6)
+        self.assertEqual(get_queue_depth(broker, ['other']), 0)
+
+    def test_process_factory(self):
+        with mock.patch('multiprocessing.get_all_start_methods', return_value=['spawn']):
+            with self.assertRaises(NotImplementedError):
+                get_process_factory()
+        with mock.patch('multiprocessing.get_all_start_methods', return_value=['fork', 'spawn']), \
+                mock.patch('multiprocessing.get_context') as get_context:
+            self.assertIs(get_process_factory(), get_context.return_value.Process)
+            get_context.assert_called_once_with('fork')
+
+    def test_supervisor(self):
+        broker, task = make_broker()
+        supervisor = AutoscaleSupervisor(broker, min_processes=1, max_processes=4, messages_per_thread=1,
+                                         max_threads=2, scale_up_cooldown=10, scale_down_cooldown=100,
+                                         process_factory=FakeProcess)
+        with mock.patch('rse_api.tasks.autoscale.get_cpu_load', return_value=0.1):
+            supervisor.step(now=1000)
+            self.assertEqual(len(supervisor.processes), 1)
+
+            for i in range(8):
+                task.send(i)
+            # scale ups wait for the cooldown
+            supervisor.step(now=1005)
+            self.assertEqual(len(supervisor.processes), 1)
+            supervisor.step(now=1010)
+            self.assertEqual(len(supervisor.processes), 4)
+            self.assertEqual(supervisor.processes[-1].args[2], 2)
+
+            broker.flush_all()
+            # scale downs wait for the cooldown and remove one process at a time
+            supervisor.step(now=1050)
+            self.assertEqual(len(supervisor.processes), 4)
+            supervisor.step(now=1110)
+            self.assertEqual(len(supervisor.processes), 3)
+            supervisor.step(now=1111)
+            self.assertEqual(len(supervisor.processes), 3)
+
+            # dead processes are replaced
+            for process in supervisor.processes:
+                process.alive = False
+            supervisor.step(now=1112)
+            self.assertEqual(len(supervisor.processes), 1)
@@ -0,0 +1,78 @@
+import threading
+import time
+import unittest
+
+from flask import Response, jsonify, request
+
+from rse_api import get_application
+from rse_api.cache import MemoryCache, invalidate_response_cache
+from rse_api.decorators import cached_response
+
+
+class TestCache(unittest.TestCase):
+
+    def test_memory_cache(self):
+        cache = MemoryCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # b was the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertFalse(cache.add('a', 10))
+        self.assertTrue(cache.add('b', 20))
+
+        cache.set('short', 1, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('short'))
+        self.assertTrue(cache.add('short', 2))
+
+    def test_memory_cache_add_is_atomic(self):
+        cache = MemoryCache()
+        threads = 8
+        for trial in range(50):
+            barrier = threading.Barrier(threads)
+            added = []
+
+            def add(i):
+                barrier.wait()
+                if cache.add('lock', i):
+                    added.append(i)
+
+            workers = [threading.Thread(target=add, args=(i,)) for i in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.assertEqual(len(added), 1)
+            self.assertFalse(cache.delete_if('lock', -1))
+            self.assertTrue(cache.delete_if('lock', added[0]))
+            self.assertIsNone(cache.get('lock'))
+
+    def test_cached_response(self):
+        app = get_application()
+        calls = []
+        cache = MemoryCache()
+
+        @app.route('/test_cached_response/<int:id>', methods=['GET'])
+        @cached_response(namespace='test_cached', vary_headers=['Authorization'], cache=cache)
+        def cached_response_fn(id):
+            calls.append(id)
+            return jsonify(dict(id=id, call=len(calls), q=request.args.get('q')))
+
+        client = app.test_client()
+        result: Response = client.get('/test_cached_response/1')
+        self.assertEqual(result.json['call'], 1)
+        result: Response = client.get('/test_cached_response/1')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['call'], 1)
+
+        self.assertEqual(client.get('/test_cached_response/2').json['call'], 2)
+        self.assertEqual(client.get('/test_cached_response/1?q=x').json['call'], 3)
+        self.assertEqual(client.get('/test_cached_response/1', headers={'Authorization': 'x'}).json['call'], 4)
+        self.assertEqual(len(calls), 4)
+
+        invalidate_response_cache('test_cached', cache=cache)
+        self.assertEqual(client.get('/test_cached_response/1').json['call'], 5)
+        self.assertEqual(client.get('/test_cached_response/1').json['call'], 5)
@@ -0,0 +1,48 @@
+import unittest
+from unittest import mock
+
+from flask import Flask
+
+from rse_api.cli import add_cli
+
+
+def make_app():
+    app = Flask(__name__)
+    add_cli(app)
+    return app
+
+
+class TestCli(unittest.TestCase):
+
+    def test_serve_gunicorn(self):
+        app = make_app()
+        with mock.patch('rse_api.cli.run_gunicorn') as run_gunicorn, mock.patch('rse_api.cli.HAS_GUNICORN', True):
+            result = app.test_cli_runner().invoke(args=['manage', 'serve', '--server', 'gunicorn', '--workers', '3',
+                                                        '--threads', '2', '--worker-class', 'gthread',
+                                                        '--keep-alive', '10', '--backlog', '64'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        run_gunicorn.assert_called_once_with(app, '127.0.0.1', 5000, 3, 2, 'gthread', 10, 64, 30)
+
+    def test_serve_waitress(self):
+        app = make_app()
+        with mock.patch('rse_api.cli.run_waitress') as run_waitress, mock.patch('rse_api.cli.HAS_WAITRESS', True):
+            result = app.test_cli_runner().invoke(args=['manage', 'serve', '--server', 'waitress', '--port', '8000'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        run_waitress.assert_called_once_with(app, '127.0.0.1', 8000, 4, 5, 2048)
+
+    def test_serve_without_server(self):
+        app = make_app()
+        with mock.patch('rse_api.cli.HAS_GUNICORN', False), mock.patch('rse_api.cli.HAS_WAITRESS', False):
+            result = app.test_cli_runner().invoke(args=['manage', 'serve'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('No production server', result.output)
+
+    def test_startup_profile(self):
+        app = make_app()
+        with mock.patch.dict('rse_api.utils.IMPORT_TIMES', {'app.fast': 1.0, 'app.slow': 30.0}, clear=True), \
+                mock.patch.dict('rse_api.utils.SCAN_TIMES', {'app': 2.0}, clear=True):
+            result = app.test_cli_runner().invoke(args=['manage', 'startup-profile', '--limit', '1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('app.slow', result.output)
+        self.assertNotIn('app.fast', result.output)
+        self.assertIn('Total(ms): 33.00', result.output)
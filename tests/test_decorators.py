@@ -1,3 +1,5 @@
+import json
+import threading
 import time
 import unittest
 import os
@@ -42,6 +44,46 @@ class TestDecorator(unittest.TestCase):
         self.assertNotEqual(x2, x4)
         self.assertEqual(x, x3)
 
+    def test_singleton_function_threads(self):
+        calls = []
+
+        @singleton_function
+        def slow():
+            calls.append(1)
+            time.sleep(0.05)
+            return object()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(id(r) for r in results)), 1)
+
+        slow.cache_clear()
+        self.assertIsNot(slow(), results[0])
+        self.assertEqual(len(calls), 2)
+
+    def test_singleton_function_arguments(self):
+        @singleton_function(keyed=True)
+        def keyed(name, suffix=''):
+            return object()
+
+        self.assertIs(keyed('a'), keyed('a'))
+        self.assertIsNot(keyed('a'), keyed('b'))
+        self.assertIsNot(keyed('a'), keyed('a', suffix='x'))
+
+        @singleton_function
+        def first(name=None):
+            return name
+
+        self.assertEqual(first('a'), 'a')
+        self.assertEqual(first(), 'a')
+        with self.assertWarns(RuntimeWarning):
+            self.assertEqual(first('b'), 'a')
+
     @requires_fixture('person')
     def test_schema_in(self, person):
         app = get_application()
@@ -135,4 +177,98 @@ class TestDecorator(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertEqual(list(data.keys()), ['name'])
         for k, v in data.items():
-            self.assertEqual(person[k].replace(" ", "_"), v)
\ No newline at end of file
+            self.assertEqual(person[k].replace(" ", "_"), v)
+
+    @requires_fixture('person')
+    def test_schema_out_stream(self, person):
+        app = get_application()
+        people = [dict(person, age=i) for i in range(25)]
+
+        @app.route('/test_schema_out_stream', methods=['GET'])
+        @schema_out(PersonSchema(), stream=True, chunk_size=10)
+        def schema_out_stream_fn():
+            return (p for p in people)
+
+        @app.route('/test_schema_out_stream_ndjson', methods=['GET'])
+        @schema_out(PersonSchema(), stream=True, ndjson=True, chunk_size=10)
+        def schema_out_stream_ndjson_fn():
+            return iter(people)
+
+        @app.route('/test_schema_out_stream_empty', methods=['GET'])
+        @schema_out(PersonSchema(), stream=True)
+        def schema_out_stream_empty_fn():
+            return []
+
+        client = app.test_client()
+
+        result: Response = client.get('/test_schema_out_stream')
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.is_streamed)
+        self.assertEqual([p['age'] for p in result.json], list(range(25)))
+
+        result: Response = client.get('/test_schema_out_stream_ndjson')
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        lines = result.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['age'] for line in lines], list(range(25)))
+
+        result: Response = client.get('/test_schema_out_stream_empty')
+        self.assertEqual(result.json, [])
+
+    @requires_fixture('person')
+    def test_schema_out_etag(self, person):
+        app = get_application()
+
+        class Versioned:
+            def __init__(self, version):
+                self.id = 1
+                self.name = person['name']
+                self.age = person['age']
+                self.version = version
+
+        @app.route('/test_schema_out_etag', methods=['GET'])
+        @schema_out(PersonSchema(), etag=True)
+        def schema_out_etag_fn():
+            return person
+
+        @app.route('/test_schema_out_etag_model/<int:version>', methods=['GET'])
+        @schema_out(PersonSchema(), etag=True)
+        def schema_out_etag_model_fn(version):
+            return Versioned(version)
+
+        client = app.test_client()
+
+        result: Response = client.get('/test_schema_out_etag')
+        self.assertEqual(result.status_code, 200)
+        etag = result.headers['ETag']
+        result: Response = client.get('/test_schema_out_etag', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.data, b'')
+
+        result: Response = client.get('/test_schema_out_etag_model/1')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['name'], person['name'])
+        etag = result.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        result: Response = client.get('/test_schema_out_etag_model/1', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+        result: Response = client.get('/test_schema_out_etag_model/2', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 200)
+
+    @requires_fixture('person')
+    def test_schema_out_sparse_fields(self, person):
+        app = get_application()
+
+        @app.route('/test_schema_out_sparse_fields', methods=['GET'])
+        @schema_out(PersonSchema(), sparse_fields=True)
+        def schema_out_sparse_fields_fn():
+            return person
+
+        client = app.test_client()
+
+        result: Response = client.get('/test_schema_out_sparse_fields?fields=name')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json, {'name': person['name']})
+        result: Response = client.get('/test_schema_out_sparse_fields')
+        self.assertEqual(set(result.json.keys()), {'name', 'age'})
+        result: Response = client.get('/test_schema_out_sparse_fields?fields=name,password')
+        self.assertEqual(result.status_code, 400)
@@ -0,0 +1,133 @@
+import time
+import unittest
+
+import dramatiq
+from dramatiq import Worker
+from dramatiq.brokers.stub import StubBroker
+from dramatiq.middleware import default_middleware, Prometheus
+from dramatiq.results import Results
+from dramatiq.results.backends import StubBackend
+
+from rse_api.cache import MemoryCache
+from rse_api.tasks.idempotent import IdempotentResults, get_idempotency_key
+
+
+class TestIdempotentResults(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StubBroker(middleware=[m() for m in default_middleware if m is not Prometheus])
+        self.idempotent = IdempotentResults(MemoryCache(max_size=10), retry_delay=50)
+        self.results = StubBackend()
+        self.broker.add_middleware(Results(backend=self.results))
+        self.broker.add_middleware(self.idempotent)
+        self.calls = []
+
+    def run_worker(self, actor, threads=1):
+        worker = Worker(self.broker, worker_timeout=50, worker_threads=threads)
+        worker.start()
+        self.broker.join(actor.queue_name)
+        worker.join()
+        worker.stop()
+
+    def test_key(self):
+        self.assertEqual(get_idempotency_key('add', (1, 2), {'b': 1, 'a': 2}),
+                         get_idempotency_key('add', [1, 2], {'a': 2, 'b': 1}))
+        self.assertNotEqual(get_idempotency_key('add', (1, 2)), get_idempotency_key('add', (2, 1)))
+
+    def test_stored_result(self):
+        @dramatiq.actor(broker=self.broker, idempotent=True, store_results=True)
+        def add(x, y):
+            self.calls.append((x, y))
+            return x + y
+
+        first = add.send(1, 2)
+        self.run_worker(add)
+        second = add.send(1, 2)
+        add.send(2, 2)
+        self.run_worker(add)
+
+        self.assertEqual(self.calls, [(1, 2), (2, 2)])
+        self.assertEqual(self.idempotent.get_result(add, 1, 2), 3)
+        # the skipped message gets the stored result
+        self.assertEqual(first.get_result(backend=self.results), 3)
+        self.assertEqual(second.get_result(backend=self.results), 3)
+
+    def test_concurrent_duplicates(self):
+        @dramatiq.actor(broker=self.broker, idempotent=True)
+        def slow(x):
+            self.calls.append(x)
+            time.sleep(0.2)
+            return x
+
+        for _ in range(4):
+            slow.send(1)
+        self.run_worker(slow, threads=4)
+        self.assertEqual(self.calls, [1])
+
+    def test_failures_are_not_stored(self):
+        @dramatiq.actor(broker=self.broker, idempotent=True, max_retries=0)
+        def flaky(x):
+            self.calls.append(x)
+            if len(self.calls) == 1:
+                raise ValueError()
+            return x
+
+        flaky.send(1)
+        self.run_worker(flaky)
+        self.assertIsNone(self.idempotent.get_result(flaky, 1))
+        flaky.send(1)
+        self.run_worker(flaky)
+        self.assertEqual(self.calls, [1, 1])
+        self.assertEqual(self.idempotent.get_result(flaky, 1), 1)
+
+    def test_max_result_size(self):
+        self.idempotent.max_result_size = 100
+
+        @dramatiq.actor(broker=self.broker, idempotent=True, idempotent_key=lambda size: str(size))
+        def build(size):
+            self.calls.append(size)
+            return 'x' * size
+
+        build.send(10)
+        build.send(1000)
+        self.run_worker(build)
+        self.assertEqual(self.idempotent.get_result(build, 10), 'x' * 10)
+        self.assertIsNone(self.idempotent.get_result(build, 1000))
+
+    def test_duplicate_backoff(self):
+        @dramatiq.actor(broker=self.broker, idempotent=True)
+        def slow(x):
+            self.calls.append(x)
+            return x
+
+        delays = []
+        enqueue = self.broker.enqueue
+
+        def record_enqueue(message, *, delay=None):
+            if delay is not None:
+                delays.append((message.options['idempotent_attempts'], delay))
+            return enqueue(message, delay=delay)
+
+        self.broker.enqueue = record_enqueue
+        self.idempotent.max_attempts = 3
+        # another process holds the lock until the duplicate gives up
+        self.idempotent.cache.add(get_idempotency_key('slow', (1,)) + ':lock', 'other', ttl=60)
+        slow.send(1)
+        self.run_worker(slow)
+
+        self.assertEqual(self.calls, [])
+        self.assertEqual(delays, [(1, 50), (2, 100), (3, 200)])
+        self.assertEqual(self.broker.dead_letters[0].options['idempotent_attempts'], 3)
+
+    def test_expired_lock_is_not_released(self):
+        key = get_idempotency_key('slow', (1,))
+
+        @dramatiq.actor(broker=self.broker, idempotent=True)
+        def slow(x):
+            # the lock expired and another message took it
+            self.idempotent.cache.set(key + ':lock', 'other')
+            return x
+
+        slow.send(1)
+        self.run_worker(slow)
+        self.assertEqual(self.idempotent.cache.get(key + ':lock'), 'other')
@@ -0,0 +1,76 @@
+import datetime
+import decimal
+import json
+import unittest
+import uuid
+
+import pytest
+from flask import Flask, jsonify, request
+
+from rse_api.json_backend import HAS_ORJSON, get_json_backend, register_json_backend
+
+PAYLOAD = {
+    'name': 'café',
+    'created': datetime.datetime(2019, 1, 2, 3, 4, 5),
+    'day': datetime.date(2019, 1, 2),
+    'id': uuid.UUID('12345678123456781234567812345678'),
+    'price': decimal.Decimal('1.5'),
+    'big': 2 ** 70,
+    'nested': [{'b': 1, 'a': None}]
+}
+
+
+def make_app(backend):
+    app = Flask(__name__)
+    register_json_backend(app, backend)
+
+    @app.route('/echo', methods=['POST'])
+    def echo():
+        return jsonify(request.json)
+
+    @app.route('/payload')
+    def payload():
+        return jsonify(PAYLOAD)
+    return app
+
+
+class TestJsonBackend(unittest.TestCase):
+
+    def test_stdlib_backend(self):
+        self.assertEqual(get_json_backend('json'), ('json', None, None))
+        with self.assertRaises(ValueError):
+            get_json_backend('not a backend')
+
+    @pytest.mark.skipif(not HAS_ORJSON, reason='orjson is not installed')
+    def test_orjson_backend(self):
+        self.assertEqual(get_json_backend()[0], 'orjson')
+        app = make_app('orjson')
+        client = app.test_client()
+
+        data = client.get('/payload').json
+        self.assertEqual(data['created'], 'Wed, 02 Jan 2019 03:04:05 GMT')
+        self.assertEqual(data['id'], '12345678-1234-5678-1234-567812345678')
+        self.assertEqual(data['price'], 1.5)
+        self.assertEqual(data['big'], 2 ** 70)
+        self.assertEqual(data['name'], 'café')
+
+        body = {'a': [1, 2.5, 'x', None, True], 'b': {'c': 'd'}}
+        result = client.post('/echo', data=json.dumps(body), content_type='application/json')
+        self.assertEqual(result.json, body)
+
+        result = client.post('/echo', data='{"a": ', content_type='application/json')
+        self.assertEqual(result.status_code, 400)
+
+        result = client.post('/echo', data='{"a": NaN}', content_type='application/json')
+        self.assertEqual(result.status_code, 200)
+
+    @pytest.mark.skipif(not HAS_ORJSON, reason='orjson is not installed')
+    def test_ensure_ascii(self):
+        app = make_app('orjson')
+        body = json.dumps({'name': 'café'})
+        result = app.test_client().post('/echo', data=body, content_type='application/json')
+        # JSON_AS_ASCII is True by default
+        self.assertIn(b'"caf\\u00e9"', result.data)
+        app.config['JSON_AS_ASCII'] = False
+        result = app.test_client().post('/echo', data=body, content_type='application/json')
+        self.assertIn('"café"'.encode('utf-8'), result.data)
@@ -0,0 +1,59 @@
+import json
+import unittest
+
+from flask import Flask
+from marshmallow import Schema
+from marshmallow.fields import String
+
+from rse_api.decorators import schema_in_out
+from rse_api.metrics import Histogram, register_metrics, get_metrics_registry, PROMETHEUS_CONTENT_TYPE
+
+
+class NameSchema(Schema):
+    name = String(required=True)
+
+
+def make_app():
+    app = Flask(__name__)
+    register_metrics(app)
+
+    @app.route('/names', methods=['POST'])
+    @schema_in_out(NameSchema(), NameSchema())
+    def create_name(data):
+        return data
+    return app
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram((1, 5))
+        for value in [0.5, 1, 3, 10]:
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.sum, 14.5)
+        self.assertEqual(histogram.count, 4)
+
+    def test_metrics_endpoint(self):
+        app = make_app()
+        self.assertIs(register_metrics(app), get_metrics_registry(app))
+        client = app.test_client()
+        body = json.dumps({'name': 'someone'})
+        for _ in range(3):
+            self.assertEqual(client.post('/names', data=body, content_type='application/json').status_code, 200)
+        self.assertEqual(client.get('/names').status_code, 405)
+        client.get('/missing')
+
+        result = client.get('/metrics')
+        self.assertEqual(result.content_type, PROMETHEUS_CONTENT_TYPE)
+        text = result.data.decode('utf-8')
+        self.assertIn('rse_api_requests_total{endpoint="create_name",method="POST",status="200"} 3', text)
+        self.assertIn('rse_api_requests_total{endpoint="unmatched",method="GET",status="404"} 1', text)
+        self.assertIn('rse_api_requests_total{endpoint="unmatched",method="GET",status="405"} 1', text)
+        self.assertIn('rse_api_request_duration_seconds_count{endpoint="create_name",method="POST"} 3', text)
+        self.assertIn('rse_api_request_duration_seconds_bucket{endpoint="create_name",method="POST",le="+Inf"} 3',
+                      text)
+        self.assertIn('rse_api_request_size_bytes_sum{endpoint="create_name"} ' + repr(float(3 * len(body))), text)
+        for phase in ['schema_load', 'handler', 'schema_dump', 'json_encode']:
+            self.assertIn('rse_api_request_phase_seconds_count{{endpoint="create_name",phase="{}"}}'.format(phase),
+                          text)
@@ -0,0 +1,40 @@
+import unittest
+
+from rse_api.tasks.pools import PoolSupervisor, WorkerPool, get_worker_pools
+from tests.test_autoscale import FakeProcess, make_broker
+
+
+class TestWorkerPools(unittest.TestCase):
+
+    def test_get_worker_pools(self):
+        declared = ['default', 'default.DQ', 'simulations', 'simulations.DQ', 'emails']
+        pools = get_worker_pools([
+            dict(name='simulations', queues=['simulations'], threads=2, prefetch=1),
+            dict(name='other', processes=2),
+        ], declared)
+        self.assertEqual(pools, [WorkerPool('simulations', ['simulations'], 1, 2, 1),
+                                 WorkerPool('other', ['default', 'emails'], 2, 8, None)])
+
+    def test_invalid_pools(self):
+        with self.assertRaises(ValueError):
+            get_worker_pools([dict(name='a', queues=['default']), dict(name='b', queues=['default'])], ['default'])
+        with self.assertRaises(ValueError):
+            get_worker_pools([dict(name='a', concurrency=2)], ['default'])
+
+    def test_supervisor(self):
+        broker, task = make_broker()
+        pools = [WorkerPool('fast', ['default'], 2, 16, None), WorkerPool('slow', ['slow'], 1, 1, 1)]
+        supervisor = PoolSupervisor(broker, pools, process_factory=FakeProcess)
+        supervisor.step()
+        self.assertEqual([process.args[1:] for process in supervisor.processes['fast']],
+                         [(['default'], 16, None)] * 2)
+        self.assertEqual([process.args[1:] for process in supervisor.processes['slow']], [(['slow'], 1, 1)])
+
+        # dead processes are restarted
+        supervisor.processes['slow'][0].alive = False
+        supervisor.step()
+        self.assertEqual(len(supervisor.processes['slow']), 1)
+        self.assertTrue(supervisor.processes['slow'][0].is_alive())
+
+        supervisor.stop()
+        self.assertEqual(supervisor.processes, {'fast': [], 'slow': []})
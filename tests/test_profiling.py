@@ -0,0 +1,74 @@
+import unittest
+
+from flask import Flask
+
+from rse_api.profiling import Profiler, profiled, register_profiling
+
+
+def make_app(profiler, env='development', **config):
+    app = Flask(__name__)
+    app.env = env
+    app.config.update(config)
+    register_profiling(app, profiler)
+
+    @profiled(name='square', profiler=profiler)
+    def square(x):
+        return x * x
+
+    @app.route('/square/<int:x>')
+    def square_view(x):
+        return str(square(x))
+    return app, square
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_disabled(self):
+        profiler = Profiler()
+        app, square = make_app(profiler)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(profiler.stats(), {})
+
+    def test_enabled_with_sampling(self):
+        profiler = Profiler()
+        app, square = make_app(profiler, PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=2)
+        for i in range(10):
+            square(i)
+        stats = profiler.stats()['square']
+        self.assertEqual(stats['count'], 10)
+        self.assertLessEqual(stats['min_ms'], stats['p50_ms'])
+        self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+        self.assertLessEqual(stats['p99_ms'], stats['max_ms'])
+        self.assertIn('function calls', profiler.profile_text('square'))
+
+        client = app.test_client()
+        result = client.get('/_profiling')
+        self.assertEqual(result.json['functions']['square']['count'], 10)
+        self.assertEqual(client.delete('/_profiling').status_code, 204)
+        self.assertEqual(profiler.stats(), {})
+
+    def test_request_header(self):
+        profiler = Profiler()
+        app, square = make_app(profiler)
+        client = app.test_client()
+        result = client.get('/square/3')
+        self.assertEqual(result.data, b'9')
+        self.assertNotIn('Server-Timing', result.headers)
+
+        result = client.get('/square/3', headers={'X-Profile': '1'})
+        self.assertIn('square;dur=', result.headers['Server-Timing'])
+        self.assertEqual(profiler.active_requests, 0)
+        self.assertIn('request GET square_view', profiler.profile_names())
+
+    def test_production(self):
+        profiler = Profiler()
+        app, square = make_app(profiler, env='production')
+        client = app.test_client()
+        self.assertNotIn('Server-Timing', client.get('/square/3', headers={'X-Profile': '1'}).headers)
+        self.assertEqual(client.get('/_profiling').status_code, 404)
+
+        app, square = make_app(Profiler(), env='production', PROFILING_ENABLED=True, PROFILING_ENDPOINT='/_stats')
+        self.assertEqual(app.test_client().get('/_stats').json, {'functions': {}, 'profiles': {}})
+
+        app, square = make_app(Profiler(), PROFILING_ENDPOINT=None)
+        self.assertEqual(app.test_client().get('/_profiling').status_code, 404)
@@ -0,0 +1,275 @@
+import datetime
+import unittest
+from importlib import util
+
+import pytest
+
+from rse_api import get_application
+from rse_api.errors import RSEApiException
+from rse_api.query import encode_cursor, decode_cursor, get_cursor_from_request, keyset_paginate, COUNT_CACHE, \
+    count_query, get_count_mode_from_request, paginate_query, get_fields_from_request, apply_sparse_fieldset, \
+    get_eager_load_options, register_query_counter, get_filters_from_request, get_sort_from_request, \
+    get_indexed_columns, apply_filters, apply_sort, _parse_datetime
+
+HAS_SQLALCHEMY = util.find_spec('sqlalchemy') is not None
+
+
+def get_person_session(count=25):
+    from sqlalchemy import create_engine, Column, Integer, String
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+
+    class Person(Base):
+        __tablename__ = 'people'
+        id = Column(Integer, primary_key=True)
+        name = Column(String, index=True)
+        age = Column(Integer)
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([Person(id=i, name='person {:02d}'.format(i), age=20 + i % 10) for i in range(1, count + 1)])
+    session.commit()
+    return Person, session
+
+
+def get_project_session(count=10):
+    from sqlalchemy import create_engine, Column, Integer, String, ForeignKey
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker, relationship
+
+    Base = declarative_base()
+
+    class Owner(Base):
+        __tablename__ = 'owners'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+
+    class Project(Base):
+        __tablename__ = 'projects'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        owner_id = Column(Integer, ForeignKey('owners.id'))
+        owner = relationship(Owner)
+        tasks = relationship('Task')
+
+    class Task(Base):
+        __tablename__ = 'tasks'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        project_id = Column(Integer, ForeignKey('projects.id'))
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    for i in range(1, count + 1):
+        project = Project(id=i, name='project {}'.format(i), owner=Owner(id=i, name='owner {}'.format(i)))
+        project.tasks = [Task(name='task {}'.format(j)) for j in range(3)]
+        session.add(project)
+    session.commit()
+    session.expunge_all()
+    return Project, session, engine
+
+
+def get_project_schema():
+    from marshmallow import Schema, fields
+
+    class OwnerSchema(Schema):
+        name = fields.String()
+
+    class TaskSchema(Schema):
+        name = fields.String()
+
+    class ProjectSchema(Schema):
+        name = fields.String()
+        owner = fields.Nested(OwnerSchema)
+        tasks = fields.List(fields.Nested(TaskSchema))
+    return ProjectSchema
+
+
+class TestQuery(unittest.TestCase):
+
+    def test_cursor_round_trip(self):
+        for value in [1, 'abc', 10.5]:
+            token = encode_cursor(value)
+            self.assertNotIn('=', token)
+            self.assertEqual(decode_cursor(token), value)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(RSEApiException):
+            decode_cursor('not a cursor')
+
+    def test_get_cursor_from_request(self):
+        app = get_application()
+        with app.test_request_context('/people?after={}&per_page=10'.format(encode_cursor(5))):
+            self.assertEqual(get_cursor_from_request(), dict(after=5, before=None, per_page=10))
+        for url in ['/people?after={0}&before={0}'.format(encode_cursor(5)), '/people?per_page=-5',
+                    '/people?per_page=0', '/people?per_page=abc']:
+            with app.test_request_context(url):
+                with self.assertRaises(RSEApiException):
+                    get_cursor_from_request()
+
+    @pytest.mark.skipif(not HAS_SQLALCHEMY, reason='sqlalchemy is not installed')
+    def test_keyset_paginate(self):
+        Person, session = get_person_session()
+        query = session.query(Person)
+
+        page = keyset_paginate(query, Person.id, per_page=10)
+        self.assertEqual([p.id for p in page.items], list(range(1, 11)))
+        self.assertIsNone(page.prev_cursor)
+
+        page = keyset_paginate(query, Person.id, after=decode_cursor(page.next_cursor), per_page=10)
+        self.assertEqual([p.id for p in page.items], list(range(11, 21)))
+
+        last = keyset_paginate(query, Person.id, after=decode_cursor(page.next_cursor), per_page=10)
+        self.assertEqual([p.id for p in last.items], list(range(21, 26)))
+        self.assertIsNone(last.next_cursor)
+
+        page = keyset_paginate(query, Person.id, before=decode_cursor(last.prev_cursor), per_page=10)
+        self.assertEqual([p.id for p in page.items], list(range(11, 21)))
+        self.assertIsNotNone(page.prev_cursor)
+        self.assertIsNotNone(page.next_cursor)
+
+    def test_get_count_mode_from_request(self):
+        app = get_application()
+        with app.test_request_context('/people'):
+            self.assertEqual(get_count_mode_from_request('cached'), 'cached')
+        with app.test_request_context('/people?count=exact'):
+            self.assertEqual(get_count_mode_from_request('none'), 'exact')
+        with app.test_request_context('/people?count=estimate'):
+            with self.assertRaises(RSEApiException):
+                get_count_mode_from_request()
+
+    @pytest.mark.skipif(not HAS_SQLALCHEMY, reason='sqlalchemy is not installed')
+    def test_paginate_query_count_modes(self):
+        Person, session = get_person_session()
+        query = session.query(Person).order_by(Person.id)
+
+        page = paginate_query(query, page=2, per_page=10)
+        self.assertEqual([p.id for p in page.items], list(range(11, 21)))
+        self.assertEqual(page.total, 25)
+        self.assertEqual(page.pages, 3)
+
+        page = paginate_query(query, page=2, per_page=10, count='none')
+        self.assertIsNone(page.total)
+        self.assertIsNone(page.pages)
+
+        # a single page does not need a count
+        self.assertEqual(paginate_query(query, page=1, per_page=50, count='none').total, 25)
+
+    @pytest.mark.skipif(not HAS_SQLALCHEMY, reason='sqlalchemy is not installed')
+    def test_cached_count(self):
+        Person, session = get_person_session()
+        COUNT_CACHE.clear()
+        query = session.query(Person)
+        filtered = query.filter(Person.age > 25)
+        self.assertEqual(count_query(query, 'cached', 'people'), 25)
+        self.assertEqual(count_query(filtered, 'cached', 'people', filtered=True), 8)
+
+        session.add(Person(id=100, name='person 100', age=50))
+        session.commit()
+        self.assertEqual(count_query(query, 'cached', 'people'), 25)
+        self.assertEqual(count_query(filtered, 'cached', 'people', filtered=True), 8)
+        self.assertEqual(count_query(query, 'exact', 'people'), 26)
+        # sqlite has no statistics so estimates are served from the cache
+        self.assertEqual(count_query(query, 'estimate', 'people'), 25)
+
+    def test_get_fields_from_request(self):
+        app = get_application()
+        with app.test_request_context('/people?fields=name, age,,name'):
+            self.assertEqual(get_fields_from_request(), ['name', 'age'])
+        with app.test_request_context('/people'):
+            self.assertIsNone(get_fields_from_request())
+
+    @pytest.mark.skipif(not HAS_SQLALCHEMY, reason='sqlalchemy is not installed')
+    def test_apply_sparse_fieldset(self):
+        from sqlalchemy import inspect
+        Person, session = get_person_session()
+        person = apply_sparse_fieldset(session.query(Person), Person, ['name']).first()
+        self.assertEqual(inspect(person).unloaded, {'age'})
+        self.assertEqual(person.id, 1)
+
+    @pytest.mark.skipif(not HAS_SQLALCHEMY, reason='sqlalchemy is not installed')
+    def test_eager_load_options(self):
+        from sqlalchemy import event
+        Project, session, engine = get_project_session()
+        schema = get_project_schema()()
+        statements = []
+        event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        options = get_eager_load_options(Project, schema)
+        self.assertEqual(len(options), 2)
+        self.assertIs(options, get_eager_load_options(Project, schema))
+        projects = session.query(Project).options(*options).all()
+        expected = schema.dump(projects, many=True).data
+        # one query for the projects and owners and one for the tasks
+        self.assertEqual(len(statements), 2)
+
+        session.expunge_all()
+        del statements[:]
+        self.assertEqual(schema.dump(session.query(Project).all(), many=True).data, expected)
+        self.assertEqual(len(statements), 21)
+
+        self.assertEqual(get_eager_load_options(Project, get_project_schema()(only=['name'])), [])
+
+    @pytest.mark.skipif(not HAS_SQLALCHEMY, reason='sqlalchemy is not installed')
+    def test_query_counter(self):
+        from flask import Flask, jsonify
+        Project, session, engine = get_project_session()
+        app = Flask(__name__)
+        register_query_counter(app, threshold=5)
+
+        @app.route('/projects')
+        def projects():
+            session.expunge_all()
+            return jsonify([p.owner.name for p in session.query(Project).all()])
+
+        with self.assertLogs(app.logger, 'WARNING'):
+            result = app.test_client().get('/projects')
+        self.assertEqual(result.headers['X-Query-Count'], '11')
+
+    def test_get_filters_and_sort_from_request(self):
+        app = get_application()
+        with app.test_request_context('/people?filter[name]=a&filter[age][ge]=18&sort=-age, name&page=2'):
+            self.assertEqual(get_filters_from_request(), [('name', 'eq', 'a'), ('age', 'ge', '18')])
+            self.assertEqual(get_sort_from_request(), [('age', True), ('name', False)])
+        for url in ['/people?filter[name][drop]=a', '/people?filter[name]]=a']:
+            with app.test_request_context(url):
+                with self.assertRaises(RSEApiException):
+                    get_filters_from_request()
+
+    def test_parse_datetime(self):
+        self.assertEqual(_parse_datetime('2020-01-02'), datetime.datetime(2020, 1, 2))
+        self.assertEqual(_parse_datetime('2020-01-02T03:04'), datetime.datetime(2020, 1, 2, 3, 4))
+        self.assertEqual(_parse_datetime('2020-01-02 03:04:05.5'), datetime.datetime(2020, 1, 2, 3, 4, 5, 500000))
+        self.assertEqual(_parse_datetime('2020-01-02T03:04:05Z'),
+                         datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc))
+        self.assertEqual(_parse_datetime('2020-01-02T03:04:05-02:30').utcoffset(),
+                         -datetime.timedelta(hours=2, minutes=30))
+        for value in ['2020-01-32', '2020-01-02T25:00', '02/01/2020']:
+            with self.assertRaises(ValueError):
+                _parse_datetime(value)
+
+    @pytest.mark.skipif(not HAS_SQLALCHEMY, reason='sqlalchemy is not installed')
+    def test_apply_filters_and_sort(self):
+        Person, session = get_person_session()
+        query = session.query(Person)
+        self.assertEqual(get_indexed_columns(Person), ['id', 'name'])
+
+        def ids(filters, sort=(), allowed=None):
+            q = apply_sort(apply_filters(query, Person, filters, allowed), Person, sort, allowed)
+            return [p.id for p in q.order_by(Person.id)]
+
+        self.assertEqual(ids([('id', 'gt', '22')]), [23, 24, 25])
+        self.assertEqual(ids([('id', 'in', '3,1,2')], [('id', True)]), [3, 2, 1])
+        self.assertEqual(ids([('name', 'like', 'person 1%'), ('id', 'le', '11')]), [10, 11])
+        self.assertEqual(ids([('age', 'eq', '29')], allowed=['age']), [9, 19])
+        self.assertEqual(ids([('name', 'is_null', 'true')]), [])
+        with self.assertRaises(RSEApiException):
+            ids([('age', 'eq', '29')])
+        with self.assertRaises(RSEApiException):
+            ids([('id', 'eq', 'abc')])
+        with self.assertRaises(RSEApiException):
+            ids([], [('age', False)])
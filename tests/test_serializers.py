@@ -0,0 +1,115 @@
+import datetime
+import threading
+import unittest
+
+from marshmallow import Schema, fields, post_dump
+
+from rse_api.serializers import CompiledSerializer, get_compiled_serializer, dump_data, get_schema_instance
+
+
+class Owner:
+    def __init__(self, name):
+        self.name = name
+
+
+class Project:
+    def __init__(self, id, name, owner=None, **kwargs):
+        self.id = id
+        self.name = name
+        self.owner = owner
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def display(self):
+        return 'Project {}'.format(self.name)
+
+
+class OwnerSchema(Schema):
+    name = fields.String()
+
+
+class ProjectSchema(Schema):
+    id = fields.Integer()
+    name = fields.String()
+    score = fields.Float()
+    active = fields.Boolean()
+    created_at = fields.DateTime()
+    due = fields.Date()
+    title = fields.String(attribute='display')
+    code = fields.String(dump_to='projectCode')
+    secret = fields.String(load_only=True)
+    status = fields.String(default='new')
+    tags = fields.List(fields.String())
+    owner = fields.Nested(OwnerSchema)
+    owner_name = fields.String(attribute='owner.name')
+    upper = fields.Method('get_upper')
+    length = fields.Function(lambda obj: len(obj.name))
+
+    def get_upper(self, obj):
+        return obj.name.upper()
+
+
+class ProcessedSchema(Schema):
+    name = fields.String()
+
+    @post_dump
+    def wrap(self, data):
+        data['processed'] = True
+        return data
+
+
+def make_projects(count=20):
+    created = datetime.datetime(2019, 1, 2, 3, 4, 5)
+    return [Project(i, 'project {}'.format(i), Owner('owner {}'.format(i)), score=i / 3, active=i % 2,
+                    created_at=created, due=created.date(), code=str(i), secret='x', tags=['a', i],
+                    **(dict(status='done') if i % 3 == 0 else {}))
+            for i in range(count)]
+
+
+class TestSerializers(unittest.TestCase):
+
+    def test_parity_objects(self):
+        schema = ProjectSchema()
+        projects = make_projects()
+        serializer = CompiledSerializer(schema)
+        self.assertTrue(serializer.compiled)
+        self.assertEqual(serializer.dump(projects, many=True), dump_data(schema, projects, many=True))
+        self.assertEqual(serializer.dump(projects[3]), dump_data(schema, projects[3]))
+        self.assertNotIn('secret', serializer.dump(projects[3]))
+        self.assertIn('projectCode', serializer.dump(projects[3]))
+
+    def test_parity_dicts(self):
+        schema = ProjectSchema(exclude=['title', 'owner_name', 'upper', 'length'])
+        data = [dict(id='1', name=2, score='1.5', active='true'), dict(id=2, items='x'), {}]
+        serializer = CompiledSerializer(schema)
+        self.assertEqual(serializer.dump(data, many=True), dump_data(schema, data, many=True))
+
+    def test_fallback_on_errors(self):
+        schema = ProjectSchema(only=['id', 'name'])
+        data = [dict(id='not a number', name='a'), dict(id=1, name='b')]
+        self.assertEqual(CompiledSerializer(schema).dump(data, many=True), dump_data(schema, data, many=True))
+
+    def test_processors_are_not_compiled(self):
+        serializer = CompiledSerializer(ProcessedSchema())
+        self.assertFalse(serializer.compiled)
+        self.assertEqual(serializer.dump(dict(name='a')), dict(name='a', processed=True))
+
+    def test_cache(self):
+        self.assertIs(get_compiled_serializer(ProjectSchema()), get_compiled_serializer(ProjectSchema()))
+        self.assertIsNot(get_compiled_serializer(ProjectSchema()),
+                         get_compiled_serializer(ProjectSchema(only=['id'])))
+
+    def test_schema_instances(self):
+        schema = get_schema_instance(ProjectSchema, only=['id', 'name'])
+        self.assertIs(schema, get_schema_instance(ProjectSchema, only=('id', 'name')))
+        self.assertIsNot(schema, get_schema_instance(ProjectSchema))
+        self.assertEqual(set(schema.fields.keys()), {'id', 'name'})
+        self.assertIsNot(get_schema_instance(ProjectSchema, context={'a': 1}),
+                         get_schema_instance(ProjectSchema, context={'a': 1}))
+
+        # every thread has its own instances
+        other = []
+        thread = threading.Thread(target=lambda: other.append(get_schema_instance(ProjectSchema, only=['id', 'name'])))
+        thread.start()
+        thread.join()
+        self.assertIsNot(schema, other[0])
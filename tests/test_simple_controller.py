@@ -0,0 +1,245 @@
+import datetime
+import json
+import sys
+import types
+import unittest
+from importlib import util
+from unittest import mock
+
+HAS_FLASK_SQLALCHEMY = util.find_spec('flask_sqlalchemy') is not None and \
+    util.find_spec('marshmallow_sqlalchemy') is not None
+
+if HAS_FLASK_SQLALCHEMY and util.find_spec('rse_db') is None:
+    # minimal stand in for rse_db, which provides the Flask-SQLAlchemy instance used by SimpleController
+    from flask_sqlalchemy import SQLAlchemy
+    _db = SQLAlchemy()
+    rse_db_utils = types.ModuleType('rse_db.utils')
+    rse_db_utils.get_db = lambda: _db
+    sys.modules['rse_db'] = types.ModuleType('rse_db')
+    sys.modules['rse_db.utils'] = rse_db_utils
+
+
+def create_app():
+    from flask import Flask
+    from marshmallow import fields
+    from marshmallow_sqlalchemy import ModelSchema
+    from rse_db.utils import get_db
+    from rse_api.controllers.simple_controller import SimpleController
+    from rse_api.errors import register_common_error_handlers
+    from rse_api.routing import register_api
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db = get_db()
+    db.init_app(app)
+    register_common_error_handlers(app)
+
+    class Owner(db.Model):
+        __tablename__ = 'controller_owners'
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.String, index=True)
+
+    class Project(db.Model):
+        __tablename__ = 'controller_projects'
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.String, nullable=False, index=True)
+        size = db.Column(db.Integer)
+        updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+        owner_id = db.Column(db.Integer, db.ForeignKey('controller_owners.id'))
+        owner = db.relationship(Owner)
+
+    class OwnerSchema(ModelSchema):
+        class Meta:
+            model = Owner
+            sqla_session = db.session
+
+    class ProjectSchema(ModelSchema):
+        name = fields.String(required=True)
+        owner = fields.Nested(OwnerSchema, allow_none=True)
+
+        class Meta:
+            model = Project
+            sqla_session = db.session
+
+    class ProjectController(SimpleController):
+        def __init__(self):
+            super().__init__(Project, ProjectSchema, allow_bulk=True, allow_stream=True, etag=True,
+                             allow_sparse_fields=True, bulk_batch_size=2)
+
+    class ReturningProjectController(SimpleController):
+        def __init__(self):
+            super().__init__(Project, ProjectSchema, allow_bulk=True, bulk_return_ids=True)
+
+    class CursorProjectController(SimpleController):
+        def __init__(self):
+            super().__init__(Project, ProjectSchema, pagination='cursor')
+
+    register_api(ProjectController, 'projects', app=app, bulk=True)
+    register_api(ReturningProjectController, 'returning_projects', app=app, bulk=True)
+    register_api(CursorProjectController, 'cursor_projects', app=app)
+    app.project_controller = ProjectController
+    return app, db, Owner, Project
+
+
+@unittest.skipUnless(HAS_FLASK_SQLALCHEMY, "Flask-SQLAlchemy and marshmallow-sqlalchemy are required")
+class TestSimpleController(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app, cls.db, cls.Owner, cls.Project = create_app()
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+        self.db.create_all()
+        self.db.session.add_all([self.Owner(id=i, name='owner {}'.format(i)) for i in range(1, 4)])
+        self.db.session.add_all([self.Project(id=i, name='p{:02d}'.format(i), size=i, owner_id=1 + i % 3)
+                                 for i in range(1, 11)])
+        self.db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.db.session.remove()
+        self.db.drop_all()
+        self.context.pop()
+
+    def send(self, method, url, data):
+        return self.client.open(url, method=method, data=json.dumps(data), content_type='application/json')
+
+    def test_find_all(self):
+        response = self.client.get('/projects?page=2&per_page=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.get_json()], [4, 5, 6])
+        self.assertEqual(response.headers['X-Total'], '10')
+        self.assertEqual(response.get_json()[0]['owner']['name'], 'owner 2')
+
+    def test_find_all_by_cursor(self):
+        ids = []
+        url = '/cursor_projects?per_page=4'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item['id'] for item in response.get_json())
+            cursor = response.headers.get('X-Next-Cursor', None)
+            url = '/cursor_projects?per_page=4&after={}'.format(cursor) if cursor else None
+        self.assertEqual(ids, list(range(1, 11)))
+        self.assertEqual(self.client.get('/cursor_projects?sort=-id').status_code, 400)
+
+    def test_stream_all(self):
+        response = self.client.get('/projects?stream=ndjson')
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines() if line]
+        self.assertEqual([item['id'] for item in lines], list(range(1, 11)))
+        response = self.client.get('/projects?stream=json')
+        self.assertEqual(len(json.loads(response.get_data(as_text=True))), 10)
+
+    def test_sparse_fields(self):
+        response = self.client.get('/projects?fields=id,name&per_page=2')
+        self.assertEqual(response.get_json(), [{'id': 1, 'name': 'p01'}, {'id': 2, 'name': 'p02'}])
+        self.assertEqual(self.client.get('/projects?fields=unknown').status_code, 400)
+
+    def test_filter_and_sort(self):
+        response = self.client.get('/projects?filter[name][in]=p02,p05,p07&sort=-name')
+        self.assertEqual([item['id'] for item in response.get_json()], [7, 5, 2])
+        self.assertEqual(response.headers['X-Total'], '3')
+        # size is not indexed
+        self.assertEqual(self.client.get('/projects?filter[size][gt]=2').status_code, 400)
+
+    def test_etag(self):
+        response = self.client.get('/projects/1')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = self.client.get('/projects/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.send('PATCH', '/projects/1', {'name': 'changed'})
+        response = self.client.get('/projects/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_patch(self):
+        response = self.send('PATCH', '/projects/3', {'name': 'renamed'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['name'], 'renamed')
+        self.assertEqual(response.get_json()['size'], 3)
+        self.assertEqual(self.Project.query.get(3).name, 'renamed')
+
+    def test_delete(self):
+        self.assertEqual(self.client.delete('/projects/2').status_code, 204)
+        self.assertIsNone(self.Project.query.get(2))
+        self.assertEqual(self.client.delete('/projects/2').status_code, 404)
+
+    def test_bulk_create(self):
+        from sqlalchemy import event
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT'):
+                statements.append(executemany)
+
+        event.listen(self.db.engine, 'before_cursor_execute', count_statement)
+        try:
+            response = self.send('POST', '/projects', [{'name': 'new 1', 'size': 1}, {'size': 2},
+                                                       {'name': 'new 3', 'size': 3}, {'name': 'new 4', 'size': 4}])
+        finally:
+            event.remove(self.db.engine, 'before_cursor_execute', count_statement)
+        self.assertEqual(response.status_code, 207)
+        statuses = response.get_json()
+        self.assertEqual([status['status'] for status in statuses], [201, 400, 201, 201])
+        self.assertIn('name', statuses[1]['errors'])
+        self.assertEqual(self.Project.query.filter(self.Project.name.like('new %')).count(), 3)
+        # sqlite cannot return the generated ids of a multi row insert
+        self.assertEqual([status.get('id', None) for status in statuses], [None, None, None, None])
+        # one executemany per batch of bulk_batch_size rows
+        self.assertEqual(statements, [True, False])
+
+    def test_bulk_create_return_ids(self):
+        response = self.send('POST', '/returning_projects', [{'name': 'new 1'}, {'name': 'new 2'}])
+        self.assertEqual(response.status_code, 201)
+        statuses = response.get_json()
+        self.assertEqual(self.Project.query.get(statuses[0]['id']).name, 'new 1')
+        self.assertEqual(self.Project.query.get(statuses[1]['id']).name, 'new 2')
+
+    def test_insert_rows_returning(self):
+        from sqlalchemy.dialects import postgresql
+        statements = []
+
+        def execute(statement, mapper):
+            statements.append(str(statement.compile(dialect=postgresql.dialect())))
+            return [(len(statements) * 10 + i,) for i in range(len(statement.parameters))]
+
+        session = mock.Mock()
+        session.get_bind.return_value.dialect.name = 'postgresql'
+        session.execute.side_effect = execute
+        controller = self.app.project_controller()
+        ids = controller.insert_rows(session, [{'name': 'a'}, {'name': 'b', 'size': 2}, {'name': 'c'}])
+        # rows are grouped by columns, each group is one INSERT .. RETURNING
+        self.assertEqual(ids, [10, 20, 11])
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(all(statement.endswith('RETURNING controller_projects.id') for statement in statements))
+
+    def test_bulk_create_relationships(self):
+        response = self.send('POST', '/projects', [{'name': 'a', 'owner': {'name': 'nested'}}, {'name': 'b'}])
+        self.assertEqual(response.status_code, 207)
+        statuses = response.get_json()
+        self.assertEqual(statuses[0]['status'], 400)
+        self.assertIn('owner', statuses[0]['errors'])
+        self.assertEqual(self.Owner.query.filter_by(name='nested').count(), 0)
+        self.assertEqual(statuses[1]['status'], 201)
+
+    def test_bulk_update(self):
+        response = self.send('PATCH', '/projects', [{'id': '2', 'name': 'two'}, {'id': 3, 'size': 30},
+                                                    {'id': 99, 'name': 'missing'}, {'id': 'x', 'name': 'bad'},
+                                                    {'id': 4, 'owner': {'name': 'nested'}}])
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([status['status'] for status in response.get_json()], [200, 200, 404, 400, 400])
+        self.assertEqual(response.get_json()[0]['id'], 2)
+        self.db.session.expire_all()
+        self.assertEqual(self.Project.query.get(2).name, 'two')
+        self.assertEqual(self.Project.query.get(3).size, 30)
+        self.assertEqual(self.Project.query.get(3).name, 'p03')
+
+    def test_bulk_delete(self):
+        response = self.send('DELETE', '/projects', {'ids': [1, '2', 99, 'x']})
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([status['status'] for status in response.get_json()], [204, 204, 404, 400])
+        self.assertEqual(self.Project.query.count(), 8)
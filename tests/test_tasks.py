@@ -0,0 +1,121 @@
+import threading
+import time
+import unittest
+
+import dramatiq
+from dramatiq import Worker
+from dramatiq.brokers.stub import StubBroker
+from dramatiq.middleware import default_middleware, Prometheus
+from flask import Flask, g, _app_ctx_stack
+
+from rse_api.tasks.app_context_middleware import AppContextMiddleware
+
+
+def make_broker(reuse_context):
+    app = Flask(__name__)
+    teardowns = []
+    app.teardown_appcontext(lambda exc: teardowns.append(exc))
+    # the prometheus exposition server is not needed and binds a port
+    broker = StubBroker(middleware=[m() for m in default_middleware if m is not Prometheus])
+    broker.add_middleware(AppContextMiddleware(app, reuse_context))
+    return app, broker, teardowns
+
+
+class TestAppContextMiddleware(unittest.TestCase):
+
+    def run_messages(self, reuse_context, count=5):
+        app, broker, teardowns = make_broker(reuse_context)
+        seen = []
+
+        @dramatiq.actor(broker=broker)
+        def task(i):
+            seen.append((id(_app_ctx_stack.top), g.get('value', None)))
+            g.value = i
+
+        for i in range(count):
+            task.send(i)
+        worker = Worker(broker, worker_timeout=100, worker_threads=1)
+        worker.start()
+        broker.join(task.queue_name)
+        worker.join()
+        processed_teardowns = list(teardowns)
+        worker.stop()
+        return seen, processed_teardowns
+
+    def test_context_per_message(self):
+        seen, teardowns = self.run_messages(False)
+        self.assertEqual([value for context, value in seen], [None] * 5)
+        self.assertEqual(len(teardowns), 5)
+
+    def test_reuse_context(self):
+        seen, teardowns = self.run_messages(True)
+        # one context for the thread, g is cleared and teardown functions run after every message
+        self.assertEqual(len(set(context for context, value in seen)), 1)
+        self.assertEqual([value for context, value in seen], [None] * 5)
+        self.assertEqual(len(teardowns), 5)
+
+
+class TestBatchActor(unittest.TestCase):
+
+    def test_batch_actor(self):
+        from rse_api.decorators import batch_actor
+        app, broker, teardowns = make_broker(False)
+        dramatiq.set_broker(broker)
+        batches = []
+
+        @batch_actor(max_batch_size=3, max_wait_ms=200, max_retries=0)
+        def ingest(items):
+            batches.append(items)
+            return [ValueError(item) if item == 'bad' else item for item in items]
+
+        items = ['a', 'b', 'bad', 'c', 'd', 'e', 'f']
+        for item in items:
+            ingest.send(item)
+        worker = Worker(broker, worker_timeout=100, worker_threads=4)
+        worker.start()
+        broker.join(ingest.queue_name)
+        worker.join()
+        worker.stop()
+
+        self.assertEqual(sorted(item for batch in batches for item in batch), sorted(items))
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        self.assertLess(len(batches), len(items))
+        # only the message of the failed item is dead lettered
+        self.assertEqual([message.args for message in broker.dead_letters], [('bad',)])
+
+    def run_throughput(self, batch, count=400):
+        from rse_api.decorators import batch_actor
+        app, broker, teardowns = make_broker(False)
+        dramatiq.set_broker(broker)
+        # a resource used by one call at a time, ie the commits of a database
+        resource = threading.Lock()
+
+        def commit():
+            with resource:
+                time.sleep(0.002)
+
+        if batch:
+            # max_batch_size cannot be reached with 8 threads, batches run once every thread is waiting on them
+            @batch_actor(max_batch_size=100, max_wait_ms=1000)
+            def ingest(items):
+                commit()
+        else:
+            @dramatiq.actor(broker=broker)
+            def ingest(item):
+                commit()
+
+        for i in range(count):
+            ingest.send(i)
+        worker = Worker(broker, worker_timeout=10, worker_threads=8)
+        start = time.perf_counter()
+        worker.start()
+        broker.join(ingest.queue_name)
+        worker.join()
+        elapsed = time.perf_counter() - start
+        worker.stop()
+        return count / elapsed
+
+    def test_batch_actor_throughput(self):
+        plain = self.run_throughput(False)
+        batched = self.run_throughput(True)
+        self.assertGreater(batched, plain * 2)
@@ -1,7 +1,14 @@
+import json
 import os
+import sys
+import tempfile
+import textwrap
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-from rse_api.utils import load_modules
+from rse_api import utils
+from rse_api.utils import build_manifest, get_lazy_actors, list_module_files, load_modules, scan_module
 
 
 class TestUtils(unittest.TestCase):
@@ -10,3 +17,169 @@ class TestUtils(unittest.TestCase):
         controller_path = os.path.join(path, 'controllers')
         modules = load_modules('tests.dummy_app.controllers', controller_path)
         self.assertEquals(modules, ['tests.dummy_app.controllers.dummy_controller', 'tests.dummy_app.controllers.nested.nested_controller'])
+
+
+class TestLazyModules(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.package_dir = os.path.join(self.tmp.name, 'lazy_pkg')
+        self.write('__init__.py', "from flask import Flask\napp = Flask(__name__)\n")
+        self.write('views/__init__.py', '')
+        self.write('views/items.py', """
+            from lazy_pkg import app
+
+            @app.route('/items/<int:id>')
+            def item(id):
+                return str(id)
+        """)
+        self.write('views/tasks.py', """
+            import dramatiq
+            from dramatiq.brokers.stub import StubBroker
+            dramatiq.set_broker(StubBroker())
+
+            @dramatiq.actor(actor_name='send_mail', queue_name='mail')
+            def send(to):
+                pass
+        """)
+        self.write('views/dynamic.py', """
+            from lazy_pkg import app
+            URL = '/dynamic'
+            app.add_url_rule(URL, 'dynamic', lambda: 'dynamic')
+        """)
+        sys.path.insert(0, self.tmp.name)
+
+    def tearDown(self):
+        sys.path.remove(self.tmp.name)
+        for name in list(sys.modules):
+            if name.startswith('lazy_pkg'):
+                del sys.modules[name]
+        utils.LAZY_MODULES.clear()
+        utils.MODULE_SCANS.clear()
+        utils._SCAN_CACHE.clear()
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.package_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(textwrap.dedent(content))
+
+    def test_scan_module(self):
+        views = os.path.join(self.package_dir, 'views')
+        self.assertEqual(scan_module(os.path.join(views, 'items.py')),
+                         dict(routes=['/items/<int:id>'], actors=[], dynamic=False))
+        self.assertEqual(scan_module(os.path.join(views, 'tasks.py')),
+                         dict(routes=[], actors=['send_mail'], dynamic=False))
+        self.assertTrue(scan_module(os.path.join(views, 'dynamic.py'))['dynamic'])
+
+    def test_scan_module_actors(self):
+        self.write('actors.py', """
+            import dramatiq
+            from rse_api.decorators import actor, cron
+
+            @actor(queue_name='mail')
+            def send(to):
+                pass
+
+            @dramatiq.actor(max_retries=3)
+            def retry():
+                pass
+
+            @cron('*/1 * * * *')
+            def every_minute():
+                pass
+        """)
+        self.assertEqual(scan_module(os.path.join(self.package_dir, 'actors.py')),
+                         dict(routes=[], actors=['every_minute', 'retry', 'send'], dynamic=False))
+        path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'dummy_app', 'tasks', 'example_cron.py')
+        self.assertEqual(scan_module(path)['actors'], ['get_new_message'])
+
+    def test_scan_module_unknown_routes(self):
+        self.write('resources.py', """
+            from lazy_pkg import api, app, bp
+
+            api.add_resource(Item, '/items')
+            app.register_blueprint(bp)
+
+            @actor
+            def send(to):
+                pass
+        """)
+        self.assertTrue(scan_module(os.path.join(self.package_dir, 'resources.py'))['dynamic'])
+
+    def test_manifest_is_cached(self):
+        manifest_path = os.path.join(self.tmp.name, 'manifest.json')
+        views = os.path.join(self.package_dir, 'views')
+        manifest = build_manifest('lazy_pkg.views', views, manifest_path=manifest_path)
+        with open(manifest_path) as f:
+            self.assertEqual(json.load(f), manifest)
+        self.assertEqual(sorted(manifest['modules']),
+                         ['lazy_pkg.views.dynamic', 'lazy_pkg.views.items', 'lazy_pkg.views.tasks'])
+
+        # unchanged modules are not scanned again
+        with mock.patch('rse_api.utils.scan_module', side_effect=AssertionError) as scan:
+            self.assertEqual(build_manifest('lazy_pkg.views', views, manifest_path=manifest_path), manifest)
+            scan.assert_not_called()
+
+    def test_list_module_files_cache(self):
+        cache_path = os.path.join(self.tmp.name, 'scan.json')
+        views = os.path.join(self.package_dir, 'views')
+        files = list_module_files('lazy_pkg.views', views, cache_path=cache_path)
+        self.assertEqual(sorted(name for name, path in files),
+                         ['lazy_pkg.views.dynamic', 'lazy_pkg.views.items', 'lazy_pkg.views.tasks'])
+
+        # the cache file is used while no directory changed
+        utils._SCAN_CACHE.clear()
+        with mock.patch('rse_api.utils.os.walk', side_effect=AssertionError) as walk:
+            self.assertEqual(list_module_files('lazy_pkg.views', views, cache_path=cache_path), files)
+            walk.assert_not_called()
+
+        self.write('views/more.py', '')
+        os.utime(views, (0, 0))
+        files = list_module_files('lazy_pkg.views', views, cache_path=cache_path)
+        self.assertIn('lazy_pkg.views.more', [name for name, path in files])
+
+    def test_import_times(self):
+        with mock.patch.dict('rse_api.utils.IMPORT_TIMES', clear=True):
+            load_modules('lazy_pkg.views', os.path.join(self.package_dir, 'views'))
+            imports = dict(utils.get_startup_profile()['imports'])
+        self.assertEqual(sorted(imports), ['lazy_pkg.views.dynamic', 'lazy_pkg.views.items', 'lazy_pkg.views.tasks'])
+
+    def test_lazy_load(self):
+        import lazy_pkg
+        views = os.path.join(self.package_dir, 'views')
+        modules = load_modules('lazy_pkg.views', views, lazy=True, app=lazy_pkg.app)
+        self.assertEqual(sorted(modules), ['lazy_pkg.views.dynamic', 'lazy_pkg.views.items', 'lazy_pkg.views.tasks'])
+        # dynamic modules are imported right away
+        self.assertIn('lazy_pkg.views.dynamic', sys.modules)
+        self.assertNotIn('lazy_pkg.views.items', sys.modules)
+        self.assertEqual(get_lazy_actors(), ['send_mail'])
+
+        client = lazy_pkg.app.test_client()
+        self.assertEqual(client.get('/other').status_code, 404)
+        self.assertNotIn('lazy_pkg.views.items', sys.modules)
+        response = client.get('/items/3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'3')
+        self.assertIn('lazy_pkg.views.items', sys.modules)
+        self.assertNotIn('lazy_pkg.views.tasks', sys.modules)
+
+    def test_lazy_load_in_debug(self):
+        import lazy_pkg
+        lazy_pkg.app.debug = True
+        load_modules('lazy_pkg.views', os.path.join(self.package_dir, 'views'), lazy=True, app=lazy_pkg.app)
+        self.assertIn('lazy_pkg.views.items', sys.modules)
+        self.assertEqual(utils.LAZY_MODULES, {})
+
+    def test_lazy_load_concurrent_requests(self):
+        import lazy_pkg
+        load_modules('lazy_pkg.views', os.path.join(self.package_dir, 'views'), lazy=True, app=lazy_pkg.app)
+
+        def get(path):
+            with lazy_pkg.app.test_client() as client:
+                return client.get(path).status_code
+
+        with ThreadPoolExecutor(8) as executor:
+            statuses = list(executor.map(get, ['/items/{}'.format(i) for i in range(16)]))
+        self.assertEqual(statuses, [200] * 16)
+        self.assertEqual(get('/items/abc'), 404)